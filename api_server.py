@@ -0,0 +1,204 @@
+"""
+HTTP API расчёта стоимости доставки (aiohttp) рядом с интерфейсом Streamlit.
+
+Эндпоинты:
+    GET  /health        — состояние сервиса
+    GET  /metrics       — метрики в формате Prometheus (при нескольких воркерах — сумма по всем)
+    POST /quote         — один заказ: {"address": ..., "cargo_size": ..., "delivery_date": ..., "use_route": ...}
+                          или {"lat": ..., "lon": ...} вместо адреса (также GET /quote?address=...)
+    POST /quote/batch   — {"orders": [заказ, ...]} или просто список заказов
+
+Ответ на заказ — поля RESULT_FIELDS из batch_quote: cost, source
+(город/кэш/ors/haversine/сетка), total_distance, dist_to_exit, exit_point и т. д.
+Логика та же, что у формы и пакетного расчёта (BatchPricer →
+calculate_delivery_cost). Кэш расстояний и геокодирования — общие SQLite,
+поэтому их видят все процессы API и приложение Streamlit.
+
+Запуск:
+    API_KEY=... ORS_API_KEY=... python api_server.py --port 8080 --workers 4
+Если задан API_TOKEN, запросы должны передавать его в заголовке
+Authorization: Bearer <token> или X-API-Key (в том числе сборщик /metrics).
+С --workers N метрики воркеров собираются в каталоге METRICS_DIR (по умолчанию
+delivery-metrics-<порт> во временном каталоге), поэтому /metrics — одна цель для сбора.
+"""
+import argparse
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+from functools import partial
+
+from aiohttp import web
+
+from batch_quote import INPUT_FIELDS, RESULT_FIELDS, BatchPricer
+from cache_store import get_cache_store
+from delivery_core import UpstreamError, get_reference_data, start_reference_watcher
+from http_client import close_client
+from metrics import CONTENT_TYPE, clear_multiprocess_dir, render_metrics, start_multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Сколько заказов принимается в одном пакетном запросе
+MAX_BATCH = 1000
+# Статусы внешнего сервиса, при которых /quote отвечает 503 (временно недоступен), а не 502;
+# None — ответа не было совсем (соединение, таймаут, нет ключа)
+UNAVAILABLE_STATUSES = {None, 429, 503, 504}
+
+json_dumps = partial(json.dumps, ensure_ascii=False, default=str)
+
+
+def _json(data, status=200):
+    return web.json_response(data, status=status, dumps=json_dumps)
+
+
+def _order(data):
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest(text=json_dumps({'error': "Заказ должен быть JSON-объектом"}),
+                                 content_type='application/json')
+    return {k: data.get(k) for k in INPUT_FIELDS}
+
+
+def _response(result):
+    return {k: result.get(k) for k in RESULT_FIELDS}
+
+
+async def _read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text=json_dumps({'error': "Тело запроса — не JSON"}),
+                                 content_type='application/json')
+
+
+def _pricer(request):
+    app = request.app
+    return BatchPricer(app['api_key'], app['routing_api_key'], store=app['store'],
+                       concurrency=app['concurrency'])
+
+
+# ----------------------------
+# Обработчики
+# ----------------------------
+async def health(request):
+    reference = get_reference_data()
+    return _json({'status': 'ok', 'reference_version': reference.version, 'cache_entries': len(request.app['store']),
+                  'geocoding': bool(request.app['api_key']), 'routing': bool(request.app['routing_api_key'])})
+
+
+async def metrics(request):
+    return web.Response(body=render_metrics().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def quote(request):
+    """
+    Один заказ. Ошибка ввода (размер груза, адрес не найден) — 422; сбой
+    внешнего сервиса — 503, если он недоступен или ограничил частоту запросов,
+    иначе 502; прочие ошибки — 500 с трассировкой в логе.
+    """
+    data = dict(request.query) if request.method == 'GET' else await _read_json(request)
+    order = _order(data)
+    try:
+        result = await _pricer(request).price_row(order, raise_errors=True)
+    except UpstreamError as e:
+        logger.warning(f"Внешний сервис: {e}")
+        return _json({'error': str(e)}, status=503 if e.status in UNAVAILABLE_STATUSES else 502)
+    except ValueError as e:
+        return _json({'error': str(e)}, status=422)
+    except Exception:
+        logger.exception("Ошибка расчёта заказа")
+        return _json({'error': "Внутренняя ошибка сервера"}, status=500)
+    return _json(_response(result))
+
+
+async def quote_batch(request):
+    data = await _read_json(request)
+    orders = data.get('orders') if isinstance(data, dict) else data
+    if not isinstance(orders, list):
+        return _json({'error': "Ожидается список заказов или {\"orders\": [...]}"}, status=400)
+    if len(orders) > request.app['max_batch']:
+        return _json({'error': f"Не больше {request.app['max_batch']} заказов в одном запросе"}, status=413)
+    orders = [_order(order) for order in orders]
+    pricer = _pricer(request)
+    results = [_response(result) async for result in pricer.price_rows(orders)]
+    return _json({'results': results, 'stats': pricer.stats})
+
+
+@web.middleware
+async def auth_middleware(request, handler):
+    token = request.app['api_token']
+    if token and request.path != '/health':
+        header = request.headers.get('Authorization', '')
+        given = header[7:] if header.startswith('Bearer ') else request.headers.get('X-API-Key', '')
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            return _json({'error': "Неверный токен API"}, status=401)
+    return await handler(request)
+
+
+async def _close_client(app):
+    await close_client()
+
+
+def create_app(api_key=None, routing_api_key=None, api_token=None, store=None, concurrency=16, max_batch=MAX_BATCH):
+    app = web.Application(middlewares=[auth_middleware], client_max_size=8 * 1024 ** 2)
+    app['api_key'] = api_key
+    app['routing_api_key'] = routing_api_key
+    app['api_token'] = api_token
+    app['store'] = store if store is not None else get_cache_store()
+    app['concurrency'] = concurrency
+    app['max_batch'] = max_batch
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_route('GET', '/quote', quote)
+    app.router.add_post('/quote', quote)
+    app.router.add_post('/quote/batch', quote_batch)
+    app.on_cleanup.append(_close_client)
+    return app
+
+
+def _serve(host, port, reuse_port, concurrency, max_batch, metrics_dir=None):
+    if metrics_dir:
+        start_multiprocess(metrics_dir)
+    # Справочные данные грузим до приёма запросов, а не на первом из них, и следим за их файлами
+    get_reference_data()
+    start_reference_watcher()
+    app = create_app(os.environ.get('API_KEY'), os.environ.get('ORS_API_KEY'), os.environ.get('API_TOKEN'),
+                     concurrency=concurrency, max_batch=max_batch)
+    web.run_app(app, host=host, port=port, reuse_port=reuse_port, print=None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP API расчёта стоимости доставки")
+    parser.add_argument('--host', default=os.environ.get('API_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8080)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('API_WORKERS', 1)),
+                        help="Число процессов (общий порт через SO_REUSEPORT)")
+    parser.add_argument('--concurrency', type=int, default=16, help="Заказов одного пакета одновременно")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.workers <= 1:
+        _serve(args.host, args.port, False, args.concurrency, args.max_batch)
+        return 0
+    # Сборщик попадает в случайный воркер: каждый отдаёт сумму метрик всех воркеров из общего каталога
+    metrics_dir = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), f'delivery-metrics-{args.port}')
+    clear_multiprocess_dir(metrics_dir)
+    serve = partial(_serve, args.host, args.port, True, args.concurrency, args.max_batch, metrics_dir)
+    workers = [multiprocessing.Process(target=serve, name=f'api-worker-{i}') for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"API: {args.workers} процессов на {args.host}:{args.port}")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
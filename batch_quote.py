@@ -0,0 +1,308 @@
+"""
+Пакетный расчёт стоимости доставки из CSV, JSONL или JSON-массива.
+
+Каждая строка файла — заказ: адрес (или координаты в колонках lat/lon),
+размер груза, дата доставки и признак доставки по рейсу. Результаты
+выдаются построчно по мере расчёта; одинаковые адреса геокодируются один раз,
+а расстояние до каждого населённого пункта/координаты считается один раз
+за прогон и сразу попадает в общее хранилище кэша.
+
+Пример:
+    python batch_quote.py orders.csv -o priced.csv
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import sys
+from collections import deque
+from datetime import date, datetime
+
+from delivery_core import (
+    UpstreamError,
+    calculate_delivery_cost,
+    check_route_match,
+    coordinates_locality,
+    extract_locality,
+    geocode_address_async,
+    get_cache_store,
+    is_inside_tver,
+    next_route_day,
+    parse_coordinates,
+    route_savings,
+)
+from geocode_cache import normalize_address
+from http_client import close_client, run_sync
+from metrics import count, timed
+
+logger = logging.getLogger(__name__)
+
+INPUT_FIELDS = ['address', 'lat', 'lon', 'cargo_size', 'delivery_date', 'use_route']
+RESULT_FIELDS = ['cost', 'locality', 'source', 'total_distance', 'dist_to_exit', 'exit_point',
+                 'rate_per_km', 'route_available', 'optimal_day', 'optimal_date', 'route_saving', 'error']
+TRUE_VALUES = {'1', 'true', 'yes', 'да', 'y'}
+# Сколько строк рассчитывается одновременно
+DEFAULT_CONCURRENCY = 16
+
+
+# ----------------------------
+# Чтение и запись файлов
+# ----------------------------
+def read_orders(stream, fmt):
+    """
+    Читать заказы из текстового потока формата csv, jsonl (объект на строке)
+    или json (массив объектов или {"orders": [...]}, как у API; читается целиком).
+    """
+    if fmt == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    elif fmt == 'json':
+        data = json.load(stream)
+        orders = data.get('orders') if isinstance(data, dict) else data
+        if not isinstance(orders, list) or not all(isinstance(order, dict) for order in orders):
+            raise ValueError("JSON-файл должен содержать массив заказов-объектов или {\"orders\": [...]}")
+        yield from orders
+    else:
+        dialect = csv.excel
+        if stream.seekable():
+            sample = stream.read(4096)
+            stream.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+            except csv.Error:
+                pass
+        yield from csv.DictReader(stream, dialect=dialect)
+
+
+def detect_format(path):
+    path = path.lower()
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'json' if path.endswith('.json') else 'csv'
+
+
+def parse_date(value):
+    if not value:
+        return None
+    if isinstance(value, date):
+        return value
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"Неверная дата: {value}. Ожидается ДД.ММ.ГГГГ или ГГГГ-ММ-ДД")
+
+
+def _coords_from_row(row):
+    lat, lon = row.get('lat'), row.get('lon')
+    if lat not in (None, '') and lon not in (None, ''):
+        return float(lat), float(lon)
+    return parse_coordinates(row.get('address') or '')
+
+
+# ----------------------------
+# Расчёт
+# ----------------------------
+class BatchPricer:
+    """Расчёт потока заказов с дедупликацией геокодирования и маршрутизации."""
+
+    def __init__(self, api_key=None, routing_api_key=None, store=None, concurrency=DEFAULT_CONCURRENCY):
+        self.api_key = api_key
+        self.routing_api_key = routing_api_key
+        self.store = store if store is not None else get_cache_store()
+        self.concurrency = concurrency
+        self.geocoded = {}
+        self.routed = set()
+        self.stats = {'rows': 0, 'errors': 0, 'geocoded': 0, 'routed': 0}
+
+    async def _geocode(self, address):
+        key = normalize_address(address)
+        if key not in self.geocoded:
+            if not self.api_key:
+                raise UpstreamError("API-ключ для геокодирования не настроен")
+            # Храним задачу, а не результат: параллельные строки с тем же адресом ждут один запрос
+            self.geocoded[key] = asyncio.ensure_future(geocode_address_async(address, self.api_key))
+            self.stats['geocoded'] += 1
+        return await self.geocoded[key]
+
+    async def locate(self, row):
+        """
+        Координаты заказа: (lat, lon, населённый пункт, адрес для расчёта).
+
+        Координаты берутся из колонок lat/lon или из адреса, иначе адрес
+        геокодируется (повторные адреса — один запрос за прогон).
+        """
+        address = (row.get('address') or '').strip()
+        with timed('parse'):
+            coords = _coords_from_row(row)
+        if coords and address and not parse_coordinates(address):
+            # Координаты заданы колонками, адрес используем для населённого пункта
+            dest_lat, dest_lon = coords
+            return dest_lat, dest_lon, extract_locality(address, (dest_lat, dest_lon)), address
+        if coords:
+            dest_lat, dest_lon = coords
+            locality = coordinates_locality(dest_lat, dest_lon)
+            return dest_lat, dest_lon, locality, locality
+        if address:
+            dest_lat, dest_lon = await self._geocode(address)
+            return dest_lat, dest_lon, extract_locality(address, (dest_lat, dest_lon)), address
+        raise ValueError("Не указан адрес или координаты")
+
+    async def price_row(self, row, raise_errors=False):
+        """
+        Рассчитать один заказ. Ошибка расчёта попадает в поле error строки;
+        с raise_errors=True исключение (после учёта в статистике) пробрасывается
+        вызывающему — так API отличает ошибку ввода от сбоя внешнего сервиса.
+        """
+        result = dict(row)
+        self.stats['rows'] += 1
+        try:
+            cargo_size = (row.get('cargo_size') or 'маленький').strip()
+            delivery_date = parse_date(row.get('delivery_date')) or date.today()
+            dest_lat, dest_lon, locality, address = await self.locate(row)
+            route_available = check_route_match(locality, delivery_date)
+            use_route_rate = route_available and str(row.get('use_route', '')).strip().lower() in TRUE_VALUES
+            # Параллельные строки с одним населённым пунктом ждут один запрос к ORS (single-flight в ядре)
+            quote = await calculate_delivery_cost(
+                cargo_size, dest_lat, dest_lon, address, self.routing_api_key,
+                delivery_date, use_route_rate, store=self.store)
+            if quote.source in ('ors', 'haversine', 'graph') and quote.locality not in self.routed:
+                self.routed.add(quote.locality)
+                self.stats['routed'] += 1
+            optimal = saving = None
+            if not route_available and not is_inside_tver(dest_lat, dest_lon):
+                optimal = next_route_day(quote.locality, delivery_date)
+            if optimal:
+                saving = route_savings(quote.locality, cargo_size, quote.total_distance, [optimal.date])[0].saving
+            result.update({
+                'cost': quote.cost,
+                'locality': quote.locality,
+                'source': quote.source,
+                'total_distance': round(quote.total_distance, 3),
+                'dist_to_exit': round(quote.dist_to_exit, 3),
+                'exit_point': quote.nearest_exit,
+                'rate_per_km': quote.rate_per_km,
+                'route_available': route_available,
+                'optimal_day': optimal.weekday if optimal else None,
+                'optimal_date': optimal.date.isoformat() if optimal else None,
+                'route_saving': saving,
+                'error': None,
+            })
+        except Exception as e:
+            self.stats['errors'] += 1
+            count('delivery_quote_errors_total')
+            if raise_errors:
+                raise
+            if not isinstance(e, ValueError):
+                logger.exception(f"Ошибка расчёта строки {row!r}")
+            result['error'] = str(e)
+        return result
+
+    async def price_rows(self, rows):
+        """
+        Асинхронный генератор рассчитанных строк в порядке входного потока.
+
+        Одновременно рассчитывается до concurrency строк; лимиты ORS/Яндекса
+        соблюдает общий HTTP-клиент.
+        """
+        pending = deque()
+        for row in rows:
+            pending.append(asyncio.ensure_future(self.price_row(row)))
+            if len(pending) >= self.concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+
+
+class _RowWriter:
+    def __init__(self, stream, fmt, fieldnames):
+        self.stream = stream
+        self.fmt = fmt
+        self.fieldnames = fieldnames
+        self.csv_writer = None
+        self.rows = 0
+
+    def close(self):
+        if self.fmt == 'json':
+            self.stream.write('\n]\n' if self.rows else '[]\n')
+
+    def write(self, row):
+        if self.fmt == 'json':
+            # Массив пишется построчно: «[» перед первой строкой, «]» в close()
+            self.stream.write(('[\n' if not self.rows else ',\n') + json.dumps(row, ensure_ascii=False))
+            self.rows += 1
+            return
+        if self.fmt == 'jsonl':
+            self.stream.write(json.dumps(row, ensure_ascii=False) + '\n')
+            return
+        if self.csv_writer is None:
+            fieldnames = self.fieldnames + [k for k in row if k not in self.fieldnames]
+            self.csv_writer = csv.DictWriter(self.stream, fieldnames=fieldnames, extrasaction='ignore')
+            self.csv_writer.writeheader()
+        self.csv_writer.writerow({k: json.dumps(v) if isinstance(v, (list, tuple)) else v for k, v in row.items()})
+
+
+async def price_stream(in_stream, out_stream, in_fmt='csv', out_fmt='csv', pricer=None):
+    """Рассчитать заказы из in_stream и построчно записать в out_stream. Вернуть статистику."""
+    pricer = pricer or BatchPricer(os.environ.get("API_KEY"), os.environ.get("ORS_API_KEY"))
+    writer = _RowWriter(out_stream, out_fmt, INPUT_FIELDS + RESULT_FIELDS)
+    async for row in pricer.price_rows(read_orders(in_stream, in_fmt)):
+        writer.write(row)
+        out_stream.flush()
+    writer.close()
+    return pricer.stats
+
+
+async def _run_cli(in_stream, out_stream, in_fmt, out_fmt, concurrency):
+    pricer = BatchPricer(os.environ.get("API_KEY"), os.environ.get("ORS_API_KEY"), concurrency=concurrency)
+    try:
+        return await price_stream(in_stream, out_stream, in_fmt, out_fmt, pricer)
+    finally:
+        await close_client()
+
+
+def price_bytes(data, filename, pricer=None):
+    """Рассчитать загруженный файл целиком (для виджета загрузки). Вернуть (CSV-текст, статистику)."""
+    in_stream = io.StringIO(data.decode('utf-8-sig'))
+    out_stream = io.StringIO()
+    stats = run_sync(price_stream(in_stream, out_stream, detect_format(filename), 'csv', pricer))
+    return out_stream.getvalue(), stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетный расчёт стоимости доставки")
+    parser.add_argument('input', help="CSV, JSONL или JSON-массив с заказами ('-' — stdin, CSV)")
+    parser.add_argument('-o', '--output', default='-', help="Файл результата ('-' — stdout)")
+    parser.add_argument('--input-format', choices=['csv', 'jsonl', 'json'])
+    parser.add_argument('--output-format', choices=['csv', 'jsonl', 'json'])
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Сколько строк рассчитывать одновременно")
+    args = parser.parse_args(argv)
+
+    in_fmt = args.input_format or ('csv' if args.input == '-' else detect_format(args.input))
+    out_fmt = args.output_format or ('csv' if args.output == '-' else detect_format(args.output))
+    in_stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8-sig', newline='')
+    out_stream = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+    try:
+        stats = asyncio.run(_run_cli(in_stream, out_stream, in_fmt, out_fmt, args.concurrency))
+    except ValueError as e:
+        print(f"Ошибка: не удалось прочитать {args.input}: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if in_stream is not sys.stdin:
+            in_stream.close()
+        if out_stream is not sys.stdout:
+            out_stream.close()
+    print(f"Строк: {stats['rows']}, ошибок: {stats['errors']}, геокодировано: {stats['geocoded']}, "
+          f"новых расстояний: {stats['routed']}", file=sys.stderr)
+    return 0 if stats['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Микробенчмарк: поиск ближайшей точки выхода циклом haversine и векторно.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_haversine --points 5000 --exits 8
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from delivery_core import get_reference_data
+from geo import haversine, nearest_many
+
+
+def nearest_loop(lats, lons, exit_points):
+    """Тот же цикл, что в исходной find_nearest_exit_point."""
+    result = []
+    for dest_lat, dest_lon in zip(lats, lons):
+        min_dist = float('inf')
+        nearest_exit = None
+        for i, exit_point in enumerate(exit_points):
+            dist = haversine(dest_lat, dest_lon, exit_point[1], exit_point[0])
+            if dist < min_dist:
+                min_dist = dist
+                nearest_exit = i
+        result.append((nearest_exit, min_dist))
+    return result
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--points', type=int, default=5000, help="Число пунктов назначения")
+    parser.add_argument('--exits', type=int, default=0, help="Число точек выхода (0 — из routes.json)")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(42)
+    exit_points = get_reference_data().exit_points
+    if args.exits:
+        exit_points = [[rng.uniform(35.6, 36.2), rng.uniform(56.7, 57.0)] for _ in range(args.exits)]
+    lats = [rng.uniform(56.0, 57.8) for _ in range(args.points)]
+    lons = [rng.uniform(34.0, 37.5) for _ in range(args.points)]
+    exit_lats = np.array([p[1] for p in exit_points])
+    exit_lons = np.array([p[0] for p in exit_points])
+    lat_array, lon_array = np.array(lats), np.array(lons)
+
+    loop_time, loop_result = best_of(lambda: nearest_loop(lats, lons, exit_points), args.repeat)
+    vec_time, (nearest, distances) = best_of(lambda: nearest_many(lat_array, lon_array, exit_lats, exit_lons), args.repeat)
+
+    mismatched = sum(1 for (i, d), j, v in zip(loop_result, nearest, distances) if i != j or abs(d - v) > 1e-9)
+    print(f"Пунктов: {args.points}, точек выхода: {len(exit_points)}")
+    print(f"Цикл haversine:  {loop_time * 1e3:9.2f} мс ({loop_time / args.points * 1e6:.2f} мкс/пункт)")
+    print(f"Векторно (NumPy): {vec_time * 1e3:9.2f} мс ({vec_time / args.points * 1e6:.2f} мкс/пункт)")
+    print(f"Ускорение: {loop_time / vec_time:.1f}×, расхождений: {mismatched}")
+    return 0 if mismatched == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,209 @@
+"""
+Бенчмарки этапов расчёта: геометрия, точки выхода, населённые пункты, рейсы,
+кэш, calculate_delivery_cost целиком (ORS — локальная заглушка) и план
+общих поездок.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_pipeline -o bench.json
+    python -m benchmarks.bench_pipeline --compare bench.json --threshold 0.2
+    python -m benchmarks.bench_pipeline -k cache
+С --compare код возврата 1, если медиана какого-то бенчмарка выросла больше порога.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import tempfile
+from datetime import date
+
+from benchmarks import harness
+from benchmarks.mock_services import start_mock_services, use_mock_services
+from benchmarks.workload import Workload
+from cache_store import MemoryCache, SqliteCacheStore, load_cache, save_cache
+from geo import geojson_rings
+from http_client import close_client
+from trip_planner import plan_group, straight_matrix
+from delivery_core import (
+    calculate_delivery_cost,
+    check_route_match,
+    extract_locality,
+    find_nearest_exit_point,
+    get_locality_resolver,
+    get_reference_data,
+    get_route_calendar,
+    is_inside_tver,
+    parse_coordinates,
+    point_in_polygon,
+)
+
+
+def _cycle(values):
+    return itertools.cycle(values).__next__
+
+
+def geometry_benchmarks(rng):
+    # Исходный ray casting по самому большому кольцу — для сравнения с PreparedPolygon
+    ring = max(geojson_rings(get_reference_data().tver_geojson), key=len)
+    points = _cycle([(rng.uniform(56.7, 57.0), rng.uniform(35.6, 36.2)) for _ in range(1000)])
+
+    def raw_polygon():
+        lat, lon = points()
+        point_in_polygon((lon, lat), ring)
+
+    def prepared_polygon():
+        is_inside_tver(*points())
+
+    def nearest_exit():
+        find_nearest_exit_point(*points())
+
+    return {
+        'geometry.point_in_polygon': raw_polygon,
+        'geometry.is_inside_tver': prepared_polygon,
+        'geometry.find_nearest_exit_point': nearest_exit,
+    }
+
+
+def locality_benchmarks(rng, workload):
+    addresses = [order['address'] for order in workload.orders(2000) if not parse_coordinates(order['address'])]
+    localities = [extract_locality(address) for address in addresses]
+    next_address = _cycle(addresses)
+    next_locality = _cycle(localities)
+    next_date = _cycle([date(2025, 1, 6 + i) for i in range(7)])
+    resolver = get_locality_resolver()
+
+    def extract_warm():
+        extract_locality(next_address())
+
+    def extract_cold():
+        resolver.memo.clear()
+        extract_locality(next_address())
+
+    def route_match():
+        check_route_match(next_locality(), next_date())
+
+    calendar = get_route_calendar()
+
+    def next_route_days():
+        calendar.next_route_days(next_locality(), next_date(), 3)
+
+    return {
+        'locality.extract_locality': extract_warm,
+        'locality.extract_locality_cold': extract_cold,
+        'routes.check_route_match': route_match,
+        'routes.next_route_days[3]': next_route_days,
+    }
+
+
+def cache_benchmarks(rng, tmpdir, size=2000):
+    entries = {f'деревня Пункт-{i}': {'distance': round(rng.uniform(5, 300), 3), 'exit_point': [35.9, 56.8]}
+               for i in range(size)}
+    keys = list(entries)
+    json_path = os.path.join(tmpdir, 'cache.json')
+    save_cache(entries, json_path)
+    sqlite_store = SqliteCacheStore(os.path.join(tmpdir, 'bench.sqlite3'), import_from=None)
+    for key, entry in entries.items():
+        sqlite_store.set(key, entry)
+    memory_store = MemoryCache(sqlite_store, max_entries=size * 2)
+    next_key = _cycle(rng.sample(keys, len(keys)))
+    counter = itertools.count()
+
+    return {
+        f'cache.load_json[{size}]': lambda: load_cache(json_path),
+        f'cache.save_json[{size}]': lambda: save_cache(entries, json_path),
+        'cache.sqlite_get': lambda: sqlite_store.get(next_key()),
+        'cache.sqlite_set': lambda: sqlite_store.set(f'запись-{next(counter) % 500}', {'distance': 1.0}),
+        'cache.memory_get': lambda: memory_store.get(next_key()),
+    }
+
+
+def trip_benchmarks(rng, stops=300):
+    # Матрица по прямой: замеряется эвристика (ближайший сосед, 2-opt, разбиение), а не ORS
+    exit_point = get_reference_data().exit_points[0]
+    points = [exit_point] + [[exit_point[0] + rng.uniform(-1.2, 0.4), exit_point[1] + rng.uniform(-0.6, 0.6)]
+                             for _ in range(stops)]
+    dist = straight_matrix(points)
+    return {
+        f'trips.straight_matrix[{stops}]': lambda: straight_matrix(points),
+        f'trips.plan_group[{stops}]': lambda: plan_group(dist),
+    }
+
+
+def quote_benchmarks(rng, loop, tmpdir):
+    store = MemoryCache(SqliteCacheStore(os.path.join(tmpdir, 'quotes.sqlite3'), import_from=None))
+    reference = get_reference_data()
+    stop = next(stop for day_routes in reference.route_groups.values()
+                for stops in day_routes.values() for stop in stops if stop.get('coords'))
+    lon, lat = stop['coords']
+    address = f"Тверская обл., {stop['name']}, д. 1"
+    locality = extract_locality(address)
+    today = date.today()
+
+    def run(dest_lat, dest_lon, text, key=None):
+        if key is not None:
+            store.delete(key)
+        return loop.run_until_complete(calculate_delivery_cost(
+            'средний', dest_lat, dest_lon, text, 'mock', today, store=store, zone_grid=False))
+
+    coordinates = _cycle([(rng.uniform(56.3, 57.5), rng.uniform(34.8, 37.0)) for _ in range(500)])
+
+    def coordinates_miss():
+        point = coordinates()
+        text = f'Координаты {point[0]:.5f}, {point[1]:.5f}'
+        run(*point, text, key=text)
+
+    return {
+        'quote.city': lambda: run(56.8587, 35.9176, 'Тверь, ул. Советская, 10'),
+        'quote.cache_hit': lambda: run(lat, lon, address),
+        'quote.ors_miss': lambda: run(lat, lon, address, key=locality),
+        'quote.coordinates_miss': coordinates_miss,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки этапов расчёта стоимости")
+    parser.add_argument('-k', '--filter', default='', help="Только бенчмарки, в имени которых есть подстрока")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.5, help="Минимальное суммарное время замеров, с")
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка заглушки ORS, с")
+    parser.add_argument('-o', '--output', help="Сохранить результаты в JSON")
+    parser.add_argument('--compare', help="JSON прошлого прогона для поиска регрессий")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Допустимый рост медианы (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(42)
+    workload = Workload(seed=42)
+    loop = asyncio.new_event_loop()
+    with tempfile.TemporaryDirectory(prefix='bench-') as tmpdir:
+        _, runner, base_url = loop.run_until_complete(start_mock_services(latency=args.latency))
+        use_mock_services(base_url)
+        try:
+            benchmarks = {
+                **geometry_benchmarks(rng),
+                **locality_benchmarks(rng, workload),
+                **cache_benchmarks(rng, tmpdir),
+                **quote_benchmarks(rng, loop, tmpdir),
+                **trip_benchmarks(rng),
+            }
+            benchmarks = {name: func for name, func in benchmarks.items() if args.filter in name}
+            results = harness.run(benchmarks, repeat=args.repeat, min_time=args.min_time)
+        finally:
+            loop.run_until_complete(close_client())
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
+
+    if args.output:
+        harness.save(results, args.output)
+    if args.compare:
+        regressions = harness.compare(results, harness.load(args.compare), args.threshold)
+        for name, before, after, ratio in regressions:
+            print(f"РЕГРЕССИЯ {name}: {harness.format_time(before)} → {harness.format_time(after)} ({ratio:.2f}×)")
+        if regressions:
+            return 1
+        print(f"Регрессий нет (порог {args.threshold:.0%})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
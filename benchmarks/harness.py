@@ -0,0 +1,88 @@
+"""
+Минимальный раннер бенчмарков в духе asv/pytest-benchmark.
+
+Каждый бенчмарк — функция без аргументов; раннер подбирает число вызовов
+на замер (не меньше min_time секунд), делает repeat замеров и считает
+время одного вызова: min, медиану, среднее и разброс. Результаты
+сохраняются в JSON и сравниваются с прошлым прогоном (baseline): бенчмарк,
+у которого медиана выросла больше порога, считается регрессией.
+"""
+import json
+import platform
+import statistics
+import sys
+import time
+
+
+def measure(func, repeat=5, min_time=0.2, number=None):
+    """Статистика времени одного вызова func (секунды)."""
+    func()  # прогрев: ленивые справочники, соединения, мемоизация
+    if number is None:
+        # Удваиваем число вызовов, пока один замер не займёт min_time / repeat
+        number = 1
+        while number < 1 << 20:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            if time.perf_counter() - start >= min_time / repeat:
+                break
+            number *= 2
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def format_time(seconds):
+    for unit, scale in (('с', 1), ('мс', 1e-3), ('мкс', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} нс'
+
+
+def run(benchmarks, repeat=5, min_time=0.2, stream=sys.stdout):
+    """Выполнить {имя: функция}; вернуть {имя: статистика} и печатать строки по ходу."""
+    results = {}
+    for name, func in benchmarks.items():
+        results[name] = stats = measure(func, repeat=repeat, min_time=min_time)
+        print(f"{name:<40} {format_time(stats['median']):>12}  (min {format_time(stats['min'])}, "
+              f"±{format_time(stats['stdev'])}, {stats['number']}×{stats['repeat']})", file=stream)
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def save(results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold=0.2):
+    """Список (имя, было, стало, отношение) для бенчмарков, чья медиана выросла больше чем на threshold."""
+    regressions = []
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if not before or not before.get('median'):
+            continue
+        ratio = stats['median'] / before['median']
+        if ratio > 1 + threshold:
+            regressions.append((name, before['median'], stats['median'], ratio))
+    return regressions
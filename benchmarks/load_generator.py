@@ -0,0 +1,266 @@
+"""
+Нагрузочный прогон расчёта стоимости: поток реалистичных заказов
+(benchmarks.workload) с задержками Яндекса и ORS от локальных заглушек.
+
+Цели:
+    core — BatchPricer.price_row в этом процессе (как одна строка /quote без HTTP);
+    api  — api_server в этом процессе, запросы POST /quote по HTTP;
+    --url URL — уже запущенный API (заглушки для него запускаются отдельно,
+                см. benchmarks.mock_services).
+Кэши расстояний и геокодирования — временные и пустые в начале прогона
+(--warm-cache — импортировать cache.json), так что видно и прогрев, и
+установившийся режим. Отчёт — p50/p95/p99 и пропускная способность, общие
+и по типам адресов и источникам расчёта.
+
+Примеры:
+    python -m benchmarks.load_generator --requests 5000 --concurrency 32 --latency 0.08 --jitter 0.05
+    python -m benchmarks.load_generator --target api --rate 200 --duration 30 --json load.json
+    python -m benchmarks.load_generator --url http://127.0.0.1:8080 --token ... --max-p95 300
+С --max-p95/--max-p99 код возврата 1, если перцентиль превысил порог (мс).
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+from batch_quote import BatchPricer
+from benchmarks.mock_services import start_mock_services, use_mock_services
+from benchmarks.workload import DEFAULT_MIX, Workload
+from cache_store import CACHE_FILE, MemoryCache, SqliteCacheStore
+from http_client import close_client
+
+
+def percentile(sorted_values, q):
+    """Перцентиль q (0–100) по отсортированному списку, ближайший ранг."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1e3,
+        'p95_ms': percentile(values, 95) * 1e3,
+        'p99_ms': percentile(values, 99) * 1e3,
+        'max_ms': values[-1] * 1e3,
+        'mean_ms': sum(values) / len(values) * 1e3,
+    }
+
+
+class LoadRecorder:
+    """Задержки и исходы запросов прогона."""
+
+    def __init__(self):
+        self.latencies = []
+        self.by_kind = defaultdict(list)
+        self.by_source = defaultdict(list)
+        self.errors = Counter()
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, order, latency, source=None, error=None):
+        self.latencies.append(latency)
+        self.by_kind[order['kind']].append(latency)
+        self.by_source[source or 'ошибка'].append(latency)
+        if error:
+            self.errors[str(error)[:80]] += 1
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        return {
+            'requests': len(self.latencies),
+            'errors': sum(self.errors.values()),
+            'elapsed_s': elapsed,
+            'throughput_rps': len(self.latencies) / elapsed if elapsed else None,
+            'latency': latency_summary(self.latencies),
+            'by_kind': {kind: latency_summary(v) for kind, v in sorted(self.by_kind.items())},
+            'by_source': {source: latency_summary(v) for source, v in sorted(self.by_source.items())},
+            'top_errors': self.errors.most_common(5),
+        }
+
+
+# ----------------------------
+# Цели нагрузки
+# ----------------------------
+def core_target(store, api_key='mock', routing_api_key='mock'):
+    """Расчёт одного заказа в процессе; как /quote, новый BatchPricer на запрос."""
+    async def send(order):
+        result = await BatchPricer(api_key, routing_api_key, store=store).price_row(order)
+        return result.get('source'), result.get('error')
+    return send
+
+
+def http_target(session, url, token=None):
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+
+    async def send(order):
+        payload = {k: v for k, v in order.items() if k != 'kind'}
+        async with session.post(f'{url}/quote', json=payload, headers=headers) as response:
+            data = await response.json(content_type=None)
+        if response.status != 200:
+            return None, (data or {}).get('error') or f'HTTP {response.status}'
+        return data.get('source'), None
+    return send
+
+
+async def drive(send, workload, recorder, requests, duration, concurrency, rate):
+    """
+    Прогнать заказы через send.
+
+    Без rate — замкнутый цикл из concurrency воркеров. С rate — открытая
+    модель: заказ i отправляется в момент start + i / rate, а задержка
+    считается от запланированного момента, чтобы очередь не пряталась
+    (coordinated omission).
+    """
+    deadline = recorder.started + duration if duration else None
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(order, scheduled):
+        async with semaphore:
+            try:
+                source, error = await send(order)
+            except Exception as e:
+                source, error = None, f'{type(e).__name__}: {e}'
+        recorder.record(order, time.perf_counter() - scheduled, source, error)
+
+    def more(sent):
+        return (not requests or sent < requests) and (not deadline or time.perf_counter() < deadline)
+
+    sent = 0
+    if rate:
+        tasks = []
+        while more(sent):
+            scheduled = recorder.started + sent / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(one(workload.order(), scheduled)))
+            sent += 1
+        await asyncio.gather(*tasks)
+    else:
+        async def worker():
+            nonlocal sent
+            while more(sent):
+                sent += 1
+                await one(workload.order(), time.perf_counter())
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    recorder.finished = time.perf_counter()
+
+
+async def run_load(args):
+    workload = Workload(seed=args.seed, zipf=args.zipf)
+    recorder = LoadRecorder()
+    services = runner = api_runner = None
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+        try:
+            if args.url:
+                send = http_target(session, args.url.rstrip('/'), args.token)
+            else:
+                services, runner, base_url = await start_mock_services(
+                    latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+                use_mock_services(base_url, keep_limits=args.real_limits)
+                store = MemoryCache(SqliteCacheStore(os.path.join(args.tmpdir, 'cache.sqlite3'),
+                                                     import_from=CACHE_FILE if args.warm_cache else None))
+                if args.target == 'api':
+                    from aiohttp import web
+
+                    from api_server import create_app
+
+                    api_runner = web.AppRunner(create_app('mock', 'mock', store=store), access_log=None)
+                    await api_runner.setup()
+                    site = web.TCPSite(api_runner, '127.0.0.1', 0)
+                    await site.start()
+                    port = site._server.sockets[0].getsockname()[1]
+                    send = http_target(session, f'http://127.0.0.1:{port}')
+                else:
+                    send = core_target(store)
+            recorder.started = time.perf_counter()
+            await drive(send, workload, recorder, args.requests, args.duration, args.concurrency, args.rate)
+        finally:
+            if api_runner is not None:
+                await api_runner.cleanup()
+            await close_client()
+            if runner is not None:
+                await runner.cleanup()
+    report = recorder.report()
+    report['upstream'] = dict(services.counters) if services else None
+    return report
+
+
+def print_report(report, stream=sys.stdout):
+    def line(title, s):
+        if not s.get('count'):
+            return
+        print(f"  {title:<22} {s['count']:>7}  p50 {s['p50_ms']:8.1f}  p95 {s['p95_ms']:8.1f}  "
+              f"p99 {s['p99_ms']:8.1f}  max {s['max_ms']:8.1f} мс", file=stream)
+
+    print(f"Запросов: {report['requests']}, ошибок: {report['errors']}, за {report['elapsed_s']:.1f} с, "
+          f"{report['throughput_rps']:.1f} запросов/с", file=stream)
+    line('всего', report['latency'])
+    print("По типам адресов:", file=stream)
+    for kind, s in report['by_kind'].items():
+        line(kind, s)
+    print("По источникам:", file=stream)
+    for source, s in report['by_source'].items():
+        line(source, s)
+    if report['upstream']:
+        print("Запросов к заглушкам: " + ', '.join(f'{k} {v}' for k, v in report['upstream'].items()), file=stream)
+    for message, count in report['top_errors']:
+        print(f"  {count:>6} × {message}", file=stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон расчёта стоимости")
+    parser.add_argument('--target', choices=['core', 'api'], default='core')
+    parser.add_argument('--url', help="Адрес запущенного API вместо цели в процессе")
+    parser.add_argument('--token', default=os.environ.get('API_TOKEN'), help="API_TOKEN для --url")
+    parser.add_argument('--requests', type=int, default=2000, help="Число заказов (0 — без ограничения)")
+    parser.add_argument('--duration', type=float, default=0, help="Длительность, с (0 — без ограничения)")
+    parser.add_argument('--concurrency', type=int, default=16, help="Одновременных запросов")
+    parser.add_argument('--rate', type=float, default=0, help="Открытая модель: заказов в секунду")
+    parser.add_argument('--latency', type=float, default=0.05, help="Задержка заглушек, с")
+    parser.add_argument('--jitter', type=float, default=0.03, help="Случайная добавка к задержке, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 503 от заглушек")
+    parser.add_argument('--real-limits', action='store_true', help="Оставить боевые квоты ORS/Яндекса")
+    parser.add_argument('--warm-cache', action='store_true', help="Начать с cache.json, а не с пустого кэша")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--zipf', type=float, default=1.1, help="Показатель популярности населённых пунктов")
+    parser.add_argument('--json', help="Сохранить отчёт в JSON")
+    parser.add_argument('--max-p95', type=float, help="Порог p95, мс")
+    parser.add_argument('--max-p99', type=float, help="Порог p99, мс")
+    args = parser.parse_args(argv)
+    if not args.requests and not args.duration:
+        parser.error("нужен --requests или --duration")
+
+    print(f"Цель: {args.url or args.target}, смесь адресов: "
+          + ', '.join(f'{k} {v:.0%}' for k, v in DEFAULT_MIX.items()))
+    with tempfile.TemporaryDirectory(prefix='load-') as args.tmpdir:
+        # Кэш геокодирования процесса создаётся лениво — направляем его во временную базу
+        os.environ['GEOCODE_CACHE_DB'] = os.path.join(args.tmpdir, 'geocode.sqlite3')
+        report = asyncio.run(run_load(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    latency = report['latency']
+    failed = [f"p{q} {latency[f'p{q}_ms']:.1f} мс > {limit} мс"
+              for q, limit in ((95, args.max_p95), (99, args.max_p99)) if limit and latency.get(f'p{q}_ms', 0) > limit]
+    for message in failed:
+        print(f"ПРЕВЫШЕН ПОРОГ: {message}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
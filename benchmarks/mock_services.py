@@ -0,0 +1,180 @@
+"""
+Локальные заглушки Яндекс Геокодера и ORS для бенчмарков и нагрузочных прогонов.
+
+Отвечают в форматах настоящих API (GET /1.x/, POST /v2/directions/driving-car,
+POST /v2/matrix/driving-car) с настраиваемой задержкой, разбросом и долей
+ответов 503, так что через заглушки проходят те же лимиты, повторы и
+single-flight, что и в бою. Геокодер узнаёт населённые пункты из справочника
+(по названию в адресе), остальные адреса детерминированно раскладывает по
+области; адреса со словом «несуществующ» не находятся. Дорожное расстояние —
+расстояние по прямой × ROAD_FACTOR.
+
+Отдельный процесс (для API-сервера, запущенного с YANDEX_GEOCODER_URL и ORS_BASE_URL):
+    python -m benchmarks.mock_services --port 8090 --latency 0.08 --jitter 0.04
+    YANDEX_GEOCODER_URL=http://127.0.0.1:8090/1.x/ ORS_BASE_URL=http://127.0.0.1:8090 \\
+        API_KEY=mock ORS_API_KEY=mock python api_server.py --port 8080
+"""
+import argparse
+import asyncio
+import dataclasses
+import hashlib
+import random
+import sys
+
+from aiohttp import web
+
+from delivery_core import ROAD_FACTOR, get_reference_data, no_route_localities_point_7, no_route_localities_point_8
+from geo import haversine
+from geocode_cache import normalize_address
+from spatial_index import normalize_locality
+
+NOT_FOUND_MARKER = 'несуществующ'
+# Центр Твери для адресов «Тверь, ...»
+TVER_CENTER = (56.8587, 35.9176)
+
+
+def known_places(reference=None):
+    """{нормализованное название: (lat, lon)} остановок рейсов и пунктов без рейсов."""
+    reference = reference or get_reference_data()
+    places = {}
+    for day_routes in reference.route_groups.values():
+        for stops in day_routes.values():
+            for stop in stops:
+                if stop.get('coords'):
+                    lon, lat = stop['coords']
+                    places.setdefault(normalize_locality(stop['name']), (lat, lon))
+    for name, coords in {**no_route_localities_point_8, **no_route_localities_point_7}.items():
+        places.setdefault(normalize_locality(name), coords)
+    places.pop('', None)
+    return places
+
+
+def _spread(key, scale):
+    """Детерминированное смещение (dlat, dlon) по хэшу строки, в пределах ±scale градусов."""
+    digest = hashlib.sha1(key.encode()).digest()
+    return ((digest[0] / 255 - 0.5) * 2 * scale, (digest[1] / 255 - 0.5) * 2 * scale)
+
+
+class MockServices:
+    """Обработчики заглушек со счётчиками запросов."""
+
+    def __init__(self, places=None, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.places = places if places is not None else known_places()
+        # Длинные названия первыми: «новое завидово» раньше «завидово»
+        self.place_names = sorted(self.places, key=len, reverse=True)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.counters = {'geocode': 0, 'directions': 0, 'matrix': 0, 'errors': 0}
+
+    async def _delay(self, kind):
+        self.counters[kind] += 1
+        delay = self.latency + self.random.uniform(0, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.counters['errors'] += 1
+            raise web.HTTPServiceUnavailable(text='{"error": "mock overload"}', content_type='application/json')
+
+    def locate(self, address):
+        """(lat, lon) адреса или None для «не найден»."""
+        key = normalize_address(address)
+        if NOT_FOUND_MARKER in key:
+            return None
+        if 'тверь' in key:
+            base, scale = TVER_CENTER, 0.02
+        else:
+            text = f' {normalize_locality(address)} '
+            name = next((n for n in self.place_names if f' {n} ' in text), None)
+            base, scale = (self.places[name], 0.003) if name else ((56.9, 35.9), 0.6)
+        dlat, dlon = _spread(key, scale)
+        return base[0] + dlat, base[1] + dlon
+
+    async def geocode(self, request):
+        await self._delay('geocode')
+        coords = self.locate(request.query.get('geocode', ''))
+        members = []
+        if coords:
+            members.append({'GeoObject': {'Point': {'pos': f'{coords[1]:.6f} {coords[0]:.6f}'}}})
+        return web.json_response({'response': {'GeoObjectCollection': {'featureMember': members}}})
+
+    async def directions(self, request):
+        await self._delay('directions')
+        body = await request.json()
+        (start_lon, start_lat), (end_lon, end_lat) = body['coordinates'][:2]
+        distance = haversine(start_lat, start_lon, end_lat, end_lon) * ROAD_FACTOR
+        return web.json_response({'routes': [{'summary': {'distance': round(distance, 3)}}]})
+
+    async def matrix(self, request):
+        await self._delay('matrix')
+        body = await request.json()
+        locations = body['locations']
+        distances = [[round(haversine(locations[s][1], locations[s][0], locations[d][1], locations[d][0])
+                            * ROAD_FACTOR, 3) for d in body['destinations']] for s in body['sources']]
+        return web.json_response({'distances': distances})
+
+    async def stats(self, request):
+        return web.json_response(self.counters)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/1.x/', self.geocode)
+        app.router.add_post('/v2/directions/driving-car', self.directions)
+        app.router.add_post('/v2/matrix/driving-car', self.matrix)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+
+async def start_mock_services(host='127.0.0.1', port=0, **kwargs):
+    """
+    Запустить заглушки в текущем цикле событий.
+
+    Вернуть (MockServices, runner, base_url); остановка — await runner.cleanup().
+    port=0 — свободный порт.
+    """
+    services = MockServices(**kwargs)
+    runner = web.AppRunner(services.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return services, runner, f'http://{host}:{port}'
+
+
+def use_mock_services(base_url, keep_limits=False):
+    """
+    Направить запросы ядра и предрасчёта на заглушки по адресу base_url.
+
+    Квоты ORS (40 запросов/мин) и Яндекса снимаются, иначе замер покажет
+    token bucket, а не код; keep_limits=True оставляет боевые квоты.
+    Вызывать до первого запроса: лимиты клиент создаёт при первом обращении.
+    """
+    import delivery_core
+    import http_client
+    import precompute_distances
+
+    delivery_core.YANDEX_GEOCODER_URL = f'{base_url}/1.x/'
+    delivery_core.ORS_BASE_URL = base_url
+    precompute_distances.ORS_MATRIX_URL = f'{base_url}/v2/matrix/driving-car'
+    if not keep_limits:
+        for name in ('ors', 'ors_matrix', 'yandex'):
+            http_client.PROVIDERS[name] = dataclasses.replace(
+                http_client.PROVIDERS[name], max_concurrency=64, rate_per_sec=1e6, burst=10 ** 6)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Заглушки Яндекс Геокодера и ORS")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке 0..jitter, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 503")
+    args = parser.parse_args(argv)
+    services = MockServices(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    web.run_app(services.app(), host=args.host, port=args.port, access_log=None)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Синтетический поток заказов, похожий на реальный.
+
+Доли типов адресов подобраны по журналу заказов: больше трети — Тверь,
+примерно столько же — населённые пункты с рейсов (популярность по закону
+Ципфа: несколько деревень дают большую часть заказов, поэтому кэш
+прогревается так же, как в бою), остальное — координаты, пункты без рейсов,
+адреса с опечатками и ненаходимые адреса.
+"""
+import random
+from datetime import date, timedelta
+
+from delivery_core import get_reference_data, no_route_localities_point_7, no_route_localities_point_8
+
+# Тип адреса → доля в потоке
+DEFAULT_MIX = {
+    'tver': 0.35,
+    'route': 0.33,
+    'typo': 0.07,
+    'pinned': 0.05,
+    'coords': 0.15,
+    'unknown': 0.05,
+}
+
+TVER_STREETS = [
+    'ул. Советская', 'пр-т Чайковского', 'ул. Горького', 'Петербургское ш.', 'ул. Вагжанова',
+    'Смоленский пер.', 'ул. Орджоникидзе', 'пр-т Калинина', 'б-р Радищева', 'ул. Склизкова',
+    'Волоколамское ш.', 'ул. Хромова', 'наб. Степана Разина', 'ул. Паши Савельевой', 'Октябрьский пр-т',
+]
+DISTRICTS = ['Калининский р-н', 'Конаковский р-н', 'Рамешковский р-н', 'Торжокский р-н', 'Лихославльский р-н']
+CARGO_WEIGHTS = {'маленький': 0.6, 'средний': 0.3, 'большой': 0.1}
+
+
+def route_localities(reference=None):
+    """Названия остановок рейсов без повторов, в порядке справочника."""
+    reference = reference or get_reference_data()
+    names = {}
+    for day_routes in reference.route_groups.values():
+        for stops in day_routes.values():
+            for stop in stops:
+                names.setdefault(stop['name'], None)
+    return list(names)
+
+
+def _typo(name, rng):
+    """Одна опечатка в последнем слове названия: пропуск, замена или перестановка букв."""
+    prefix, _, word = name.rpartition(' ')
+    if len(word) < 5:
+        return name
+    i = rng.randrange(1, len(word) - 1)
+    kind = rng.randrange(3)
+    if kind == 0:
+        word = word[:i] + word[i + 1:]
+    elif kind == 1:
+        word = word[:i] + rng.choice('аеиоуыя') + word[i + 1:]
+    else:
+        word = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return f'{prefix} {word}'.strip()
+
+
+class Workload:
+    """Генератор заказов (словари с полями INPUT_FIELDS batch_quote)."""
+
+    def __init__(self, seed=42, mix=None, zipf=1.1, start_date=None):
+        self.rng = random.Random(seed)
+        self.mix = mix or DEFAULT_MIX
+        self.localities = route_localities()
+        self.pinned = list(no_route_localities_point_8) + list(no_route_localities_point_7)
+        # Веса Ципфа по случайной перестановке, чтобы популярными были не первые по справочнику
+        order = self.localities[:]
+        self.rng.shuffle(order)
+        self.localities = order
+        self.weights = [1 / (rank + 1) ** zipf for rank in range(len(order))]
+        self.start_date = start_date or date.today()
+        self.kinds = list(self.mix)
+        self.kind_weights = [self.mix[k] for k in self.kinds]
+
+    def _locality(self):
+        return self.rng.choices(self.localities, self.weights)[0]
+
+    def address(self, kind):
+        rng = self.rng
+        if kind == 'tver':
+            return f'Тверь, {rng.choice(TVER_STREETS)}, {rng.randint(1, 120)}'
+        if kind == 'route':
+            return f'Тверская обл., {rng.choice(DISTRICTS)}, {self._locality()}, д. {rng.randint(1, 60)}'
+        if kind == 'typo':
+            return f'Тверская обл., {_typo(self._locality(), rng)}, д. {rng.randint(1, 60)}'
+        if kind == 'pinned':
+            return f'Тверская обл., Калининский р-н, {rng.choice(self.pinned)}, д. {rng.randint(1, 30)}'
+        if kind == 'coords':
+            return f'{rng.uniform(56.3, 57.5):.5f}, {rng.uniform(34.8, 37.0):.5f}'
+        return f'Тверская обл., деревня Несуществующая-{rng.randint(1, 10 ** 6)}'
+
+    def order(self):
+        kind = self.rng.choices(self.kinds, self.kind_weights)[0]
+        delivery_date = self.start_date + timedelta(days=self.rng.randrange(14))
+        return {
+            'kind': kind,
+            'address': self.address(kind),
+            'cargo_size': self.rng.choices(list(CARGO_WEIGHTS), list(CARGO_WEIGHTS.values()))[0],
+            'delivery_date': delivery_date.isoformat(),
+            'use_route': '1' if self.rng.random() < 0.5 else '0',
+        }
+
+    def orders(self, count):
+        return [self.order() for _ in range(count)]
@@ -0,0 +1,247 @@
+"""
+Фоновое обновление записей кэша расстояний (stale-while-revalidate).
+
+Расчёт всегда сразу берёт расстояние из кэша. Если запись устарела —
+посчитана по прямой (ORS был недоступен или не настроен), от других точек
+выхода, старше CACHE_MAX_AGE_DAYS или записана в прежнем формате без
+источника, — для пункта в фоне запрашивается ORS, и при успехе запись
+заменяется. Фоновые запросы делят квоту ORS с расчётами, поэтому их
+немного: не больше CACHE_REFRESH_MAX_PENDING одновременно, не чаще раза в
+CACHE_REFRESH_INTERVAL секунд, а после ошибки ORS пункт не трогается
+CACHE_REFRESH_RETRY секунд.
+
+Обойти весь кэш (например, по cron после сбоя ORS):
+    ORS_API_KEY=... python cache_refresh.py --limit 200
+    python cache_refresh.py --dry-run       # только список устаревших записей
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from delivery_core import (
+    COORDINATES_PREFIX,
+    distance_entry,
+    find_nearest_exit_point,
+    get_cache_store,
+    get_reference_data,
+    get_road_distance_ors,
+    parse_coordinates,
+    stale_reason,
+)
+from http_client import close_client
+from metrics import count, timed
+from precompute_distances import known_localities, locality_points, shared_bare_names
+from spatial_index import bare_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE_DAYS = 180
+
+
+def refresh_exit_point(entry, reason, nearest_exit, exit_points):
+    """Точка выхода для пересчёта: прежняя, если она ещё есть в справочнике, иначе ближайшая сейчас."""
+    exit_point = entry.get('exit_point')
+    if reason != 'exit_points' and exit_point in exit_points:
+        return exit_point
+    return nearest_exit
+
+
+class CacheRefresher:
+    """Пересчёт устаревших записей в фоне: не больше max_pending сразу и не чаще раза в min_interval секунд."""
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE_DAYS * 86400, max_pending=2, min_interval=6.0, retry_after=600.0):
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.min_interval = min_interval
+        self.retry_after = retry_after
+        self.pending = {}
+        self.retry_at = {}
+        self.next_start = 0.0
+        self.lock = threading.Lock()
+        self.counters = {'stale_hits': 0, 'started': 0, 'upgraded': 0, 'errors': 0, 'deferred': 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(max_age=float(os.environ.get('CACHE_MAX_AGE_DAYS', DEFAULT_MAX_AGE_DAYS)) * 86400,
+                   max_pending=int(os.environ.get('CACHE_REFRESH_MAX_PENDING', 2)),
+                   min_interval=float(os.environ.get('CACHE_REFRESH_INTERVAL', 6)),
+                   retry_after=float(os.environ.get('CACHE_REFRESH_RETRY', 600)))
+
+    def check(self, store, locality, entry, nearest_exit, dest_lat, dest_lon, routing_api_key):
+        """
+        Проверить запись, отданную из кэша, и при необходимости запустить пересчёт.
+
+        Вызывается внутри цикла событий; задача пересчёта создаётся в нём же и
+        не задерживает текущий расчёт. Вернуть причину устаревания или None.
+        """
+        reference = get_reference_data()
+        reason = stale_reason(entry, reference.exit_version, self.max_age)
+        if reason is None or nearest_exit is None:
+            return reason
+        now = time.monotonic()
+        with self.lock:
+            self.counters['stale_hits'] += 1
+            if locality in self.pending or now < self.retry_at.get(locality, 0):
+                return reason
+            if len(self.pending) >= self.max_pending or now < self.next_start:
+                # Пункт запросят снова при следующем попадании в кэш
+                self.counters['deferred'] += 1
+                return reason
+            self.next_start = now + self.min_interval
+            self.counters['started'] += 1
+            exit_point = refresh_exit_point(entry, reason, nearest_exit, reference.exit_points)
+            task = asyncio.get_running_loop().create_task(
+                self.refresh(store, locality, exit_point, dest_lat, dest_lon, routing_api_key, reason))
+            self.pending[locality] = task
+        task.add_done_callback(lambda _: self._done(locality))
+        return reason
+
+    def _done(self, locality):
+        with self.lock:
+            self.pending.pop(locality, None)
+
+    async def refresh(self, store, locality, exit_point, dest_lat, dest_lon, routing_api_key, reason):
+        """Пересчитать запись через ORS и заменить её. Вернуть исход: 'upgraded', 'skipped' или 'error'."""
+        try:
+            with timed('cache_refresh'):
+                road_distance = await get_road_distance_ors(exit_point[0], exit_point[1], dest_lon, dest_lat,
+                                                            routing_api_key)
+            exit_version = get_reference_data().exit_version
+            # Пока ждали ORS, запись мог обновить другой процесс или предрасчёт
+            current = store.get(locality)
+            if current and stale_reason(current, exit_version, self.max_age) is None:
+                count('delivery_cache_refresh_total', reason=reason, result='skipped')
+                return 'skipped'
+            entry = distance_entry(road_distance * 2, exit_point, 'ors', (dest_lon, dest_lat))
+            store.set(locality, entry)
+        except Exception as e:
+            with self.lock:
+                self.retry_at[locality] = time.monotonic() + self.retry_after
+                self.counters['errors'] += 1
+            count('delivery_cache_refresh_total', reason=reason, result='error')
+            logger.info(f"Запись кэша «{locality}» не обновлена: {e}")
+            return 'error'
+        with self.lock:
+            self.retry_at.pop(locality, None)
+            self.counters['upgraded'] += 1
+        count('delivery_cache_refresh_total', reason=reason, result='upgraded')
+        logger.info(f"Запись кэша «{locality}» обновлена ({reason}): {entry['distance']:.2f} км")
+        return 'upgraded'
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'pending': len(self.pending), 'backoff': len(self.retry_at)}
+
+
+# ----------------------------
+# Обход всего кэша
+# ----------------------------
+def known_coordinates(reference=None):
+    """
+    {ключ кэша: (lon, lat)} известных населённых пунктов, включая короткие
+    названия, если они не общие для нескольких пунктов.
+    """
+    reference = reference or get_reference_data()
+    shared = shared_bare_names(locality_points(reference))
+    coords = {}
+    for name, point in known_localities(reference).items():
+        coords.setdefault(name, point)
+        if bare_name(name) not in shared:
+            coords.setdefault(bare_name(name), point)
+    return coords
+
+
+def entry_coordinates(key, entry, known):
+    """(lon, lat) пункта записи: из самой записи, из ключа «Координаты …» или из справочника."""
+    if entry.get('dest'):
+        return tuple(entry['dest'])
+    if key.startswith(COORDINATES_PREFIX):
+        coords = parse_coordinates(key[len(COORDINATES_PREFIX):])
+        if coords:
+            return coords[1], coords[0]
+    return known.get(key)
+
+
+def find_stale(store, max_age=None, now=None):
+    """[(ключ, запись, причина)] устаревших записей хранилища."""
+    exit_version = get_reference_data().exit_version
+    stale = []
+    for key, entry in store.to_dict().items():
+        reason = stale_reason(entry, exit_version, max_age, now)
+        if reason:
+            stale.append((key, entry, reason))
+    return stale
+
+
+async def refresh_all(store, routing_api_key, stale, concurrency=4):
+    """
+    Пересчитать записи из find_stale через ORS.
+
+    Квоту ORS соблюдает общий HTTP-клиент. Вернуть Counter исходов:
+    upgraded, skipped, error, no_coordinates.
+    """
+    reference = get_reference_data()
+    known = known_coordinates(reference)
+    refresher = CacheRefresher()
+    semaphore = asyncio.Semaphore(concurrency)
+    outcomes = Counter()
+
+    async def one(key, entry, reason):
+        coords = entry_coordinates(key, entry, known)
+        if coords is None:
+            outcomes['no_coordinates'] += 1
+            return
+        lon, lat = coords
+        nearest_exit, _ = find_nearest_exit_point(lat, lon, key)
+        exit_point = refresh_exit_point(entry, reason, nearest_exit, reference.exit_points)
+        async with semaphore:
+            outcomes[await refresher.refresh(store, key, exit_point, lat, lon, routing_api_key, reason)] += 1
+
+    await asyncio.gather(*[one(key, entry, reason) for key, entry, reason in stale])
+    return outcomes
+
+
+async def _run_cli(store, api_key, stale):
+    try:
+        return await refresh_all(store, api_key, stale)
+    finally:
+        await close_client()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пересчёт устаревших записей кэша расстояний через ORS")
+    parser.add_argument('--limit', type=int, help="Пересчитать не больше стольких записей")
+    parser.add_argument('--max-age-days', type=float,
+                        default=float(os.environ.get('CACHE_MAX_AGE_DAYS', DEFAULT_MAX_AGE_DAYS)),
+                        help="Записи старше стольких дней считаются устаревшими (0 — возраст не учитывать)")
+    parser.add_argument('--dry-run', action='store_true', help="Только показать устаревшие записи")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    store = get_cache_store()
+    stale = find_stale(store, args.max_age_days * 86400)
+    reasons = Counter(reason for _, _, reason in stale)
+    print(f"Записей: {len(store)}, устаревших: {len(stale)}"
+          + (" (" + ", ".join(f"{r} {n}" for r, n in reasons.most_common()) + ")" if stale else ""), file=sys.stderr)
+    if args.dry_run:
+        for key, entry, reason in stale:
+            print(f"{reason:<12} {key}: {entry.get('distance')} км")
+        return 0
+    api_key = os.environ.get("ORS_API_KEY")
+    if not api_key:
+        print("Ошибка: ORS_API_KEY не настроен", file=sys.stderr)
+        return 2
+    outcomes = asyncio.run(_run_cli(store, api_key, stale[:args.limit] if args.limit else stale))
+    print("Обновлено: {upgraded}, уже актуальны: {skipped}, ошибок ORS: {error}, без координат: {no_coordinates}"
+          .format(**{k: outcomes.get(k, 0) for k in ('upgraded', 'skipped', 'error', 'no_coordinates')}),
+          file=sys.stderr)
+    return 0 if not outcomes.get('error') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,538 @@
+"""
+Хранилище кэша расстояний «населённый пункт → {distance, exit_point}».
+
+По умолчанию — SQLite в режиме WAL: каждая новая запись — одна строка
+(upsert), параллельные сессии не перетирают файл друг друга. Прежний формат
+cache.json поддерживается как бэкенд (CACHE_BACKEND=json), как источник
+импорта в новую базу SQLite (один раз) и как снимок, который фоновый экспортёр
+периодически пишет на диск (и при желании отправляет в git).
+
+Кэш в памяти считает попадания по ключам и раз в несколько минут
+сбрасывает их в SQLite; при старте процесса (CACHE_WARM_UP=1) самые
+востребованные записи загружаются в память до первого расчёта.
+"""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_FILE = os.path.join(BASE_DIR, 'cache.json')
+CACHE_DB = os.path.join(BASE_DIR, 'cache.sqlite3')
+
+
+# ----------------------------
+# cache.json
+# ----------------------------
+def load_cache(cache_file=CACHE_FILE):
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Ошибка при загрузке кэша: {e}")
+            return {}
+    return {}
+
+
+def save_cache(cache, cache_file=CACHE_FILE):
+    # Пишем во временный файл и подменяем атомарно, чтобы читатели не видели половину JSON
+    directory = os.path.dirname(os.path.abspath(cache_file))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.cache-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        # mkstemp создаёт файл только для владельца; cache.json читают и другие процессы
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, cache_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# ----------------------------
+# Бэкенды
+# ----------------------------
+class JsonCacheStore:
+    """Прежнее поведение: весь кэш в одном cache.json, запись — перезапись файла."""
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return load_cache(self.path).get(key)
+
+    def set(self, key, entry):
+        with self.lock:
+            cache = load_cache(self.path)
+            cache[key] = entry
+            save_cache(cache, self.path)
+
+    def delete(self, key):
+        with self.lock:
+            cache = load_cache(self.path)
+            if cache.pop(key, None) is not None:
+                save_cache(cache, self.path)
+
+    def to_dict(self):
+        return load_cache(self.path)
+
+    def hottest(self, limit):
+        # Попадания в JSON не хранятся: первые записи файла
+        return list(load_cache(self.path).items())[:limit]
+
+    def record_hits(self, hits):
+        pass
+
+    def import_json(self, path, overwrite=False):
+        with self.lock:
+            cache = load_cache(self.path)
+            imported = {k: v for k, v in load_cache(path).items() if overwrite or k not in cache}
+            if imported:
+                cache.update(imported)
+                save_cache(cache, self.path)
+        return len(imported)
+
+    def version(self):
+        return os.path.getmtime(self.path) if os.path.exists(self.path) else 0
+
+    def change_token(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.to_dict())
+
+
+class SqliteCacheStore:
+    """Кэш в SQLite (WAL): построчные upsert, отдельное соединение на поток."""
+
+    def __init__(self, path=CACHE_DB, import_from=CACHE_FILE):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS distance_cache ('
+            ' locality TEXT PRIMARY KEY,'
+            ' data TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL,'
+            ' hits INTEGER NOT NULL DEFAULT 0)'
+        )
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(distance_cache)')}
+        if 'hits' not in columns:
+            conn.execute('ALTER TABLE distance_cache ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+        conn.commit()
+        if import_from:
+            self._import_once(import_from)
+
+    def _import_once(self, path):
+        """
+        Перенести cache.json в новую базу один раз: иначе удалённые или
+        вытесненные из базы записи возвращались бы из устаревшего JSON при
+        каждом запуске. База с записями, но без отметки (созданная до неё),
+        считается уже перенесённой.
+        """
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM cache_meta WHERE key = 'json_imported'").fetchone():
+            return
+        imported = 0
+        if conn.execute('SELECT 1 FROM distance_cache LIMIT 1').fetchone() is None:
+            imported = self.import_json(path)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('json_imported', ?)",
+                         (f'{path} {imported}',))
+        if imported:
+            logger.info(f"Импортировано записей из {path}: {imported}")
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT data FROM distance_cache WHERE locality = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, entry):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'INSERT INTO distance_cache (locality, data, updated_at) VALUES (?, ?, ?)'
+                ' ON CONFLICT(locality) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+                (key, json.dumps(entry, ensure_ascii=False), time.time()))
+        self.writes += 1
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM distance_cache WHERE locality = ?', (key,))
+        self.writes += 1
+
+    def to_dict(self):
+        rows = self._conn().execute('SELECT locality, data FROM distance_cache ORDER BY rowid').fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def hottest(self, limit):
+        """[(ключ, запись)] с наибольшим числом попаданий."""
+        rows = self._conn().execute(
+            'SELECT locality, data FROM distance_cache ORDER BY hits DESC, updated_at DESC LIMIT ?', (limit,)).fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def record_hits(self, hits):
+        """Прибавить попадания {ключ: число}; updated_at и version() не меняются, экспорт не запускается."""
+        conn = self._conn()
+        with conn:
+            conn.executemany('UPDATE distance_cache SET hits = hits + ? WHERE locality = ?',
+                             [(n, key) for key, n in hits.items()])
+
+    def import_json(self, path, overwrite=False):
+        """Перенести записи из cache.json; существующие строки не трогаются без overwrite."""
+        cache = load_cache(path)
+        if not cache:
+            return 0
+        verb = 'INSERT OR REPLACE' if overwrite else 'INSERT OR IGNORE'
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            before = conn.total_changes
+            conn.executemany(
+                f'{verb} INTO distance_cache (locality, data, updated_at) VALUES (?, ?, ?)',
+                [(k, json.dumps(v, ensure_ascii=False), now) for k, v in cache.items()])
+            changed = conn.total_changes - before
+        self.writes += changed
+        return changed
+
+    def version(self):
+        """Меняется при любой записи; по нему экспортёр понимает, что снимок устарел."""
+        return self._conn().execute('SELECT COUNT(*), MAX(updated_at) FROM distance_cache').fetchone()
+
+    def change_token(self):
+        """Дешёвая проверка изменений без запроса к базе: коммиты других процессов меняют файлы базы и WAL."""
+        token = [self.writes]
+        for path in (self.path, self.path + '-wal'):
+            try:
+                st = os.stat(path)
+                token += [st.st_mtime_ns, st.st_size]
+            except FileNotFoundError:
+                token += [None, None]
+        return tuple(token)
+
+    def __contains__(self, key):
+        return self._conn().execute('SELECT 1 FROM distance_cache WHERE locality = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM distance_cache').fetchone()[0]
+
+
+# ----------------------------
+# Кэш в памяти процесса
+# ----------------------------
+_MISSING = object()
+
+
+class MemoryCache:
+    """
+    LRU-кэш записей в памяти поверх бэкенда.
+
+    Записи читаются из бэкенда один раз и затем отдаются из памяти; не чаще
+    check_interval секунд сверяется change_token() бэкенда (mtime и размер
+    файла для JSON; mtime и размер базы и -wal плюс счётчик своих записей
+    для SQLite), и при изменении память сбрасывается. Отсутствующие ключи тоже запоминаются, чтобы повторный
+    промах не читал диск. Счётчики hits/misses показывают, сколько обращений
+    обслужено без диска. Попадания по ключам раз в hits_flush_interval
+    секунд сбрасываются в бэкенд: если кэш не помещается в память целиком,
+    при перезагрузке и прогреве в неё попадают самые востребованные записи.
+    """
+
+    def __init__(self, backend, max_entries=10000, check_interval=0.5, hits_flush_interval=300):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.complete = False
+        self.token = None
+        self.checked_at = 0.0
+        self.hits_flush_interval = hits_flush_interval
+        self.key_hits = Counter()
+        self.hits_flushed_at = time.monotonic()
+        self.lock = threading.RLock()
+        self.counters = {'hits': 0, 'misses': 0, 'backend_reads': 0, 'reloads': 0, 'evictions': 0}
+
+    def _reload(self):
+        self.entries.clear()
+        self.counters['reloads'] += 1
+        self.token = self.backend.change_token()
+        # Небольшой кэш (сотни пунктов) загружаем целиком: тогда промах не требует чтения диска
+        data = self.backend.to_dict()
+        self.complete = len(data) <= self.max_entries
+        if self.complete:
+            self.entries.update(data)
+        else:
+            self.entries.update(self.backend.hottest(self.max_entries))
+
+    def _check(self):
+        now = time.monotonic()
+        if self.token is not None and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        if self.key_hits and now - self.hits_flushed_at >= self.hits_flush_interval:
+            self.flush_hits()
+        if self.token is None or self.backend.change_token() != self.token:
+            self._reload()
+
+    def flush_hits(self):
+        """Сбросить накопленные попадания по ключам в бэкенд."""
+        with self.lock:
+            hits, self.key_hits = self.key_hits, Counter()
+            self.hits_flushed_at = time.monotonic()
+            if not hits:
+                return
+            try:
+                self.backend.record_hits(hits)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить попадания кэша: {e}")
+                return
+            # Своя запись не должна вызывать перезагрузку всего кэша
+            if self.token is not None:
+                self.token = self.backend.change_token()
+
+    def warm_up(self):
+        """Загрузить записи в память до первого расчёта (весь кэш или самые востребованные). Вернуть их число."""
+        with self.lock:
+            self._reload()
+            self.checked_at = time.monotonic()
+            return len(self.entries)
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+            self.complete = False
+
+    def get(self, key):
+        with self.lock:
+            self._check()
+            value = self.entries.get(key, _MISSING)
+            if value is _MISSING and self.complete:
+                value = None
+            if value is _MISSING:
+                self.counters['backend_reads'] += 1
+                value = self.backend.get(key)
+                self._remember(key, value)
+            elif key in self.entries:
+                self.entries.move_to_end(key)
+            if value is not None:
+                self.counters['hits'] += 1
+                self.key_hits[key] += 1
+            else:
+                self.counters['misses'] += 1
+            return value
+
+    def set(self, key, entry):
+        with self.lock:
+            self._check()
+            self.backend.set(key, entry)
+            self._remember(key, entry)
+            # Своя запись не должна вызывать перезагрузку всего кэша
+            self.token = self.backend.change_token()
+
+    def delete(self, key):
+        with self.lock:
+            self.backend.delete(key)
+            self._remember(key, None)
+            self.token = self.backend.change_token()
+
+    def invalidate(self):
+        with self.lock:
+            self.token = None
+
+    def to_dict(self):
+        return self.backend.to_dict()
+
+    def import_json(self, path, overwrite=False):
+        imported = self.backend.import_json(path, overwrite)
+        if imported:
+            self.invalidate()
+        return imported
+
+    def version(self):
+        return self.backend.version()
+
+    def change_token(self):
+        return self.backend.change_token()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            served = lookups - self.counters['backend_reads']
+            return {**self.counters, 'size': len(self.entries),
+                    'memory_ratio': served / lookups if lookups else 0.0}
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.backend)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def create_cache_store(backend=None):
+    backend = backend or os.environ.get('CACHE_BACKEND', 'sqlite')
+    if backend == 'json':
+        return JsonCacheStore(os.environ.get('CACHE_FILE', CACHE_FILE))
+    if backend == 'sqlite':
+        return SqliteCacheStore(os.environ.get('CACHE_DB', CACHE_DB), os.environ.get('CACHE_FILE', CACHE_FILE))
+    raise ValueError(f"Неизвестный бэкенд кэша: {backend}. Доступны: sqlite, json")
+
+
+def get_cache_store():
+    """Хранилище кэша процесса с LRU в памяти (создаётся при первом обращении)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = MemoryCache(create_cache_store(), int(os.environ.get('CACHE_MEMORY_MAX', 10000)))
+                if os.environ.get('CACHE_WARM_UP', '1') == '1':
+                    logger.info(f"Кэш расстояний: в памяти {store.warm_up()} записей")
+                _store = store
+    return _store
+
+
+# ----------------------------
+# Фоновый экспорт снимка
+# ----------------------------
+class CacheExporter(threading.Thread):
+    """
+    Периодически пишет снимок хранилища в cache.json, если он изменился.
+
+    on_export(path) вызывается после записи (например, git commit/push) и
+    может вернуть словарь статусов — он сохраняется в last_status; при
+    'ok': False экспорт повторяется на следующем интервале. После
+    on_export записи из cache.json (которые могли прийти с git pull)
+    догружаются в хранилище; ключи из статуса 'replaced' ({ключ: updated_at
+    заменённой записи}) перезаписываются записями из cache.json, если запись
+    в хранилище с тех пор не менялась.
+    """
+
+    def __init__(self, store, path=CACHE_FILE, interval=300, on_export=None):
+        super().__init__(name='cache-exporter', daemon=True)
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.on_export = on_export
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.exported_version = None
+        self.last_export = None
+        self.last_status = {}
+        self.last_error = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.export_once()
+
+    def export_once(self, force=False):
+        try:
+            version = self.store.version()
+            if not force and version == self.exported_version:
+                return False
+            backend = getattr(self.store, 'backend', self.store)
+            if not isinstance(backend, JsonCacheStore) or backend.path != self.path:
+                save_cache(self.store.to_dict(), self.path)
+            self.exported_version = version
+            self.last_export = time.time()
+            if self.on_export:
+                self.last_status = self.on_export(self.path) or {}
+                self.store.import_json(self.path)
+                replaced = self.last_status.get('replaced')
+                if replaced:
+                    merged = load_cache(self.path)
+                    for key, updated_at in replaced.items():
+                        current = self.store.get(key)
+                        if key in merged and current is not None and current.get('updated_at') == updated_at:
+                            self.store.set(key, merged[key])
+                # Неудачная синхронизация повторится на следующем интервале, даже если новых записей не будет
+                self.exported_version = self.store.version() if self.last_status.get('ok', True) else None
+            self.last_error = None
+            return True
+        except Exception as e:
+            self.last_error = f"Ошибка при экспорте кэша: {e}"
+            logger.warning(self.last_error)
+            return False
+
+    def request_export(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def start_exporter(interval=None, on_export=None):
+    """Запустить фоновый экспортёр процесса (повторные вызовы возвращают уже запущенный)."""
+    global _exporter
+    store = get_cache_store()
+    with _exporter_lock:
+        if _exporter is None or not _exporter.is_alive():
+            interval = interval or float(os.environ.get('CACHE_EXPORT_INTERVAL', 300))
+            _exporter = CacheExporter(store, os.environ.get('CACHE_FILE', CACHE_FILE), interval, on_export)
+            _exporter.start()
+    return _exporter
+
+
+def get_exporter():
+    return _exporter
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Обслуживание хранилища кэша расстояний")
+    parser.add_argument('command', choices=['import', 'export', 'stats'])
+    parser.add_argument('--file', default=CACHE_FILE, help="Путь к cache.json")
+    parser.add_argument('--overwrite', action='store_true', help="При импорте перезаписывать существующие записи")
+    args = parser.parse_args(argv)
+    store = get_cache_store()
+    if args.command == 'import':
+        print(f"Импортировано записей: {store.import_json(args.file, args.overwrite)}")
+    elif args.command == 'export':
+        save_cache(store.to_dict(), args.file)
+        print(f"Экспортировано записей: {len(store)} → {args.file}")
+    else:
+        print(f"Бэкенд: {type(store).__name__}, записей: {len(store)}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,608 +1,378 @@
-import math
-import requests
-import streamlit as st
-import os
-import asyncio
-import aiohttp
-import json
-import subprocess
-from datetime import date, datetime, timedelta
-from typing import Dict, List, Tuple
-
-# Установка заголовка вкладки
-st.set_page_config(page_title="Флора калькулятор (розница)", page_icon="favicon.png")
-
-# Получение параметра admin из URL
-def is_admin_mode():
-    query_params = st.query_params
-    return query_params.get("admin", "") == "1"
-
-# Центрирование логотипа
-col1, col2, col3 = st.columns([1, 2, 1])
-with col2:
-    st.image("logo.png", width=533)
-
-# Загрузка routes.json
-def load_routes():
-    cache_file = 'routes.json'
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                globals()['exit_points'] = data.get('exit_points', [])
-                globals()['route_groups'] = data.get('route_groups', {})
-                return data
-        except Exception as e:
-            st.warning(f"Ошибка при загрузке routes.json: {e}")
-            globals()['exit_points'] = []
-            globals()['route_groups'] = {}
-            return {}
-    else:
-        st.warning("Файл routes.json не найден. Используются пустые данные.")
-        globals()['exit_points'] = []
-        globals()['route_groups'] = {}
-        return {}
-load_routes()
-
-# Загрузка границ Твери из GeoJSON
-def load_tver_boundary():
-    cache_file = 'tver_boundaries.geojson'
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            st.warning(f"Ошибка при загрузке tver_boundaries.geojson: {e}")
-            return {}
-    return {}
-
-# Проверка, находится ли точка внутри полигона (алгоритм ray casting)
-def point_in_polygon(point, polygon):
-    x, y = point
-    n = len(polygon)
-    inside = False
-    p1x, p1y = polygon[0]
-    for i in range(n + 1):
-        p2x, p2y = polygon[i % n]
-        if y > min(p1y, p2y):
-            if y <= max(p1y, p2y):
-                if x <= max(p1x, p2x):
-                    if p1y != p2y:
-                        xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                    if p1x == p2x or x <= xinters:
-                        inside = not inside
-        p1x, p1y = p2x, p2y
-    return inside
-
-# Инициализация данных
-tver_geojson = load_tver_boundary()
-tver_polygon = tver_geojson['features'][0]['geometry']['coordinates'][0] if tver_geojson and tver_geojson.get('features') else []
-cargo_prices = {"маленький": 350, "средний": 500, "большой": 800}
-distance_table = {}  # Можно расширить, если есть данные
-
-# Словари населённых пунктов с привязкой к конкретным точкам выхода
-no_route_localities_point_8 = {
-    "деревня Аввакумово": (56.879706, 36.006304),
-    "деревня Аркатово": (56.890298, 36.029007),
-    "деревня Горютино": (56.891522, 36.058333),
-    "деревня Сапково": (56.887168, 36.066890),
-    "посёлок Сахарово": (56.897499, 36.049389)
-}
-
-no_route_localities_point_7 = {
-    "деревня Рябеево": (56.835279, 35.716402),
-    "деревня Красново": (56.836976, 35.667727),
-    "деревня Мотавино": (56.833959, 35.651731),
-    "деревня Прудище": (56.828384, 35.627544),
-    "деревня Спичево": (56.823067, 35.612344)
-}
-
-# Функция Haversine
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371.0
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = R * c
-    return distance
-
-# ----------------------------
-# Новая функция: парсер координат
-# ----------------------------
-def parse_coordinates(input_str: str):
-    """
-    Попробовать распарсить строку как координаты.
-    Принимает форматы:
-      - "lat, lon"
-      - "lon, lat"
-      - "lat lon" / "lon lat"
-      - с ; вместо ,
-    Вернёт (lat, lon) или None.
-    """
-    if not input_str or not isinstance(input_str, str):
-        return None
-    s = input_str.strip()
-    # Уберём лишние слова в конце/начале (если пользователь вставил "координаты: 56.8, 35.9")
-    # Но не трогаем если это обычный адрес.
-    # Попробуем найти два числа в строке.
-    for sep in [',', ';']:
-        if sep in s:
-            parts = [p.strip() for p in s.split(sep) if p.strip() != ""]
-            if len(parts) >= 2:
-                # Берём первые два компонента
-                a, b = parts[0], parts[1]
-                try:
-                    a_f = float(a)
-                    b_f = float(b)
-                    # Определим, какой из них широта (lat) — обычно в [-90,90]
-                    if -90 <= a_f <= 90 and -180 <= b_f <= 180:
-                        return a_f, b_f  # a=lat, b=lon
-                    if -90 <= b_f <= 90 and -180 <= a_f <= 180:
-                        return b_f, a_f  # b=lat, a=lon (обратный порядок)
-                except ValueError:
-                    return None
-    # Попробовать пробел в качестве разделителя (редко)
-    parts = s.split()
-    if len(parts) >= 2:
-        try:
-            a_f = float(parts[0])
-            b_f = float(parts[1])
-            if -90 <= a_f <= 90 and -180 <= b_f <= 180:
-                return a_f, b_f
-            if -90 <= b_f <= 90 and -180 <= a_f <= 180:
-                return b_f, a_f
-        except ValueError:
-            return None
-    return None
-
-# Функции для кэша
-def load_cache():
-    cache_file = 'cache.json'
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            st.warning(f"Ошибка при загрузке кэша: {e}")
-            return {}
-    return {}
-
-def save_cache(cache):
-    cache_file = 'cache.json'
-    try:
-        st.session_state.cache_before_save = cache
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
-        if os.path.exists(cache_file):
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                saved_cache = json.load(f)
-                st.session_state.cache_after_save = saved_cache
-        # Настройка Git
-        try:
-            if not os.path.exists('.git'):
-                subprocess.run(['git', 'init'], check=True, capture_output=True, text=True)
-            git_repo = os.environ.get('GIT_REPO', 'https://github.com/floratvertransport-prog/delivery-calc.git')
-            git_token = os.environ.get('GIT_TOKEN')
-            if git_token:
-                git_repo = git_repo.replace('https://', f'https://{git_token}@')
-            # Проверяем и добавляем origin
-            remote_output = subprocess.run(['git', 'remote', '-v'], capture_output=True, text=True)
-            st.session_state.git_remote_status = f"Git remote: {remote_output.stdout.replace(git_token, '******') if git_token else remote_output.stdout or 'No remotes set'}"
-            if 'origin' not in remote_output.stdout:
-                subprocess.run(['git', 'remote', 'add', 'origin', git_repo], check=True, capture_output=True, text=True)
-                st.session_state.git_remote_status = f"Git remote: added origin {git_repo.replace(git_token, '******') if git_token else git_repo}"
-            # Настраиваем Git
-            subprocess.run(['git', 'config', '--global', 'user.name', os.environ.get('GIT_USER', 'floratvertransport-prog')], check=True, capture_output=True, text=True)
-            subprocess.run(['git', 'config', '--global', 'user.email', 'floratvertransport-prog@example.com'], check=True, capture_output=True, text=True)
-            # Проверяем текущую ветку и исправляем detached HEAD
-            branch_output = subprocess.run(['git', 'branch'], capture_output=True, text=True)
-            st.session_state.git_branch_status = f"Git branch: {branch_output.stdout}"
-            if 'detached' in branch_output.stdout:
-                subprocess.run(['git', 'add', cache_file], check=True, capture_output=True, text=True)
-                subprocess.run(['git', 'commit', '-m', 'Commit cache.json before checkout'], check=True, capture_output=True, text=True)
-                subprocess.run(['git', 'fetch', 'origin'], check=True, capture_output=True, text=True)
-                subprocess.run(['git', 'checkout', '-B', 'main', 'origin/main'], check=True, capture_output=True, text=True)
-                st.session_state.git_branch_status = f"Git branch: switched to main"
-            # Синхронизируем ветку
-            try:
-                fetch_result = subprocess.run(['git', 'fetch', 'origin'], check=True, capture_output=True, text=True)
-                st.session_state.git_fetch_status = f"Git fetch: {fetch_result.stdout or 'Success'}"
-                pull_result = subprocess.run(['git', 'pull', 'origin', 'main', '--allow-unrelated-histories'], check=True, capture_output=True, text=True)
-                st.session_state.git_pull_status = f"Git pull: {pull_result.stdout or 'Success'}"
-            except subprocess.CalledProcessError as e:
-                st.session_state.git_sync_status = f"Ошибка git pull: {e}\nSTDERR: {e.stderr}"
-                return
-            # Проверяем изменения
-            status_result = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True)
-            st.session_state.git_status = f"Git status: {status_result.stdout}"
-            if cache_file in status_result.stdout:
-                subprocess.run(['git', 'add', cache_file], check=True, capture_output=True, text=True)
-                subprocess.run(['git', 'commit', '-m', 'Update cache.json'], check=True, capture_output=True, text=True)
-                try:
-                    push_result = subprocess.run(['git', 'push', 'origin', 'main'], check=True, capture_output=True, text=True)
-                    st.session_state.git_sync_status = f"Кэш успешно синхронизирован с GitHub: {push_result.stdout or 'Success'}"
-                except subprocess.CalledProcessError as e:
-                    st.session_state.git_sync_status = f"Ошибка git push: {e}\nSTDERR: {e.stderr}"
-            else:
-                st.session_state.git_sync_status = "Нет изменений в cache.json для коммита"
-        except subprocess.CalledProcessError as e:
-            st.session_state.git_sync_status = f"Ошибка синхронизации с GitHub: {e}\nSTDERR: {e.stderr}"
-    except Exception as e:
-        st.session_state.save_cache_error = f"Ошибка при сохранении кэша: {e}"
-
-# Проверка GIT_TOKEN
-def check_git_token():
-    git_token = os.environ.get('GIT_TOKEN')
-    if not git_token:
-        return "Ошибка: GIT_TOKEN не настроен в переменных окружения"
-    try:
-        response = requests.get('https://api.github.com/user', auth=('floratvertransport-prog', git_token))
-        if response.status_code == 200:
-            return f"GIT_TOKEN валиден: {response.json().get('login')}"
-        else:
-            return f"Ошибка проверки GIT_TOKEN: HTTP {response.status_code}, {response.json().get('message', 'Неизвестная ошибка')}"
-    except Exception as e:
-        return f"Ошибка проверки GIT_TOKEN: {str(e)}"
-
-# Геокодирование через Яндекс
-@st.cache_data
-def geocode_address(address, api_key):
-    url = f"https://geocode-maps.yandex.ru/1.x/?apikey={api_key}&geocode={address}&format=json"
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        try:
-            pos = data['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']['Point']['pos']
-            lon, lat = map(float, pos.split(' '))
-            return lat, lon
-        except (IndexError, KeyError):
-            raise ValueError("Адрес не найден. Уточните адрес (например, добавьте 'Тверь' или 'Тверская область').")
-    else:
-        raise ValueError(f"Ошибка API: {response.status_code}")
-
-# Получение IP сервера
-async def get_server_ip():
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get('https://api.ipify.org?format=json', timeout=5) as response:
-                if response.status == 200:
-                    ip_data = await response.json()
-                    return ip_data.get('ip', 'Не удалось получить IP')
-                else:
-                    return f"Ошибка получения IP: HTTP {response.status}"
-    except aiohttp.ClientError as e:
-        return f"Ошибка соединения при получении IP: {str(e)}"
-    except Exception as e:
-        return f"Неизвестная ошибка при получении IP: {str(e)}"
-
-# Запрос к ORS
-async def get_road_distance_ors(start_lon, start_lat, end_lon, end_lat, api_key):
-    url = "https://api.openrouteservice.org/v2/directions/driving-car"
-    headers = {
-        "Authorization": api_key,
-        "Content-Type": "application/json",
-        "Accept": "application/geo+json"
-    }
-    body = {
-        "coordinates": [[start_lon, start_lat], [end_lon, end_lat]],
-        "units": "km",
-        "radiuses": [1000, 1000]
-    }
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=body, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    distance = data["routes"][0]["summary"]["distance"]
-                    return distance
-                else:
-                    error_data = await response.json()
-                    error_code = error_data.get("error", {}).get("code", 0)
-                    error_msg = error_data.get("error", {}).get("message", "Неизвестная ошибка")
-                    if error_code == 2010:
-                        raise ValueError(f"ORS не нашёл маршрут для координат: {error_msg}. Используется Haversine.")
-                    raise ValueError(f"Ошибка ORS API: HTTP {response.status}. Код: {error_code}. Сообщение: {error_msg}")
-    except aiohttp.ClientError as e:
-        raise ValueError(f"Ошибка соединения с ORS API: {str(e)}")
-
-# Поиск ближайшей точки выхода с точной привязкой по координатам
-def find_nearest_exit_point(dest_lat, dest_lon, locality, delivery_date):
-    min_dist = float('inf')
-    nearest_exit = None
-    tolerance = 0.01  # Допуск в градусах (около 1 км)
-
-    # Проверка координат для привязки к точке 8
-    for loc, (lat, lon) in no_route_localities_point_8.items():
-        if abs(dest_lat - lat) < tolerance and abs(dest_lon - lon) < tolerance:
-            nearest_exit = exit_points[7] if len(exit_points) > 7 else None  # Точка 8 (индекс 7)
-            if nearest_exit:
-                min_dist = haversine(dest_lat, dest_lon, nearest_exit[1], nearest_exit[0])
-                return nearest_exit, min_dist
-
-    # Проверка координат для привязки к точке 7
-    for loc, (lat, lon) in no_route_localities_point_7.items():
-        if abs(dest_lat - lat) < tolerance and abs(dest_lon - lon) < tolerance:
-            nearest_exit = exit_points[6] if len(exit_points) > 6 else None  # Точка 7 (индекс 6)
-            if nearest_exit:
-                min_dist = haversine(dest_lat, dest_lon, nearest_exit[1], nearest_exit[0])
-                return nearest_exit, min_dist
-
-    # Если нет точного соответствия, ищем ближайшую точку
-    if exit_points:
-        for exit_point in exit_points:
-            dist = haversine(dest_lat, dest_lon, exit_point[1], exit_point[0])
-            if dist < min_dist:
-                min_dist = dist
-                nearest_exit = exit_point
-    return nearest_exit, min_dist
-
-# Извлечение населённого пункта с точным соответствием
-def extract_locality(address):
-    known_localities = {**no_route_localities_point_8, **no_route_localities_point_7}
-    if 'тверь' in address.lower():
-        return 'Тверь'
-    if 'завидово' in address.lower() and not 'новозавидовский' in address.lower():
-        return 'село Завидово'
-    if 'новозавидовский' in address.lower():
-        return 'посёлок городского типа Новозавидовский'
-    cache = load_cache()
-    for locality, (lat, lon) in known_localities.items():
-        if locality.lower() in address.lower():
-            return locality
-    parts = address.split(',')
-    for part in parts:
-        part = part.strip()
-        if part and 'область' not in part.lower() and 'ул.' not in part.lower() and 'г.' not in part.lower():
-            return part
-    return None
-
-# Проверка соответствия рейсу
-def check_route_match(locality, delivery_date):
-    if not locality or not delivery_date or not route_groups:
-        return False
-    # Исключение для населённых пунктов без рейсов
-    if locality in no_route_localities_point_8 or locality in no_route_localities_point_7:
-        return False
-    day_of_week = delivery_date.weekday()
-    if str(day_of_week) not in route_groups:
-        return False
-    for route_name, route_locations in route_groups[str(day_of_week)].items():
-        for point in route_locations:
-            if locality.lower() in point["name"].lower():
-                return True
-    return False
-
-# Поиск ближайшего дня с оптовым рейсом
-def find_nearest_optimal_day(locality, current_date):
-    if not route_groups or not locality:
-        return None
-    days_of_week = list(route_groups.keys())
-    current_day = current_date.weekday()
-    # Словарь для перевода дней недели на русский
-    day_translation = {
-        'Monday': 'Понедельник',
-        'Tuesday': 'Вторник',
-        'Wednesday': 'Среда',
-        'Thursday': 'Четверг',
-        'Friday': 'Пятница',
-        'Saturday': 'Суббота',
-        'Sunday': 'Воскресенье'
-    }
-    for i in range(7):  # Проверяем следующую неделю
-        next_day = (current_day + i) % 7
-        if str(next_day) in route_groups:
-            for route_name, route_locations in route_groups[str(next_day)].items():
-                for point in route_locations:
-                    if locality.lower() in point["name"].lower():
-                        new_date = current_date + timedelta(days=i)
-                        english_day = new_date.strftime('%A')
-                        return day_translation.get(english_day, english_day)  # Возвращаем день на русском
-    return None
-
-# Округление стоимости
-def round_cost(cost):
-    remainder = cost % 100
-    if remainder <= 20:
-        return (cost // 100) * 100
-    else:
-        return ((cost // 100) + 1) * 100
-
-# Расчёт стоимости с учетом рейса
-async def calculate_delivery_cost(cargo_size, dest_lat, dest_lon, address, routing_api_key, delivery_date=None, use_route_rate=False):
-    with st.spinner("Производится расчёт стоимости..."):
-        if cargo_size not in cargo_prices:
-            raise ValueError("Неверный размер груза. Доступны: маленький, средний, большой")
-        base_cost = cargo_prices[cargo_size]
-        locality = extract_locality(address)
-        st.session_state.locality = locality
-        # Проверка, находится ли точка внутри границ Твери
-        if point_in_polygon((dest_lon, dest_lat), tver_polygon):
-            locality = 'Тверь'
-            total_distance = 0
-            total_cost = base_cost
-            if is_admin_mode():
-                st.write(f"DEBUG: Point ({dest_lon}, {dest_lat}) is inside Tver polygon.")
-            return total_cost, 0, None, locality, total_distance, "город", 0
-        nearest_exit, dist_to_exit = find_nearest_exit_point(dest_lat, dest_lon, locality, delivery_date)
-        rate_per_km = 15 if use_route_rate else 32
-        if locality and locality.lower() == 'тверь':
-            total_distance = 0
-            total_cost = base_cost
-            return total_cost, dist_to_exit, nearest_exit, locality, total_distance, "город", rate_per_km
-        cache = load_cache()
-        if locality and locality in cache:
-            total_distance = cache[locality]['distance']
-            extra_cost = total_distance * rate_per_km
-            total_cost = base_cost + extra_cost
-            rounded_cost = round_cost(total_cost) if total_distance > 0 else base_cost
-            return rounded_cost, dist_to_exit, nearest_exit, locality, total_distance, "кэш", rate_per_km
-        if routing_api_key and locality:
-            try:
-                road_distance = await get_road_distance_ors(nearest_exit[0], nearest_exit[1], dest_lon, dest_lat, routing_api_key)
-                total_distance = road_distance * 2
-                extra_cost = total_distance * rate_per_km
-                total_cost = base_cost + extra_cost
-                rounded_cost = round_cost(total_cost) if total_distance > 0 else base_cost
-                cache[locality] = {'distance': total_distance, 'exit_point': nearest_exit}
-                save_cache(cache)
-                return rounded_cost, dist_to_exit, nearest_exit, locality, total_distance, "ors", rate_per_km
-            except ValueError as e:
-                st.warning(f"Ошибка ORS API: {e}. Используется Haversine с коэффициентом 1.3.")
-                road_distance = dist_to_exit * 1.3
-                total_distance = road_distance * 2
-                extra_cost = total_distance * rate_per_km
-                total_cost = base_cost + extra_cost
-                rounded_cost = round_cost(total_cost) if total_distance > 0 else base_cost
-                if locality:
-                    cache[locality] = {'distance': total_distance, 'exit_point': nearest_exit}
-                    save_cache(cache)
-                return rounded_cost, dist_to_exit, nearest_exit, locality, total_distance, "haversine", rate_per_km
-        road_distance = dist_to_exit * 1.3
-        total_distance = road_distance * 2
-        extra_cost = total_distance * rate_per_km
-        total_cost = base_cost + extra_cost
-        rounded_cost = round_cost(total_cost) if total_distance > 0 else base_cost
-        if locality:
-            cache[locality] = {'distance': total_distance, 'exit_point': nearest_exit}
-            save_cache(cache)
-        return rounded_cost, dist_to_exit, nearest_exit, locality, total_distance, "haversine", rate_per_km
-
-# Streamlit UI
-st.title("Калькулятор стоимости доставки по Твери и области для розничных клиентов")
-st.write("Введите адрес доставки, выберите размер груза и дату доставки.")
-st.write("Можно вводить адрес или координаты в формате: 56.862957, 35.883402")
-api_key = os.environ.get("API_KEY")
-routing_api_key = os.environ.get("ORS_API_KEY")
-if not api_key:
-    st.error("Ошибка: API-ключ для геокодирования не настроен. Обратитесь к администратору.")
-else:
-    with st.form(key="delivery_form"):
-        cargo_size = st.selectbox("Размер груза", ["маленький", "средний", "большой"])
-        address = st.text_input("Адрес доставки (например, 'Тверь, ул. Советская, 10' или 'Тверская область, Вараксино')", value="Тверская область, ")
-        delivery_date = st.date_input("Дата доставки", value=date.today(), format="DD.MM.YYYY")
-        submit_button = st.form_submit_button(label="Рассчитать")
-
-        if is_admin_mode():
-            st.write("### Админ-режим активирован")
-            server_ip = asyncio.run(get_server_ip())
-            st.write(f"IP сервера Render: {server_ip}")
-            st.write(f"Версия Streamlit: {st.__version__}")
-            st.write(f"Версия aiohttp: {aiohttp.__version__}")
-            st.write(f"Проверка GIT_TOKEN: {check_git_token()}")
-            if 'cache_before_save' in st.session_state:
-                st.write(f"Кэш перед сохранением: {st.session_state.cache_before_save}")
-            if 'cache_after_save' in st.session_state:
-                st.write(f"Кэш после сохранением: {st.session_state.cache_after_save}")
-            if 'save_cache_error' in st.session_state:
-                st.write(f"Ошибка сохранения кэша: {st.session_state.save_cache_error}")
-            if 'git_sync_status' in st.session_state:
-                st.write(f"Статус синхронизации с GitHub: {st.session_state.git_sync_status}")
-            if 'git_fetch_status' in st.session_state:
-                st.write(f"Статус git fetch: {st.session_state.git_fetch_status}")
-            if 'git_pull_status' in st.session_state:
-                st.write(f"Статус git pull: {st.session_state.git_pull_status}")
-            if 'git_remote_status' in st.session_state:
-                st.write(st.session_state.git_remote_status)
-            if 'git_branch_status' in st.session_state:
-                st.write(st.session_state.git_branch_status)
-            if 'git_status' in st.session_state:
-                st.write(st.session_state.git_status)
-            if not routing_api_key:
-                st.warning("ORS_API_KEY не настроен. Для неизвестных адресов используется Haversine с коэффициентом 1.3.")
-            else:
-                st.success("ORS_API_KEY настроен. Расстояние будет рассчитано по реальным дорогам.")
-
-            # Сворачиваемые секции
-            with st.expander("Точки выхода из Твери"):
-                if exit_points:
-                    for i, point in enumerate(exit_points, 1):
-                        st.write(f"Точка {i}: {point}")
-                else:
-                    st.write("Данные о точках выхода отсутствуют (routes.json не загружен).")
-
-            cache = load_cache()
-            with st.expander("Текущий кэш"):
-                st.write(f"Текущий кэш: {cache}")
-
-            if cache:
-                with st.expander("Кэш расстояний"):
-                    for locality, data in cache.items():
-                        st.write(f"{locality}: {data['distance']} км (точка выхода: {data['exit_point']})")
-
-        if submit_button and address:
-            try:
-                # --- Новая логика: сначала пробуем распарсить координаты ---
-                coords = parse_coordinates(address)
-                if coords:
-                    dest_lat, dest_lon = coords
-                    # Если введено что-то ещё помимо координат, попытка извлечь locality не нужна.
-                    # Ставим понятный locality: либо Тверь (если внутри полигона), либо текст "Координаты ..."
-                    if tver_polygon and point_in_polygon((dest_lon, dest_lat), tver_polygon):
-                        locality = 'Тверь'
-                    else:
-                        locality = f"Координаты {round(dest_lat,6)},{round(dest_lon,6)}"
-                else:
-                    # Обычный путь — геокодирование через Яндекс
-                    dest_lat, dest_lon = geocode_address(address, api_key)
-                    locality = extract_locality(address)
-
-                use_route_rate = False
-                if check_route_match(locality, delivery_date):
-                    st.write("👉 Вы можете доставить этот заказ вместе с оптовыми клиентами")
-                    st.write("Доставка по рейсу вместе с оптовыми заказами")
-                    use_route = st.checkbox("Использовать доставку по рейсу")
-                    if use_route:
-                        if not st.session_state.get('route_confirmed', False):
-                            confirm = st.radio("Вы точно уверены, что возможна доставка вместе с оптовыми заказами? Время или объём позволяют осуществить доставку вместе с рейсом?", ("Нет", "Да"))
-                            if confirm == "Да":
-                                st.session_state.route_confirmed = True
-                                use_route_rate = True
-                            else:
-                                st.session_state.route_confirmed = False
-                                use_route_rate = False
-                        else:
-                            use_route_rate = True
-                    else:
-                        use_route_rate = False
-                        if 'route_confirmed' in st.session_state:
-                            del st.session_state.route_confirmed
-                else:
-                    if 'use_route' in st.session_state:
-                        del st.session_state.use_route
-                    if 'route_confirmed' in st.session_state:
-                        del st.session_state.route_confirmed
-
-                # Вызываем основной расчёт (тот же, что был)
-                result = asyncio.run(calculate_delivery_cost(cargo_size, dest_lat, dest_lon, locality if coords else address, routing_api_key, delivery_date, use_route_rate))
-                cost, dist_to_exit, nearest_exit, locality_result, total_distance, source, rate_per_km = result
-                st.success(f"Стоимость доставки: {cost} руб.")
-                # Если доставка не в пределах города и нет рейса — предложим ближайший день
-                if not (tver_polygon and point_in_polygon((dest_lon, dest_lat), tver_polygon)) and not check_route_match(locality_result, delivery_date):
-                    optimal_day = find_nearest_optimal_day(locality_result, delivery_date)
-                    if optimal_day:
-                        st.warning(f"Вы можете предложить клиенту доставить в другой день ({optimal_day}) вместе с оптовыми заказами, чтобы было дешевле. Поменяйте дату в календаре и произведите повторный расчёт стоимости.")
-                if is_admin_mode():
-                    st.write(f"Координаты адреса: lat={dest_lat}, lon={dest_lon}")
-                    st.write(f"Ближайшая точка выхода: {nearest_exit}")
-                    st.write(f"Расстояние до ближайшей точки выхода (по прямой): {dist_to_exit:.2f} км")
-                    st.write(f"Извлечённый населённый пункт: {locality_result}")
-                    st.write(f"Источник расстояния: {source}")
-                    if source == "город":
-                        st.write(f"Населённый пункт: {locality_result} (доставка в пределах Твери)")
-                        st.write(f"Километраж: {total_distance} км (без доплаты)")
-                        st.write(f"Базовая стоимость: {cost} руб. (без округления)")
-                    elif source in ["таблица", "кэш", "ors", "haversine"]:
-                        st.write(f"Населённый пункт: {locality_result}")
-                        st.write(f"Километраж (туда и обратно): {total_distance:.2f} км")
-                        st.write(f"Доплата: {total_distance:.2f} × {rate_per_km} = {total_distance * rate_per_km:.2f} руб.")
-                    st.write(f"Дата доставки: {delivery_date.strftime('%d.%m.%Y')} ({delivery_date.strftime('%A')})")
-                    st.write(f"Использован рейс: {use_route_rate}")
-            except ValueError as e:
-                st.error(f"Ошибка: {e}")
-            except Exception as e:
-                st.error(f"Ошибка при расчёте: {e}")
+import os
+import aiohttp
+import requests
+import streamlit as st
+from datetime import date, datetime
+
+import delivery_core
+from batch_quote import BatchPricer, price_bytes
+from http_client import HttpError, get_client, run_sync
+from delivery_core import (
+    calculate_delivery_cost as calculate_delivery_cost_core,
+    check_route_match,
+    coordinates_locality,
+    extract_locality,
+    geocode_address,
+    get_reference_data,
+    next_route_day,
+    parse_coordinates,
+    route_savings,
+    start_reference_watcher,
+)
+from cache_store import get_cache_store, start_exporter
+from geocode_cache import get_geocode_cache
+from git_sync import GitCacheSync
+from metrics import get_metrics, start_metrics_server, timed, trace
+
+# Установка заголовка вкладки
+st.set_page_config(page_title="Флора калькулятор (розница)", page_icon="favicon.png")
+
+# Получение параметра admin из URL
+def is_admin_mode():
+    query_params = st.query_params
+    return query_params.get("admin", "") == "1"
+
+# Центрирование логотипа
+col1, col2, col3 = st.columns([1, 2, 1])
+with col2:
+    st.image("logo.png", width=533)
+
+# Фоновые службы процесса создаются один раз, а не на каждом перезапуске скрипта:
+# хранилище кэша расстояний, экспорт cache.json и синхронизация с GitHub, наблюдение
+# за справочными данными, порт метрик Prometheus (Streamlit не даёт добавить свой эндпоинт)
+@st.cache_resource(show_spinner=False)
+def start_services():
+    store = get_cache_store()
+    git_sync = GitCacheSync() if os.environ.get('CACHE_GIT_SYNC', '1') == '1' else None
+    exporter = start_exporter(on_export=git_sync)
+    watcher = start_reference_watcher()
+    if os.environ.get('METRICS_PORT'):
+        start_metrics_server(int(os.environ['METRICS_PORT']))
+    return store, git_sync, exporter, watcher
+
+
+cache_store, git_cache_sync, cache_exporter, reference_watcher = start_services()
+
+# Справочные данные (routes.json, tver_boundaries.geojson) со всеми индексами собираются ядром;
+# изменённые файлы подхватываются в фоне, здесь только берётся действующая версия
+reference = get_reference_data()
+for message in reference.load_errors:
+    st.warning(message)
+exit_points = reference.exit_points
+
+# Диагностика админ-режима ходит в сеть: результат живёт столько секунд
+ADMIN_DIAGNOSTICS_TTL = int(os.environ.get('ADMIN_DIAGNOSTICS_TTL', 600))
+
+# Проверка GIT_TOKEN
+@st.cache_data(ttl=ADMIN_DIAGNOSTICS_TTL, show_spinner=False)
+def check_git_token():
+    git_token = os.environ.get('GIT_TOKEN')
+    if not git_token:
+        return "Ошибка: GIT_TOKEN не настроен в переменных окружения"
+    try:
+        response = requests.get('https://api.github.com/user', auth=('floratvertransport-prog', git_token), timeout=10)
+        if response.status_code == 200:
+            return f"GIT_TOKEN валиден: {response.json().get('login')}"
+        else:
+            return f"Ошибка проверки GIT_TOKEN: HTTP {response.status_code}, {response.json().get('message', 'Неизвестная ошибка')}"
+    except Exception as e:
+        return f"Ошибка проверки GIT_TOKEN: {str(e)}"
+
+# Получение IP сервера (через общую сессию HTTP-клиента в фоновом цикле)
+async def fetch_server_ip():
+    try:
+        status, ip_data = await get_client().request_json('default', 'GET', 'https://api.ipify.org?format=json')
+        if status == 200 and ip_data:
+            return ip_data.get('ip', 'Не удалось получить IP')
+        else:
+            return f"Ошибка получения IP: HTTP {status}"
+    except HttpError as e:
+        return f"Ошибка соединения при получении IP: {str(e)}"
+    except Exception as e:
+        return f"Неизвестная ошибка при получении IP: {str(e)}"
+
+
+@st.cache_data(ttl=ADMIN_DIAGNOSTICS_TTL, show_spinner=False)
+def get_server_ip():
+    return run_sync(fetch_server_ip())
+
+# Расчёт стоимости с учетом рейса
+def calculate_delivery_cost(cargo_size, dest_lat, dest_lon, address, routing_api_key, delivery_date=None, use_route_rate=False, stages=None):
+    """(Quote, предупреждения ORS): расчёт идёт в общем фоновом цикле HTTP-клиента, предупреждения показываются после него."""
+    warnings = []
+    with st.spinner("Производится расчёт стоимости..."), trace(stages):
+        result = run_sync(calculate_delivery_cost_core(
+            cargo_size, dest_lat, dest_lon, address, routing_api_key, delivery_date, use_route_rate,
+            on_warning=warnings.append))
+    return result, warnings
+
+
+# ----------------------------
+# Админ-режим
+# ----------------------------
+@st.fragment
+def admin_diagnostics():
+    """IP сервера и проверка GIT_TOKEN: запрашиваются при первом показе и держатся ADMIN_DIAGNOSTICS_TTL секунд."""
+    if st.button("Обновить диагностику"):
+        get_server_ip.clear()
+        check_git_token.clear()
+    st.write(f"IP сервера Render: {get_server_ip()}")
+    st.write(f"Проверка GIT_TOKEN: {check_git_token()}")
+
+
+@st.fragment
+def cache_browser():
+    """Содержимое кэша расстояний: читается из хранилища, только когда его попросили показать."""
+    if not st.toggle("Показать кэш расстояний"):
+        return
+    cache = cache_store.to_dict()
+    with st.expander("Текущий кэш"):
+        st.write(f"Текущий кэш: {cache}")
+
+    if cache:
+        with st.expander("Кэш расстояний"):
+            for locality, data in cache.items():
+                source = data.get('source', 'источник не записан')
+                updated = (f", {datetime.fromtimestamp(data['updated_at']):%d.%m.%Y}"
+                           if data.get('updated_at') else "")
+                st.write(f"{locality}: {data['distance']} км (точка выхода: {data['exit_point']}, "
+                         f"{source}{updated})")
+
+
+def admin_panel():
+    st.write("### Админ-режим активирован")
+    admin_diagnostics()
+    st.write(f"Версия Streamlit: {st.__version__}")
+    st.write(f"Версия aiohttp: {aiohttp.__version__}")
+    st.write(f"Хранилище кэша: {type(cache_store.backend).__name__}, записей: {len(cache_store)}")
+    memory_stats = cache_store.stats()
+    st.write(f"Кэш в памяти: попаданий {memory_stats['hits']}, промахов {memory_stats['misses']}, "
+             f"чтений с диска {memory_stats['backend_reads']}, перезагрузок {memory_stats['reloads']}, "
+             f"вытеснений {memory_stats['evictions']}, записей в памяти {memory_stats['size']}")
+    cache_refresher = delivery_core.get_cache_refresher()
+    if cache_refresher:
+        refresh_stats = cache_refresher.stats()
+        st.write(f"Фоновое обновление кэша: устаревших попаданий {refresh_stats['stale_hits']}, "
+                 f"запущено {refresh_stats['started']}, обновлено {refresh_stats['upgraded']}, "
+                 f"ошибок {refresh_stats['errors']}, отложено {refresh_stats['deferred']}")
+    reference_stats = delivery_core.get_reference_registry().stats()
+    st.write(f"Справочные данные: версия {reference_stats['generation']} ({reference_stats['version']}), "
+             f"загружена {datetime.fromtimestamp(reference_stats['loaded_at']):%d.%m.%Y %H:%M:%S}, "
+             f"обновлений {reference_stats['reloads']}, ошибок {reference_stats['errors']}"
+             + ("" if reference_watcher else " (наблюдение выключено)"))
+    if reference_stats['last_error']:
+        st.write(reference_stats['last_error'])
+    geocode_cache = get_geocode_cache()
+    if geocode_cache:
+        geocode_stats = geocode_cache.stats()
+        st.write(f"Кэш геокодирования: записей {geocode_stats['size']}, попаданий {geocode_stats['hits']}, "
+                 f"«не найден» из кэша {geocode_stats['negative_hits']}, промахов {geocode_stats['misses']}, "
+                 f"вытеснений {geocode_stats['evictions']}")
+    if cache_exporter.last_export:
+        st.write(f"Последний экспорт cache.json: {datetime.fromtimestamp(cache_exporter.last_export):%d.%m.%Y %H:%M:%S}")
+    if cache_exporter.last_error:
+        st.write(f"Ошибка сохранения кэша: {cache_exporter.last_error}")
+    git_status = cache_exporter.last_status
+    if 'git_sync_status' in git_status:
+        st.write(f"Статус синхронизации с GitHub: {git_status['git_sync_status']}")
+    if 'git_fetch_status' in git_status:
+        st.write(f"Статус git fetch: {git_status['git_fetch_status']}")
+    if 'git_remote_status' in git_status:
+        st.write(git_status['git_remote_status'])
+    if git_cache_sync:
+        sync_stats = git_cache_sync.stats()
+        last_success = (f"{datetime.fromtimestamp(sync_stats['last_success']):%d.%m.%Y %H:%M:%S}"
+                        if sync_stats['last_success'] else "—")
+        st.write(f"Фоновая синхронизация: запусков {sync_stats['runs']}, ошибок подряд {sync_stats['consecutive_failures']}, "
+                 f"отложено {sync_stats['skipped']}, последний успех: {last_success}")
+        if sync_stats['last_commit']:
+            st.write(f"Последний коммит кэша: {sync_stats['last_commit'][:8]}")
+    with st.expander("Метрики расчёта (с запуска процесса)"):
+        metrics = get_metrics()
+
+        def timing_rows(summary, title):
+            return [{title: name, 'расчётов': s['count'], 'среднее, мс': round(s['mean'] * 1e3, 2),
+                     'p50, мс': round(s['p50'] * 1e3, 2), 'p95, мс': round(s['p95'] * 1e3, 2),
+                     'p99, мс': round(s['p99'] * 1e3, 2)} for name, s in summary.items() if s['count']]
+
+        quote_rows = timing_rows(metrics.summary('delivery_quote_duration_seconds'), 'источник')
+        stage_rows = timing_rows(metrics.summary('delivery_stage_duration_seconds'), 'этап')
+        if quote_rows:
+            st.write("Расчёт целиком по источнику расстояния:")
+            st.table(quote_rows)
+        if stage_rows:
+            st.write("Этапы:")
+            st.table(stage_rows)
+        for name in ('delivery_cache_lookups_total', 'delivery_cache_refresh_total', 'delivery_geocode_total',
+                     'delivery_ors_requests_total', 'delivery_git_sync_total', 'delivery_reference_reloads_total',
+                     'delivery_quote_errors_total'):
+            values = metrics.counter_values(name)
+            if values:
+                st.write(f"{name}: " + ", ".join(
+                    f"{'/'.join(v for _, v in labels) or 'всего'} {value}" for labels, value in values.items()))
+        if not quote_rows:
+            st.write("Расчётов пока не было.")
+        if os.environ.get('METRICS_PORT'):
+            st.write(f"Prometheus: порт {os.environ['METRICS_PORT']}, путь /metrics")
+    if not routing_api_key and os.environ.get('ROAD_GRAPH'):
+        st.info(f"ORS_API_KEY не настроен. Для неизвестных адресов используется дорожный граф {os.environ['ROAD_GRAPH']}.")
+    elif not routing_api_key:
+        st.warning("ORS_API_KEY не настроен. Для неизвестных адресов используется Haversine с коэффициентом 1.3.")
+    else:
+        st.success("ORS_API_KEY настроен. Расстояние будет рассчитано по реальным дорогам.")
+
+    # Сворачиваемые секции
+    with st.expander("Точки выхода из Твери"):
+        if exit_points:
+            for i, point in enumerate(exit_points, 1):
+                st.write(f"Точка {i}: {point}")
+        else:
+            st.write("Данные о точках выхода отсутствуют (routes.json не загружен).")
+
+    cache_browser()
+
+
+# ----------------------------
+# Результат расчёта
+# ----------------------------
+# Выбор рейса и результат — фрагмент: переключение флажка и ответа пересчитывает
+# только его (стоимость по другому тарифу), без геокодирования и остальной страницы
+@st.fragment
+def quote_result(order):
+    """order — заказ из формы (координаты уже найдены), st.session_state.order."""
+    delivery_date = order['delivery_date']
+    use_route_rate = False
+    if order['route_match']:
+        st.write("👉 Вы можете доставить этот заказ вместе с оптовыми клиентами")
+        st.write("Доставка по рейсу вместе с оптовыми заказами")
+        use_route = st.checkbox("Использовать доставку по рейсу", key='use_route')
+        if use_route:
+            if not st.session_state.get('route_confirmed', False):
+                confirm = st.radio("Вы точно уверены, что возможна доставка вместе с оптовыми заказами? Время или объём позволяют осуществить доставку вместе с рейсом?", ("Нет", "Да"), key='route_confirm')
+                if confirm == "Да":
+                    st.session_state.route_confirmed = True
+                    use_route_rate = True
+                else:
+                    st.session_state.route_confirmed = False
+                    use_route_rate = False
+            else:
+                use_route_rate = True
+        else:
+            use_route_rate = False
+            if 'route_confirmed' in st.session_state:
+                del st.session_state.route_confirmed
+
+    try:
+        # Стоимость по каждому тарифу считается один раз на заказ
+        if use_route_rate not in order['quotes']:
+            stages = list(order['stages'])
+            order['quotes'][use_route_rate] = calculate_delivery_cost(
+                order['cargo_size'], order['dest_lat'], order['dest_lon'], order['address'], routing_api_key,
+                delivery_date, use_route_rate, stages) + (stages,)
+        result, warnings, stages = order['quotes'][use_route_rate]
+    except ValueError as e:
+        st.error(f"Ошибка: {e}")
+        return
+    except Exception as e:
+        st.error(f"Ошибка при расчёте: {e}")
+        return
+    for message in warnings:
+        st.warning(message)
+    dest_lat, dest_lon = order['dest_lat'], order['dest_lon']
+    cost, dist_to_exit, nearest_exit, locality_result, total_distance, source, rate_per_km = result
+    if source == "город" and nearest_exit is None and is_admin_mode():
+        st.write(f"DEBUG: Point ({dest_lon}, {dest_lat}) is inside Tver polygon.")
+    st.success(f"Стоимость доставки: {cost} руб.")
+    # Если доставка не в пределах города и нет рейса — предложим ближайший день
+    if source != "город" and not check_route_match(locality_result, delivery_date):
+        optimal = next_route_day(locality_result, delivery_date)
+        if optimal:
+            saving = route_savings(locality_result, order['cargo_size'], total_distance, [optimal.date])[0].saving
+            saving_text = f", дешевле на {saving:.0f} руб." if saving > 0 else ""
+            st.warning(f"Вы можете предложить клиенту доставить в другой день ({optimal.weekday}, {optimal.date.strftime('%d.%m.%Y')}{saving_text}) вместе с оптовыми заказами, чтобы было дешевле. Поменяйте дату в календаре и произведите повторный расчёт стоимости.")
+    if is_admin_mode():
+        st.write(f"Координаты адреса: lat={dest_lat}, lon={dest_lon}")
+        st.write(f"Ближайшая точка выхода: {nearest_exit}")
+        st.write(f"Расстояние до ближайшей точки выхода (по прямой): {dist_to_exit:.2f} км")
+        st.write(f"Извлечённый населённый пункт: {locality_result}")
+        st.write(f"Источник расстояния: {source}")
+        if source == "город":
+            st.write(f"Населённый пункт: {locality_result} (доставка в пределах Твери)")
+            st.write(f"Километраж: {total_distance} км (без доплаты)")
+            st.write(f"Базовая стоимость: {cost} руб. (без округления)")
+        elif source in ["таблица", "кэш", "ors", "haversine", "graph", "сетка"]:
+            st.write(f"Населённый пункт: {locality_result}")
+            st.write(f"Километраж (туда и обратно): {total_distance:.2f} км")
+            st.write(f"Доплата: {total_distance:.2f} × {rate_per_km} = {total_distance * rate_per_km:.2f} руб.")
+        st.write(f"Дата доставки: {delivery_date.strftime('%d.%m.%Y')} ({delivery_date.strftime('%A')})")
+        st.write(f"Использован рейс: {use_route_rate}")
+        st.write("Этапы расчёта: " + ", ".join(f"{name} {elapsed * 1e3:.2f} мс" for name, elapsed in stages))
+
+
+# Streamlit UI
+st.title("Калькулятор стоимости доставки по Твери и области для розничных клиентов")
+st.write("Введите адрес доставки, выберите размер груза и дату доставки.")
+st.write("Можно вводить адрес или координаты в формате: 56.862957, 35.883402")
+api_key = os.environ.get("API_KEY")
+routing_api_key = os.environ.get("ORS_API_KEY")
+if not api_key:
+    st.error("Ошибка: API-ключ для геокодирования не настроен. Обратитесь к администратору.")
+else:
+    with st.form(key="delivery_form"):
+        cargo_size = st.selectbox("Размер груза", ["маленький", "средний", "большой"])
+        address = st.text_input("Адрес доставки (например, 'Тверь, ул. Советская, 10' или 'Тверская область, Вараксино')", value="Тверская область, ")
+        delivery_date = st.date_input("Дата доставки", value=date.today(), format="DD.MM.YYYY")
+        submit_button = st.form_submit_button(label="Рассчитать")
+
+    if is_admin_mode():
+        admin_panel()
+
+    if submit_button and address:
+        # Новый заказ: выбор рейса и рассчитанные стоимости прежнего заказа больше не нужны
+        for key in ('order', 'use_route', 'route_confirmed', 'route_confirm'):
+            st.session_state.pop(key, None)
+        try:
+            # Время этапов этого расчёта (для админ-режима); в метрики процесса они попадают всегда
+            stages = []
+            # --- Новая логика: сначала пробуем распарсить координаты ---
+            with trace(stages), timed('parse'):
+                coords = parse_coordinates(address)
+            if coords:
+                dest_lat, dest_lon = coords
+                # Если введено что-то ещё помимо координат, попытка извлечь locality не нужна.
+                # Ставим понятный locality: либо Тверь (если внутри полигона), либо текст "Координаты ..."
+                locality = coordinates_locality(dest_lat, dest_lon)
+            else:
+                # Обычный путь — геокодирование через Яндекс
+                with trace(stages):
+                    dest_lat, dest_lon = geocode_address(address, api_key)
+                locality = extract_locality(address, (dest_lat, dest_lon))
+            st.session_state.order = {
+                'cargo_size': cargo_size, 'dest_lat': dest_lat, 'dest_lon': dest_lon,
+                'address': locality if coords else address, 'delivery_date': delivery_date,
+                'route_match': check_route_match(locality, delivery_date), 'stages': stages, 'quotes': {},
+            }
+        except ValueError as e:
+            st.error(f"Ошибка: {e}")
+        except Exception as e:
+            st.error(f"Ошибка при расчёте: {e}")
+
+    if 'order' in st.session_state:
+        quote_result(st.session_state.order)
+
+    # Пакетный расчёт: файл с заказами → CSV с рассчитанной стоимостью
+    with st.expander("Пакетный расчёт (CSV/JSONL/JSON)"):
+        st.write("Колонки: address (или lat, lon), cargo_size, delivery_date (ДД.ММ.ГГГГ), use_route (да/нет).")
+        uploaded = st.file_uploader("Файл с заказами", type=["csv", "jsonl", "json"])
+        if uploaded is not None and st.button("Рассчитать файл"):
+            try:
+                with st.spinner("Производится пакетный расчёт..."):
+                    pricer = BatchPricer(api_key, routing_api_key, store=cache_store)
+                    priced_csv, stats = price_bytes(uploaded.getvalue(), uploaded.name, pricer)
+            except ValueError as e:
+                st.error(f"Не удалось прочитать файл {uploaded.name}: {e}")
+            else:
+                st.success(f"Рассчитано строк: {stats['rows']}, ошибок: {stats['errors']}, "
+                           f"геокодировано адресов: {stats['geocoded']}, новых расстояний: {stats['routed']}")
+                st.download_button("Скачать результат", priced_csv.encode('utf-8-sig'),
+                                   file_name=f"priced_{os.path.splitext(uploaded.name)[0]}.csv", mime="text/csv")
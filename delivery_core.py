@@ -0,0 +1,983 @@
+"""
+Ядро расчёта стоимости доставки без зависимости от Streamlit.
+
+Справочные данные (routes.json, tver_boundaries.geojson) загружаются лениво
+при первом обращении и переиспользуются всем процессом, поэтому модуль можно
+импортировать из фоновых воркеров, CLI и бенчмарков. Долгоживущие процессы
+(Streamlit, API) запускают start_reference_watcher(): изменённые файлы
+подхватываются в фоне без перезапуска (см. reference_registry.py).
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from typing import NamedTuple, Optional
+
+from geo import PreparedPolygon, geojson_rings, haversine, haversine_matrix, nearest_many, point_in_polygon  # noqa: F401 (реэкспорт)
+from spatial_index import GridIndex, LocalityResolver, LocalityRouteIndex, locality_part
+from cache_store import get_cache_store, load_cache, save_cache  # noqa: F401 (реэкспорт)
+from geocode_cache import NOT_FOUND, get_geocode_cache, normalize_address
+from http_client import HttpError, get_client, run_sync
+from metrics import count, observe_quote, timed
+from reference_registry import DEFAULT_INTERVAL as REFERENCE_RELOAD_INTERVAL, ReferenceRegistry, ReferenceWatcher
+from single_flight import get_single_flight
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROUTES_FILE = os.path.join(BASE_DIR, 'routes.json')
+BOUNDARY_FILE = os.path.join(BASE_DIR, 'tver_boundaries.geojson')
+# Праздники и блокировки рейсов (необязательный файл, см. route_calendar.py)
+ROUTE_CALENDAR_FILE = os.path.join(BASE_DIR, 'route_calendar.json')
+
+# Тарифы
+cargo_prices = {"маленький": 350, "средний": 500, "большой": 800}
+ROUTE_RATE_PER_KM = 15
+DEFAULT_RATE_PER_KM = 32
+# Коэффициент перевода расстояния по прямой в дорожное (если ORS недоступен)
+ROAD_FACTOR = 1.3
+
+# Адреса внешних API (переопределяются для тестовых стендов и бенчмарков с заглушками)
+YANDEX_GEOCODER_URL = os.environ.get('YANDEX_GEOCODER_URL', "https://geocode-maps.yandex.ru/1.x/")
+ORS_BASE_URL = os.environ.get('ORS_BASE_URL', "https://api.openrouteservice.org").rstrip('/')
+
+# Словари населённых пунктов с привязкой к конкретным точкам выхода
+# (номер точки выхода с единицы, как в админ-режиме)
+no_route_localities_point_8 = {
+    "деревня Аввакумово": (56.879706, 36.006304),
+    "деревня Аркатово": (56.890298, 36.029007),
+    "деревня Горютино": (56.891522, 36.058333),
+    "деревня Сапково": (56.887168, 36.066890),
+    "посёлок Сахарово": (56.897499, 36.049389)
+}
+
+no_route_localities_point_7 = {
+    "деревня Рябеево": (56.835279, 35.716402),
+    "деревня Красново": (56.836976, 35.667727),
+    "деревня Мотавино": (56.833959, 35.651731),
+    "деревня Прудище": (56.828384, 35.627544),
+    "деревня Спичево": (56.823067, 35.612344)
+}
+
+PINNED_EXIT_POINTS = [(8, no_route_localities_point_8), (7, no_route_localities_point_7)]
+# Допуск привязки по координатам, градусы (около 1 км)
+PINNED_TOLERANCE = 0.01
+
+# Префикс «населённого пункта» для ввода координатами
+COORDINATES_PREFIX = "Координаты "
+
+# Словарь для перевода дней недели на русский
+day_translation = {
+    'Monday': 'Понедельник',
+    'Tuesday': 'Вторник',
+    'Wednesday': 'Среда',
+    'Thursday': 'Четверг',
+    'Friday': 'Пятница',
+    'Saturday': 'Суббота',
+    'Sunday': 'Воскресенье'
+}
+
+
+class Quote(NamedTuple):
+    """Результат расчёта; распаковывается как прежний кортеж из 7 значений."""
+    cost: float
+    dist_to_exit: float
+    nearest_exit: Optional[list]
+    locality: Optional[str]
+    total_distance: float
+    source: str
+    rate_per_km: int
+
+
+# ----------------------------
+# Справочные данные
+# ----------------------------
+def _read_json(path, title, errors):
+    if not os.path.exists(path):
+        errors.append(f"Файл {title} не найден. Используются пустые данные.")
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        errors.append(f"Ошибка при загрузке {title}: {e}")
+        return {}
+
+
+def reference_version(exit_points, tver_geojson):
+    """Отпечаток точек выхода и границы: по нему отбрасываются устаревшие предрасчёты."""
+    return hashlib.sha1(json.dumps([exit_points, tver_geojson], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def exit_points_version(exit_points):
+    """Отпечаток только точек выхода: записи кэша расстояний, посчитанные от других точек, устарели."""
+    return hashlib.sha1(json.dumps(exit_points).encode('utf-8')).hexdigest()[:12]
+
+
+class ReferenceData:
+    """Точки выхода, рейсы по дням недели и граница Твери."""
+
+    def __init__(self, routes_file=ROUTES_FILE, boundary_file=BOUNDARY_FILE):
+        self.load_errors = []
+        self.boundary_file = boundary_file
+        routes = _read_json(routes_file, 'routes.json', self.load_errors)
+        self.exit_points = routes.get('exit_points', [])
+        self.exit_version = exit_points_version(self.exit_points)
+        self._route_groups = routes.get('route_groups', {})
+        self._tver_geojson = _read_json(boundary_file, 'tver_boundaries.geojson', self.load_errors)
+        # Внешнее кольцо первой части границы (для Polygon и MultiPolygon одинаково)
+        rings = geojson_rings(self._tver_geojson)
+        self.tver_polygon = rings[0] if rings else []
+        # Вся граница (все части и дыры), подготовленная для быстрых проверок
+        self.tver_boundary = PreparedPolygon.from_geojson(self._tver_geojson)
+        self.version = reference_version(self.exit_points, self._tver_geojson)
+        self.snapshot = None
+        self._build_indexes(LocalityRouteIndex(self._route_groups))
+
+    @classmethod
+    def from_snapshot(cls, snapshot, boundary_file=BOUNDARY_FILE):
+        """Справочные данные из бинарного снимка (см. reference_snapshot.py) без разбора JSON."""
+        reference = cls.__new__(cls)
+        reference.load_errors = []
+        reference.boundary_file = boundary_file
+        reference.snapshot = snapshot
+        reference.exit_points = snapshot.exit_points()
+        reference.exit_version = exit_points_version(reference.exit_points)
+        # Рейсы и GeoJSON целиком на расчёте не нужны: разворачиваются при первом обращении
+        reference._route_groups = None
+        reference._tver_geojson = None
+        reference.tver_polygon = snapshot.first_ring()
+        reference.tver_boundary = PreparedPolygon(snapshot.rings())
+        reference.version = snapshot.version
+        reference._build_indexes(snapshot.route_index())
+        return reference
+
+    @property
+    def route_groups(self):
+        if self._route_groups is None:
+            self._route_groups = self.snapshot.route_groups()
+        return self._route_groups
+
+    @property
+    def tver_geojson(self):
+        if self._tver_geojson is None:
+            self._tver_geojson = _read_json(self.boundary_file, 'tver_boundaries.geojson', self.load_errors)
+        return self._tver_geojson
+
+    def _build_indexes(self, route_index):
+        # Производные объекты версии: строятся при первом обращении (или заранее, см. prepare_reference)
+        self.zone_grid = None
+        self.locality_resolver = None
+        self.route_calendar = None
+        # Точки выхода хранятся как [lon, lat], индексы работают с (lat, lon)
+        self.exit_index = GridIndex([(lat, lon) for lon, lat in self.exit_points])
+        pinned = [(coords, number - 1) for number, localities in PINNED_EXIT_POINTS for coords in localities.values()]
+        self.pinned_index = GridIndex([coords for coords, _ in pinned], cell_size=PINNED_TOLERANCE)
+        self.pinned_exits = [exit_idx for _, exit_idx in pinned]
+        self.route_index = route_index
+
+
+def load_reference_data(routes_file=ROUTES_FILE, boundary_file=BOUNDARY_FILE):
+    """
+    Загрузить справочные данные: из бинарного снимка, пересобрав его при
+    изменении JSON, или из JSON напрямую (REFERENCE_SNAPSHOT=0, снимок не
+    собирается — например, каталог только для чтения).
+    """
+    if os.environ.get('REFERENCE_SNAPSHOT', '1') == '1' and os.path.exists(routes_file) and os.path.exists(boundary_file):
+        try:
+            from reference_snapshot import SNAPSHOT_FILE, ensure_snapshot
+
+            snapshot = ensure_snapshot(routes_file, boundary_file, os.environ.get('REFERENCE_SNAPSHOT_FILE', SNAPSHOT_FILE))
+            return ReferenceData.from_snapshot(snapshot, boundary_file)
+        except Exception as e:
+            logger.warning(f"Снимок справочных данных недоступен, читаем JSON: {e}")
+    return ReferenceData(routes_file, boundary_file)
+
+
+def reference_files():
+    """Файлы, из которых собирается версия справочных данных (за ними следит наблюдатель)."""
+    return [ROUTES_FILE, BOUNDARY_FILE, os.environ.get('ROUTE_CALENDAR_FILE', ROUTE_CALENDAR_FILE)]
+
+
+def _load_reference_logged():
+    reference = load_reference_data()
+    for message in reference.load_errors:
+        logger.warning(message)
+    return reference
+
+
+def prepare_reference(reference):
+    """Построить производные объекты версии заранее, чтобы после замены расчёт их не строил."""
+    reference.route_groups  # из снимка рейсы разворачиваются при первом обращении
+    _reference_calendar(reference)
+    _reference_zone_grid(reference)
+    _reference_resolver(reference)
+
+
+_reference_registry = None
+_reference_lock = threading.Lock()
+# Версия, закреплённая за текущим расчётом (contextvar доходит до корутин и run_sync)
+_pinned_reference = contextvars.ContextVar('reference_data', default=None)
+
+
+def get_reference_registry():
+    """Реестр версий справочных данных процесса (reference_registry.py); первая версия грузится при создании."""
+    global _reference_registry
+    if _reference_registry is None:
+        with _reference_lock:
+            if _reference_registry is None:
+                _reference_registry = ReferenceRegistry(_load_reference_logged, reference_files(), prepare_reference)
+    return _reference_registry
+
+
+def get_reference_data():
+    """Вернуть справочные данные: версию текущего расчёта или действующую версию процесса."""
+    reference = _pinned_reference.get()
+    if reference is not None:
+        return reference
+    return (_reference_registry or get_reference_registry()).current
+
+
+@contextmanager
+def pinned_reference(reference=None):
+    """Закрепить версию справочных данных за блоком: замена версии в фоне его не затронет."""
+    reference = reference or get_reference_data()
+    token = _pinned_reference.set(reference)
+    try:
+        yield reference
+    finally:
+        _pinned_reference.reset(token)
+
+
+def reset_reference_data():
+    """Перечитать справочные данные сейчас (при ошибке загрузки остаётся прежняя версия). Вернуть True при замене."""
+    return get_reference_registry().reload(force=True)
+
+
+_reference_watcher = None
+
+
+def start_reference_watcher(interval=None):
+    """
+    Запустить фоновое наблюдение за файлами справочных данных (повторные вызовы
+    возвращают уже запущенное). REFERENCE_RELOAD_INTERVAL=0 — не наблюдать, None.
+    """
+    global _reference_watcher
+    interval = interval or float(os.environ.get('REFERENCE_RELOAD_INTERVAL', REFERENCE_RELOAD_INTERVAL))
+    if interval <= 0:
+        return None
+    registry = get_reference_registry()
+    with _reference_lock:
+        if _reference_watcher is None or not _reference_watcher.is_alive():
+            _reference_watcher = ReferenceWatcher(registry, interval)
+            _reference_watcher.start()
+    return _reference_watcher
+
+
+# ----------------------------
+# Сетка ценовых зон
+# ----------------------------
+ZONE_GRID_SOURCE = "сетка"
+
+
+def _reference_zone_grid(reference):
+    path = os.environ.get('ZONE_GRID')
+    if not path:
+        return None
+    if reference.zone_grid is None:
+        with _reference_lock:
+            if reference.zone_grid is None:
+                from zone_grid import load_zone_grid
+                try:
+                    grid = load_zone_grid(path)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Сетка зон {path} не загружена: {e}")
+                    grid = False
+                if grid and grid.reference_version != reference.version:
+                    logger.warning(f"Сетка зон {path} построена по другим справочным данным, не используется")
+                    grid = False
+                reference.zone_grid = grid
+    return reference.zone_grid or None
+
+
+def get_zone_grid():
+    """
+    Сетка зон процесса (см. zone_grid.py) или None.
+
+    Включается переменной ZONE_GRID с путём к каталогу сетки. Сетка,
+    построенная по другим точкам выхода или границе, не используется.
+    Расстояния сетки по прямой (source=haversine) идут в расчёт только без
+    ключа ORS; с ключом приоритет у кэша и ORS.
+    """
+    return _reference_zone_grid(get_reference_data())
+
+
+# ----------------------------
+# Геометрия
+# ----------------------------
+def is_inside_tver(dest_lat, dest_lon):
+    return get_reference_data().tver_boundary.contains(dest_lon, dest_lat)
+
+
+def inside_tver_many(lats, lons):
+    """Векторная проверка массива точек для пакетного расчёта (numpy-массив bool)."""
+    return get_reference_data().tver_boundary.contains_many(lons, lats)
+
+
+# ----------------------------
+# Парсер координат
+# ----------------------------
+def parse_coordinates(input_str: str):
+    """
+    Попробовать распарсить строку как координаты.
+    Принимает форматы:
+      - "lat, lon"
+      - "lon, lat"
+      - "lat lon" / "lon lat"
+      - с ; вместо ,
+    Вернёт (lat, lon) или None.
+    """
+    if not input_str or not isinstance(input_str, str):
+        return None
+    s = input_str.strip()
+    # Уберём лишние слова в конце/начале (если пользователь вставил "координаты: 56.8, 35.9")
+    # Но не трогаем если это обычный адрес.
+    # Попробуем найти два числа в строке.
+    for sep in [',', ';']:
+        if sep in s:
+            parts = [p.strip() for p in s.split(sep) if p.strip() != ""]
+            if len(parts) >= 2:
+                # Берём первые два компонента
+                a, b = parts[0], parts[1]
+                try:
+                    a_f = float(a)
+                    b_f = float(b)
+                    # Определим, какой из них широта (lat) — обычно в [-90,90]
+                    if -90 <= a_f <= 90 and -180 <= b_f <= 180:
+                        return a_f, b_f  # a=lat, b=lon
+                    if -90 <= b_f <= 90 and -180 <= a_f <= 180:
+                        return b_f, a_f  # b=lat, a=lon (обратный порядок)
+                except ValueError:
+                    return None
+    # Попробовать пробел в качестве разделителя (редко)
+    parts = s.split()
+    if len(parts) >= 2:
+        try:
+            a_f = float(parts[0])
+            b_f = float(parts[1])
+            if -90 <= a_f <= 90 and -180 <= b_f <= 180:
+                return a_f, b_f
+            if -90 <= b_f <= 90 and -180 <= a_f <= 180:
+                return b_f, a_f
+        except ValueError:
+            return None
+    return None
+
+
+def coordinates_locality(dest_lat, dest_lon):
+    """Название населённого пункта для ввода координатами."""
+    if is_inside_tver(dest_lat, dest_lon):
+        return 'Тверь'
+    return f"{COORDINATES_PREFIX}{round(dest_lat,6)},{round(dest_lon,6)}"
+
+
+# ----------------------------
+# Внешние сервисы
+# ----------------------------
+class UpstreamError(ValueError):
+    """
+    Внешний сервис (Яндекс Геокодер, ORS) недоступен или ответил ошибкой.
+
+    Наследует ValueError, чтобы прежние обработчики ошибок расчёта работали
+    как раньше; status — HTTP-статус ответа (None, если ответа не было).
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+# Геокодирование через Яндекс
+ADDRESS_NOT_FOUND = "Адрес не найден. Уточните адрес (например, добавьте 'Тверь' или 'Тверская область')."
+
+
+async def geocode_address_async(address, api_key, cache=None):
+    """
+    Координаты (lat, lon) адреса через Яндекс Геокодер.
+
+    cache — постоянный кэш геокодирования (по умолчанию get_geocode_cache(),
+    False — не использовать). «Адрес не найден» тоже кэшируется, ошибки API — нет.
+    """
+    with timed('geocode'):
+        return await _geocode_cached(address, api_key, cache)
+
+
+async def _geocode_cached(address, api_key, cache):
+    if cache is None:
+        cache = get_geocode_cache()
+    elif cache is False:
+        cache = None
+    if cache is not None:
+        cached = cache.get(address)
+        if cached == NOT_FOUND:
+            count('delivery_geocode_total', result='cache_not_found')
+            raise ValueError(ADDRESS_NOT_FOUND)
+        if cached:
+            count('delivery_geocode_total', result='cache')
+            return cached
+    # Одновременные запросы одного адреса (в любом написании) ждут один запрос к Яндексу
+    return await get_single_flight().do(('geocode', normalize_address(address)),
+                                        lambda: _geocode_yandex(address, api_key, cache))
+
+
+async def _geocode_yandex(address, api_key, cache):
+    url = YANDEX_GEOCODER_URL
+    params = {"apikey": api_key, "geocode": address, "format": "json"}
+    try:
+        status, data = await get_client().request_json('yandex', 'GET', url, params=params)
+    except HttpError as e:
+        count('delivery_geocode_total', result='error')
+        raise UpstreamError(f"Ошибка API: {e.status or e}", e.status)
+    if status == 200:
+        try:
+            pos = data['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']['Point']['pos']
+            lon, lat = map(float, pos.split(' '))
+        except (IndexError, KeyError, TypeError):
+            count('delivery_geocode_total', result='not_found')
+            if cache is not None:
+                cache.set(address, None)
+            raise ValueError(ADDRESS_NOT_FOUND)
+        count('delivery_geocode_total', result='yandex')
+        if cache is not None:
+            cache.set(address, (lat, lon))
+        return lat, lon
+    else:
+        count('delivery_geocode_total', result='error')
+        raise UpstreamError(f"Ошибка API: {status}", status)
+
+
+def geocode_address(address, api_key):
+    """Синхронное геокодирование через общий фоновый цикл HTTP-клиента."""
+    return run_sync(geocode_address_async(address, api_key))
+
+
+# Запрос к ORS
+async def get_road_distance_ors(start_lon, start_lat, end_lon, end_lat, api_key):
+    url = f"{ORS_BASE_URL}/v2/directions/driving-car"
+    headers = {
+        "Authorization": api_key,
+        "Content-Type": "application/json",
+        "Accept": "application/geo+json"
+    }
+    body = {
+        "coordinates": [[start_lon, start_lat], [end_lon, end_lat]],
+        "units": "km",
+        "radiuses": [1000, 1000]
+    }
+    try:
+        status, data = await get_client().request_json('ors', 'POST', url, json=body, headers=headers)
+    except HttpError as e:
+        raise UpstreamError(f"Ошибка соединения с ORS API: {str(e)}", e.status)
+    if status == 200:
+        distance = data["routes"][0]["summary"]["distance"]
+        return distance
+    error = (data or {}).get("error", {})
+    if not isinstance(error, dict):
+        error = {"message": str(error)}
+    error_code = error.get("code", 0)
+    error_msg = error.get("message", "Неизвестная ошибка")
+    if error_code == 2010:
+        raise ValueError(f"ORS не нашёл маршрут для координат: {error_msg}. Используется Haversine.")
+    raise UpstreamError(f"Ошибка ORS API: HTTP {status}. Код: {error_code}. Сообщение: {error_msg}", status)
+
+
+# Локальный дорожный граф (road_graph.py) вместо ORS или в подстраховку к нему
+ROAD_GRAPH_SOURCE = "graph"
+_road_graph = None
+_road_graph_lock = threading.Lock()
+
+
+def get_road_graph():
+    """Дорожный граф процесса или None; включается переменной ROAD_GRAPH с путём к каталогу графа."""
+    global _road_graph
+    path = os.environ.get('ROAD_GRAPH')
+    if not path:
+        return None
+    if _road_graph is None:
+        with _road_graph_lock:
+            if _road_graph is None:
+                from road_graph import load_road_graph
+                try:
+                    _road_graph = load_road_graph(path)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Дорожный граф {path} не загружен: {e}")
+                    _road_graph = False
+    return _road_graph or None
+
+
+async def get_road_distance_graph(start_lon, start_lat, end_lon, end_lat, api_key=None):
+    """То же, что get_road_distance_ors, по локальному дорожному графу (км); api_key не нужен."""
+    graph = get_road_graph()
+    if graph is None:
+        raise ValueError("Дорожный граф не загружен (ROAD_GRAPH)")
+    # От точки выхода ответ — чтение массива, но A* для прочих пар не должен занимать цикл событий
+    return await asyncio.get_running_loop().run_in_executor(
+        None, graph.distance, start_lon, start_lat, end_lon, end_lat)
+
+
+# ----------------------------
+# Точки выхода, населённые пункты, рейсы
+# ----------------------------
+# Поиск ближайшей точки выхода с точной привязкой по координатам
+def find_nearest_exit_point(dest_lat, dest_lon, locality=None, delivery_date=None):
+    reference = get_reference_data()
+    exit_points = reference.exit_points
+
+    # Проверка координат для привязки к точкам 8 и 7 (в порядке PINNED_EXIT_POINTS)
+    for i in reference.pinned_index.within(dest_lat, dest_lon, PINNED_TOLERANCE):
+        exit_idx = reference.pinned_exits[i]
+        if len(exit_points) > exit_idx:
+            nearest_exit = exit_points[exit_idx]
+            return nearest_exit, haversine(dest_lat, dest_lon, nearest_exit[1], nearest_exit[0])
+
+    # Если нет точного соответствия, ищем ближайшую точку
+    index, min_dist = reference.exit_index.nearest(dest_lat, dest_lon)
+    return (exit_points[index] if index is not None else None), min_dist
+
+
+def find_nearest_exit_points_many(dest_lats, dest_lons):
+    """
+    Векторный find_nearest_exit_point для массивов координат.
+
+    Возвращает (индексы точек выхода, расстояния в км); индекс -1 — точек
+    выхода нет. Привязка населённых пунктов к точкам 8 и 7 учитывается.
+    """
+    import numpy as np
+
+    reference = get_reference_data()
+    exit_points = reference.exit_points
+    dest_lats = np.asarray(dest_lats, dtype=float)
+    dest_lons = np.asarray(dest_lons, dtype=float)
+    exit_lons = [p[0] for p in exit_points]
+    exit_lats = [p[1] for p in exit_points]
+    nearest, distances = nearest_many(dest_lats, dest_lons, exit_lats, exit_lons)
+    # Первая подходящая привязка побеждает, как в скалярной версии
+    pinned_exit = np.full(dest_lats.shape, -1)
+    for (lat, lon), exit_idx in zip(reference.pinned_index.points, reference.pinned_exits):
+        if len(exit_points) <= exit_idx:
+            continue
+        match = ((pinned_exit < 0) & (np.abs(dest_lats - lat) < PINNED_TOLERANCE)
+                 & (np.abs(dest_lons - lon) < PINNED_TOLERANCE))
+        pinned_exit[match] = exit_idx
+    fixed = pinned_exit >= 0
+    if fixed.any():
+        nearest[fixed] = pinned_exit[fixed]
+        distances[fixed] = haversine_matrix(dest_lats[fixed], dest_lons[fixed], exit_lats,
+                                            exit_lons)[np.arange(fixed.sum()), pinned_exit[fixed]]
+    return nearest, distances
+
+
+# ----------------------------
+# Населённый пункт из адреса
+# ----------------------------
+def _reference_resolver(reference):
+    if reference.locality_resolver is None:
+        cache_entries = [(key, _lat_lon(entry.get('dest'))) for key, entry in get_cache_store().to_dict().items()
+                         if not key.startswith(COORDINATES_PREFIX)]
+        with _reference_lock:
+            if reference.locality_resolver is None:
+                # Написание пунктов с закреплённой точкой выхода и остановок рейсов — каноническое:
+                # по нему проверяются рейсы и закрепления; ключи кэша с другим написанием — варианты.
+                # Точки остановок и пунктов кэша нужны, чтобы принять название с опечаткой
+                names = [(name, None) for name in no_route_localities_point_8]
+                names.extend((name, None) for name in no_route_localities_point_7)
+                for day_routes in reference.route_groups.values():
+                    for stops in day_routes.values():
+                        names.extend((stop['name'], _lat_lon(stop.get('coords'))) for stop in stops)
+                names.extend(cache_entries)
+                resolver = LocalityResolver()
+                for name, point in names:
+                    resolver.add(name, point)
+                reference.locality_resolver = resolver
+    return reference.locality_resolver
+
+
+def _lat_lon(coords):
+    """[lon, lat] из routes.json и записей кэша → (lat, lon); None, если координат нет."""
+    return (coords[1], coords[0]) if coords else None
+
+
+def get_locality_resolver():
+    """
+    Словарь известных населённых пунктов процесса.
+
+    Строится на версию справочных данных: пункты без рейсов, остановки рейсов
+    и ключи кэша расстояний (с точками остановок и пунктов кэша). Ключи, записанные в кэш этим процессом позже,
+    добавляются при записи (_route_and_store); записи других процессов
+    попадут в словарь со следующей версией справочных данных.
+    """
+    return _reference_resolver(get_reference_data())
+
+
+def cached_distance(store, locality):
+    """(ключ, запись) из кэша расстояний: по каноническому названию, иначе по его вариантам; (locality, None)."""
+    cached = store.get(locality)
+    if cached is None and locality and not locality.startswith(COORDINATES_PREFIX):
+        resolver = get_reference_data().locality_resolver
+        for alias in resolver.aliases(locality) if resolver else ():
+            cached = store.get(alias)
+            if cached is not None:
+                return alias, cached
+    return locality, cached
+
+
+def extract_locality(address, point=None):
+    """
+    Населённый пункт из адреса: по словарю, иначе первая подходящая часть адреса.
+
+    point — (lat, lon) адреса: название с опечаткой принимается, только если
+    точка рядом с известным пунктом (см. LocalityResolver).
+    """
+    # Координаты уже являются ключом кэша целиком (иначе запятая обрезала бы долготу)
+    if address.startswith(COORDINATES_PREFIX):
+        return address
+    address_lower = address.lower()
+    if 'тверь' in address_lower:
+        return 'Тверь'
+    if 'завидово' in address_lower and not 'новозавидовский' in address_lower:
+        return 'село Завидово'
+    if 'новозавидовский' in address_lower:
+        return 'посёлок городского типа Новозавидовский'
+    return get_locality_resolver().resolve(address, point) or locality_part(address)
+
+
+def _reference_calendar(reference):
+    if reference.route_calendar is None:
+        with _reference_lock:
+            if reference.route_calendar is None:
+                from route_calendar import RouteCalendar, load_calendar_config
+                path = os.environ.get('ROUTE_CALENDAR_FILE', ROUTE_CALENDAR_FILE)
+                try:
+                    holidays, blackouts, public_holidays = load_calendar_config(path)
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Календарь рейсов {path} не загружен, даты рейсов — по расписанию: {e}")
+                    holidays, blackouts, public_holidays = (), (), os.environ.get('ROUTE_PUBLIC_HOLIDAYS') == '1'
+                reference.route_calendar = RouteCalendar(reference.route_index, holidays, blackouts, public_holidays)
+    return reference.route_calendar
+
+
+def get_route_calendar():
+    """Календарь рейсов (route_calendar.py) версии справочных данных с файлом праздников/блокировок."""
+    return _reference_calendar(get_reference_data())
+
+
+# Проверка соответствия рейсу
+def check_route_match(locality, delivery_date):
+    reference = get_reference_data()
+    if not locality or not delivery_date or not reference.route_groups:
+        return False
+    # Исключение для населённых пунктов без рейсов
+    if locality in no_route_localities_point_8 or locality in no_route_localities_point_7:
+        return False
+    return get_route_calendar().runs(locality, delivery_date)
+
+
+# Поиск ближайшего дня с оптовым рейсом
+def find_nearest_optimal_day(locality, current_date):
+    route_day = next_route_day(locality, current_date)
+    return route_day.weekday if route_day else None
+
+
+def next_route_day(locality, current_date):
+    """Ближайшая дата рейса в населённый пункт не раньше current_date (RouteDay) или None."""
+    reference = get_reference_data()
+    if not reference.route_groups or not locality:
+        return None
+    if locality in no_route_localities_point_8 or locality in no_route_localities_point_7:
+        return None
+    return get_route_calendar().next_route_day(locality, current_date)
+
+
+class DateQuote(NamedTuple):
+    """Стоимость доставки в конкретную дату: по тарифу рейса, если он в этот день идёт."""
+    date: date
+    routes: tuple
+    cost: float
+    saving: float
+
+
+def route_savings(locality, cargo_size, total_distance, dates):
+    """
+    Стоимость для каждой даты-кандидата (список DateQuote).
+
+    total_distance — километраж туда-обратно из Quote; saving — разница с
+    обычным тарифом (0 в даты без рейса).
+    """
+    base_cost = cargo_prices[cargo_size]
+    default_cost = price_for_distance(base_cost, total_distance, DEFAULT_RATE_PER_KM)
+    route_cost = price_for_distance(base_cost, total_distance, ROUTE_RATE_PER_KM)
+    pinned = locality in no_route_localities_point_8 or locality in no_route_localities_point_7
+    calendar = get_route_calendar()
+    quotes = []
+    for day in dates:
+        routes = () if pinned or not locality else calendar.routes_on(locality, day)
+        cost = route_cost if routes else default_cost
+        quotes.append(DateQuote(day, routes, cost, default_cost - cost))
+    return quotes
+
+
+# ----------------------------
+# Записи кэша расстояний
+# ----------------------------
+def distance_entry(total_distance, exit_point, source, dest=None):
+    """
+    Запись кэша расстояний: километраж туда-обратно, точка выхода и откуда он взят.
+
+    source — 'ors', 'ors_matrix' или 'haversine'. По updated_at и
+    exit_version фоновое обновление (cache_refresh.py) находит устаревшие
+    записи; dest — [lon, lat] пункта, чтобы пересчитать запись без геокодирования.
+    """
+    entry = {'distance': total_distance, 'exit_point': exit_point, 'source': source,
+             'updated_at': int(time.time()), 'exit_version': get_reference_data().exit_version}
+    if dest is not None:
+        entry['dest'] = [round(dest[0], 6), round(dest[1], 6)]
+    return entry
+
+
+# Источники, которым можно верить, пока не сменились точки выхода и запись не состарилась
+TRUSTED_SOURCES = frozenset(['ors', 'ors_matrix'])
+
+
+def stale_reason(entry, exit_version, max_age=None, now=None):
+    """
+    Почему запись кэша надо пересчитать через ORS, или None.
+
+    'legacy' — запись без источника (прежний формат), 'haversine' — по
+    прямой, 'exit_points' — посчитана от других точек выхода, 'age' —
+    старше max_age секунд.
+    """
+    source = entry.get('source')
+    if source is None:
+        return 'legacy'
+    if source not in TRUSTED_SOURCES:
+        return source
+    if entry.get('exit_version') != exit_version:
+        return 'exit_points'
+    if max_age and (now or time.time()) - entry.get('updated_at', 0) > max_age:
+        return 'age'
+    return None
+
+
+_cache_refresher = None
+_cache_refresher_lock = threading.Lock()
+
+
+def get_cache_refresher():
+    """Фоновое обновление устаревших записей кэша (cache_refresh.py); False при CACHE_REFRESH=0."""
+    global _cache_refresher
+    if _cache_refresher is None:
+        with _cache_refresher_lock:
+            if _cache_refresher is None:
+                if os.environ.get('CACHE_REFRESH', '1') == '1':
+                    from cache_refresh import CacheRefresher
+                    _cache_refresher = CacheRefresher.from_env()
+                else:
+                    _cache_refresher = False
+    return _cache_refresher
+
+
+# ----------------------------
+# Расчёт стоимости
+# ----------------------------
+# Округление стоимости
+def round_cost(cost):
+    remainder = cost % 100
+    if remainder <= 20:
+        return (cost // 100) * 100
+    else:
+        return ((cost // 100) + 1) * 100
+
+
+def price_for_distance(base_cost, total_distance, rate_per_km):
+    """Стоимость по базовой цене груза и километражу туда-обратно, округлённая как в расчёте заказа."""
+    total_cost = base_cost + total_distance * rate_per_km
+    return round_cost(total_cost) if total_distance > 0 else base_cost
+
+
+# Расчёт стоимости с учетом рейса
+def _zone_grid_quote(grid, base_cost, dest_lat, dest_lon, locality, rate_per_km, distances=True):
+    """
+    Quote по ячейке сетки; None вне сетки и для ячеек на границе Твери.
+
+    distances=False — из сетки берётся только «внутри Твери», расстояние за
+    городом считается обычным путём (кэш, ORS).
+    """
+    from zone_grid import INSIDE, OUTSIDE
+
+    cell = grid.lookup(dest_lat, dest_lon)
+    if cell is None:
+        return None
+    inside, exit_idx, road_distance = cell
+    if inside == INSIDE:
+        return Quote(base_cost, 0, None, 'Тверь', 0, "город", 0)
+    if inside != OUTSIDE or exit_idx < 0 or not distances:
+        return None
+    nearest_exit = get_reference_data().exit_points[exit_idx]
+    dist_to_exit = haversine(dest_lat, dest_lon, nearest_exit[1], nearest_exit[0])
+    total_distance = road_distance * 2
+    return Quote(price_for_distance(base_cost, total_distance, rate_per_km), dist_to_exit, nearest_exit, locality,
+                 total_distance, ZONE_GRID_SOURCE, rate_per_km)
+
+
+async def calculate_delivery_cost(cargo_size, dest_lat, dest_lon, address, routing_api_key, delivery_date=None,
+                                  use_route_rate=False, on_warning=None, store=None, zone_grid=None):
+    """
+    Рассчитать стоимость доставки и вернуть Quote.
+
+    on_warning(message) вызывается при переходе на Haversine из-за ошибки ORS.
+    store — хранилище кэша расстояний (по умолчанию общее хранилище процесса).
+    zone_grid — сетка зон для ввода координатами (по умолчанию get_zone_grid(), False — не использовать).
+    Время расчёта и его этапов попадает в метрики процесса (metrics).
+    """
+    start = time.perf_counter()
+    # Версия справочных данных закрепляется за расчётом (как pinned_reference, но без генератора)
+    token = _pinned_reference.set(get_reference_data())
+    try:
+        result = await _calculate_delivery_cost(cargo_size, dest_lat, dest_lon, address, routing_api_key,
+                                                delivery_date, use_route_rate, on_warning, store, zone_grid)
+    finally:
+        _pinned_reference.reset(token)
+    observe_quote(result.source, time.perf_counter() - start)
+    return result
+
+
+async def _calculate_delivery_cost(cargo_size, dest_lat, dest_lon, address, routing_api_key, delivery_date,
+                                   use_route_rate, on_warning, store, zone_grid):
+    if cargo_size not in cargo_prices:
+        raise ValueError("Неверный размер груза. Доступны: маленький, средний, большой")
+    base_cost = cargo_prices[cargo_size]
+    with timed('locality'):
+        locality = extract_locality(address, (dest_lat, dest_lon))
+    rate_per_km = ROUTE_RATE_PER_KM if use_route_rate else DEFAULT_RATE_PER_KM
+    if zone_grid is None:
+        zone_grid = get_zone_grid()
+    if zone_grid and locality and locality.startswith(COORDINATES_PREFIX):
+        # Сетка по прямой не подменяет ORS: при настроенном ключе её расстояния не используются
+        grid_distances = zone_grid.source == 'ors' or not routing_api_key
+        with timed('zone_grid'):
+            zone_quote = _zone_grid_quote(zone_grid, base_cost, dest_lat, dest_lon, locality, rate_per_km,
+                                          grid_distances)
+        if zone_quote:
+            return zone_quote
+    # Проверка, находится ли точка внутри границ Твери
+    with timed('polygon'):
+        inside = is_inside_tver(dest_lat, dest_lon)
+    if inside:
+        logger.debug(f"Point ({dest_lon}, {dest_lat}) is inside Tver polygon.")
+        return Quote(base_cost, 0, None, 'Тверь', 0, "город", 0)
+    with timed('exit_lookup'):
+        nearest_exit, dist_to_exit = find_nearest_exit_point(dest_lat, dest_lon, locality, delivery_date)
+    if locality and locality.lower() == 'тверь':
+        return Quote(base_cost, dist_to_exit, nearest_exit, locality, 0, "город", rate_per_km)
+    if store is None:
+        store = get_cache_store()
+    cached = None
+    if locality:
+        with timed('cache_lookup'):
+            cache_key, cached = cached_distance(store, locality)
+        count('delivery_cache_lookups_total', result='hit' if cached else 'miss')
+    if cached:
+        if routing_api_key:
+            refresher = get_cache_refresher()
+            if refresher:
+                # Запись отдаётся сразу; посчитанная по прямой или устаревшая уточняется через ORS в фоне
+                refresher.check(store, cache_key, cached, nearest_exit, dest_lat, dest_lon, routing_api_key)
+        total_distance = cached['distance']
+        nearest_exit, dist_to_exit = _cached_exit(cached, nearest_exit, dist_to_exit, dest_lat, dest_lon)
+        return Quote(price_for_distance(base_cost, total_distance, rate_per_km), dist_to_exit, nearest_exit, locality,
+                     total_distance, "кэш", rate_per_km)
+    if locality:
+        # Одновременные промахи по одному пункту ждут один запрос к ORS и одну запись в кэш
+        total_distance, source, warning = await get_single_flight().do(
+            ('route', locality),
+            lambda: _route_and_store(store, locality, nearest_exit, dist_to_exit, dest_lat, dest_lon, routing_api_key))
+    else:
+        total_distance, source, warning = dist_to_exit * ROAD_FACTOR * 2, "haversine", None
+    if warning:
+        if on_warning:
+            on_warning(warning)
+        else:
+            logger.warning(warning)
+    return Quote(price_for_distance(base_cost, total_distance, rate_per_km), dist_to_exit, nearest_exit, locality,
+                 total_distance, source, rate_per_km)
+
+
+def _cached_exit(entry, nearest_exit, dist_to_exit, dest_lat, dest_lon):
+    """
+    Точка выхода, от которой посчитан километраж записи кэша, и расстояние до неё по прямой.
+
+    Матрица ORS (precompute_distances.py) выбирает ближайшую точку по дороге,
+    она может не совпадать с ближайшей по прямой. Точки записи нет среди
+    текущих (точки выхода сменились) — ближайшая по прямой, как без кэша.
+    """
+    exit_point = entry.get('exit_point')
+    if not exit_point or list(exit_point) not in get_reference_data().exit_points:
+        return nearest_exit, dist_to_exit
+    exit_point = list(exit_point)
+    return exit_point, haversine(dest_lat, dest_lon, exit_point[1], exit_point[0])
+
+
+async def _route_and_store(store, locality, nearest_exit, dist_to_exit, dest_lat, dest_lon, routing_api_key):
+    """
+    Расстояние туда-обратно для пункта не из кэша: (км, источник, предупреждение или None).
+
+    Порядок: ORS (если есть ключ и ROUTING_BACKEND не graph), дорожный граф
+    (если задан ROAD_GRAPH), расстояние по прямой × ROAD_FACTOR.
+    """
+    # Пока ждали очереди, запись мог сделать другой процесс
+    _, cached = cached_distance(store, locality)
+    if cached:
+        return cached['distance'], "кэш", None
+    source = "haversine"
+    ors_error = None
+    road_distance = dist_to_exit * ROAD_FACTOR
+    if routing_api_key and os.environ.get('ROUTING_BACKEND', 'ors') != 'graph':
+        try:
+            with timed('ors'):
+                road_distance = await get_road_distance_ors(nearest_exit[0], nearest_exit[1], dest_lon, dest_lat,
+                                                            routing_api_key)
+            source = "ors"
+            count('delivery_ors_requests_total', result='ok')
+        except ValueError as e:
+            count('delivery_ors_requests_total', result='error')
+            ors_error = e
+    if source == "haversine" and get_road_graph():
+        try:
+            with timed('graph'):
+                road_distance = await get_road_distance_graph(nearest_exit[0], nearest_exit[1], dest_lon, dest_lat)
+            source = ROAD_GRAPH_SOURCE
+        except ValueError as e:
+            logger.info(f"Дорожный граф: {e}")
+    warning = None
+    if ors_error:
+        fallback = ("локальный дорожный граф" if source == ROAD_GRAPH_SOURCE
+                    else f"Haversine с коэффициентом {ROAD_FACTOR}")
+        warning = f"Ошибка ORS API: {ors_error}. Используется {fallback}."
+    total_distance = road_distance * 2
+    with timed('cache_save'):
+        store.set(locality, distance_entry(total_distance, nearest_exit, source, (dest_lon, dest_lat)))
+    if not locality.startswith(COORDINATES_PREFIX):
+        get_locality_resolver().add(locality, (dest_lat, dest_lon))
+    return total_distance, source, warning
+
+
+def quote(cargo_size, dest_lat, dest_lon, address, routing_api_key=None, delivery_date=None, use_route_rate=False, **kwargs):
+    """Синхронная обёртка над calculate_delivery_cost для скриптов и воркеров."""
+    return run_sync(calculate_delivery_cost(cargo_size, dest_lat, dest_lon, address, routing_api_key,
+                                            delivery_date, use_route_rate, **kwargs))
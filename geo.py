@@ -0,0 +1,214 @@
+"""
+Геометрические функции: расстояние по сфере и принадлежность точки полигону.
+
+Модуль не зависит от справочных данных, его используют ядро расчёта и индексы.
+"""
+import math
+
+# Радиус Земли, км
+EARTH_RADIUS_KM = 6371.0
+# Длина одного градуса меридиана, км
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+# Функция Haversine
+def haversine(lat1, lon1, lat2, lon2):
+    R = EARTH_RADIUS_KM
+    lat1_rad = math.radians(lat1)
+    lon1_rad = math.radians(lon1)
+    lat2_rad = math.radians(lat2)
+    lon2_rad = math.radians(lon2)
+    dlat = lat2_rad - lat1_rad
+    dlon = lon2_rad - lon1_rad
+    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    distance = R * c
+    return distance
+
+
+# Проверка, находится ли точка внутри полигона (алгоритм ray casting)
+def point_in_polygon(point, polygon):
+    x, y = point
+    n = len(polygon)
+    inside = False
+    p1x, p1y = polygon[0]
+    for i in range(n + 1):
+        p2x, p2y = polygon[i % n]
+        if y > min(p1y, p2y):
+            if y <= max(p1y, p2y):
+                if x <= max(p1x, p2x):
+                    if p1y != p2y:
+                        xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                    if p1x == p2x or x <= xinters:
+                        inside = not inside
+        p1x, p1y = p2x, p2y
+    return inside
+
+
+def haversine_matrix(lats, lons, to_lats, to_lons):
+    """
+    Расстояния (км) от N точек до M точек одним векторным вызовом: массив N×M.
+
+    Формула та же, что в haversine(), поэтому результаты совпадают с
+    поэлементным вызовом с точностью до округления float.
+    """
+    import numpy as np
+
+    lat1 = np.radians(np.asarray(lats, dtype=float))[:, None]
+    lon1 = np.radians(np.asarray(lons, dtype=float))[:, None]
+    lat2 = np.radians(np.asarray(to_lats, dtype=float))[None, :]
+    lon2 = np.radians(np.asarray(to_lons, dtype=float))[None, :]
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def nearest_many(lats, lons, to_lats, to_lons, max_cells=1_000_000):
+    """
+    Для каждой из N точек — индекс ближайшей из M точек и расстояние до неё (км).
+
+    Матрица считается блоками не больше max_cells элементов, чтобы память не
+    росла как N×M.
+    """
+    import numpy as np
+
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    n, m = lats.shape[0], len(to_lats)
+    nearest = np.full(n, -1)
+    distances = np.full(n, np.inf)
+    if m == 0:
+        return nearest, distances
+    step = max(1, max_cells // m)
+    for start in range(0, n, step):
+        block = haversine_matrix(lats[start:start + step], lons[start:start + step], to_lats, to_lons)
+        # argmin берёт первый минимум — как строгое «<» в цикле find_nearest_exit_point
+        block_nearest = block.argmin(axis=1)
+        nearest[start:start + step] = block_nearest
+        distances[start:start + step] = block[np.arange(block.shape[0]), block_nearest]
+    return nearest, distances
+
+
+def geojson_rings(geojson):
+    """Все кольца (внешние и дыры) Polygon/MultiPolygon из FeatureCollection, Feature или геометрии."""
+    rings = []
+    if not geojson:
+        return rings
+    if geojson.get('type') == 'FeatureCollection':
+        geometries = [f.get('geometry') for f in geojson.get('features', [])]
+    elif geojson.get('type') == 'Feature':
+        geometries = [geojson.get('geometry')]
+    else:
+        geometries = [geojson]
+    for geometry in geometries:
+        if not geometry:
+            continue
+        if geometry['type'] == 'Polygon':
+            rings.extend(geometry['coordinates'])
+        elif geometry['type'] == 'MultiPolygon':
+            for polygon in geometry['coordinates']:
+                rings.extend(polygon)
+    return rings
+
+
+class PreparedPolygon:
+    """
+    Полигон (или мультиполигон с дырами), подготовленный для частых проверок.
+
+    Точка сначала проверяется по bounding box, затем по рёбрам только той
+    горизонтальной полосы, в которую попадает её широта. Правило пересечения
+    ребра то же, что в point_in_polygon, а чётность считается по всем
+    кольцам сразу, поэтому дыры и несколько частей учитываются автоматически.
+    Координаты — (lon, lat), как в GeoJSON.
+    """
+
+    def __init__(self, rings, buckets=64):
+        edges = []
+        segments = []
+        for ring in rings:
+            n = len(ring)
+            for i in range(n):
+                (x1, y1), (x2, y2) = ring[i][:2], ring[(i + 1) % n][:2]
+                segments.append((x1, y1, x2, y2))
+                # Горизонтальные рёбра луч никогда не пересекают (как в point_in_polygon)
+                if y1 != y2:
+                    edges.append((x1, y1, x2, y2))
+        self.edges = edges
+        # Все рёбра, включая горизонтальные: по ним видно, какие области задевает граница
+        self.segments = segments
+        if not edges:
+            self.bbox = None
+            return
+        xs = [x for e in edges for x in (e[0], e[2])]
+        ys = [y for e in edges for y in (e[1], e[3])]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+        self.bucket_count = max(1, min(buckets, len(edges)))
+        self.bucket_height = (self.bbox[3] - self.bbox[1]) / self.bucket_count or 1.0
+        self.buckets = [[] for _ in range(self.bucket_count)]
+        for edge in edges:
+            y_min, y_max = min(edge[1], edge[3]), max(edge[1], edge[3])
+            for b in range(self._bucket(y_min), self._bucket(y_max) + 1):
+                self.buckets[b].append(edge)
+        self._arrays = None
+
+    @classmethod
+    def from_geojson(cls, geojson, **kwargs):
+        """Все Polygon/MultiPolygon из FeatureCollection, Feature или геометрии."""
+        return cls(geojson_rings(geojson), **kwargs)
+
+    def __bool__(self):
+        return self.bbox is not None
+
+    def _bucket(self, y):
+        b = int((y - self.bbox[1]) / self.bucket_height)
+        return min(max(b, 0), self.bucket_count - 1)
+
+    def contains(self, lon, lat):
+        if self.bbox is None:
+            return False
+        min_x, min_y, max_x, max_y = self.bbox
+        if not (min_x <= lon <= max_x and min_y < lat <= max_y):
+            return False
+        inside = False
+        for x1, y1, x2, y2 in self.buckets[self._bucket(lat)]:
+            if (y1 < lat <= y2) or (y2 < lat <= y1):
+                if x1 == x2:
+                    crosses = lon <= x1
+                else:
+                    crosses = lon <= (lat - y1) * (x2 - x1) / (y2 - y1) + x1
+                if crosses:
+                    inside = not inside
+        return inside
+
+    def contains_many(self, lons, lats):
+        """Векторная проверка массива точек; возвращает numpy-массив bool."""
+        import numpy as np
+
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        result = np.zeros(lons.shape, dtype=bool)
+        if self.bbox is None or lons.size == 0:
+            return result
+        min_x, min_y, max_x, max_y = self.bbox
+        candidates = np.flatnonzero((lons >= min_x) & (lons <= max_x) & (lats > min_y) & (lats <= max_y))
+        if candidates.size == 0:
+            return result
+        buckets = np.clip(((lats[candidates] - min_y) / self.bucket_height).astype(int), 0, self.bucket_count - 1)
+        arrays = self._bucket_arrays()
+        for b in np.unique(buckets):
+            idx = candidates[buckets == b]
+            x1, y1, x2, y2 = arrays[b]
+            px = lons[idx][:, None]
+            py = lats[idx][:, None]
+            in_span = ((y1 < py) & (py <= y2)) | ((y2 < py) & (py <= y1))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = np.where(x1 == x2, x1, (py - y1) * (x2 - x1) / (y2 - y1) + x1)
+            crossings = np.count_nonzero(in_span & (px <= x_cross), axis=1)
+            result[idx] = crossings % 2 == 1
+        return result
+
+    def _bucket_arrays(self):
+        if self._arrays is None:
+            import numpy as np
+
+            self._arrays = [np.array(bucket, dtype=float).reshape(-1, 4).T for bucket in self.buckets]
+        return self._arrays
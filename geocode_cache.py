@@ -0,0 +1,162 @@
+"""
+Постоянный кэш геокодирования «адрес → координаты».
+
+Ключ — нормализованный адрес: регистр, ё/е, знаки препинания, лишние
+пробелы и распространённые сокращения не различаются, так что
+«Тверь, ул. Советская, 10» и «тверь улица советская 10» — один запрос к
+Яндексу. Записи живут в той же базе SQLite, что и кэш расстояний
+(отдельная таблица), переживают перезапуски, устаревают по TTL и
+вытесняются по давности использования. «Адрес не найден» тоже
+запоминается, но на короткий срок.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from cache_store import CACHE_DB
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 90 * 24 * 3600
+DEFAULT_NEGATIVE_TTL = 24 * 3600
+DEFAULT_MAX_ENTRIES = 50000
+# Время последнего использования обновляется не чаще раза в час
+TOUCH_INTERVAL = 3600
+
+# Результат для адреса, который Яндекс не нашёл
+NOT_FOUND = 'not_found'
+
+_ABBREVIATIONS = {
+    'улица': 'ул', 'проспект': 'пр-т', 'пр': 'пр-т', 'переулок': 'пер', 'бульвар': 'б-р', 'площадь': 'пл',
+    'набережная': 'наб', 'шоссе': 'ш', 'проезд': 'пр-д', 'микрорайон': 'мкр', 'дом': 'д', 'корпус': 'к',
+    'корп': 'к', 'строение': 'стр', 'город': 'г', 'область': 'обл', 'район': 'р-н',
+}
+_PUNCTUATION = re.compile(r'[^\w\s-]+|(?<!\w)-|-(?!\w)')
+
+
+def normalize_address(address):
+    """Ключ кэша: «Тверь, ул. Советская, 10» → «тверь ул советская 10»."""
+    text = _PUNCTUATION.sub(' ', address.lower().replace('ё', 'е'))
+    return ' '.join(_ABBREVIATIONS.get(word, word) for word in text.split())
+
+
+class GeocodeCache:
+    """Кэш геокодирования в SQLite (WAL), отдельное соединение на поток."""
+
+    def __init__(self, path=CACHE_DB, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'expired': 0, 'writes': 0, 'evictions': 0}
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS geocode_cache ('
+            ' address TEXT PRIMARY KEY,'
+            ' lat REAL,'
+            ' lon REAL,'
+            ' created_at REAL NOT NULL,'
+            ' used_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS geocode_cache_used_at ON geocode_cache (used_at)')
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self.local.conn = conn
+        return conn
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get(self, address):
+        """(lat, lon), NOT_FOUND или None, если записи нет или она устарела."""
+        key = normalize_address(address)
+        conn = self._conn()
+        row = conn.execute('SELECT lat, lon, created_at, used_at FROM geocode_cache WHERE address = ?',
+                           (key,)).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        lat, lon, created_at, used_at = row
+        now = time.time()
+        found = lat is not None
+        if now - created_at > (self.ttl if found else self.negative_ttl):
+            self._count('expired')
+            self._count('misses')
+            return None
+        if now - used_at > TOUCH_INTERVAL:
+            with conn:
+                conn.execute('UPDATE geocode_cache SET used_at = ? WHERE address = ?', (now, key))
+        self._count('hits' if found else 'negative_hits')
+        return (lat, lon) if found else NOT_FOUND
+
+    def set(self, address, coords):
+        """Запомнить координаты (lat, lon) или None для «адрес не найден»."""
+        lat, lon = coords if coords else (None, None)
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO geocode_cache (address, lat, lon, created_at, used_at) VALUES (?, ?, ?, ?, ?)',
+                (normalize_address(address), lat, lon, now, now))
+        self._count('writes')
+        # Проверяем размер не на каждую запись: COUNT(*) по большой таблице не бесплатен
+        if self.counters['writes'] % 100 == 1:
+            self.evict()
+
+    def evict(self):
+        """Удалить устаревшие записи и самые давно использованные сверх max_entries."""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            before = conn.total_changes
+            conn.execute('DELETE FROM geocode_cache WHERE (lat IS NOT NULL AND created_at < ?)'
+                         ' OR (lat IS NULL AND created_at < ?)', (now - self.ttl, now - self.negative_ttl))
+            excess = conn.execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute('DELETE FROM geocode_cache WHERE address IN'
+                             ' (SELECT address FROM geocode_cache ORDER BY used_at LIMIT ?)', (excess,))
+            removed = conn.total_changes - before
+        with self.lock:
+            self.counters['evictions'] += removed
+        return removed
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'size': len(self)}
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0]
+
+
+_geocode_cache = None
+_geocode_cache_lock = threading.Lock()
+
+
+def get_geocode_cache():
+    """Кэш геокодирования процесса или None, если он выключен (GEOCODE_CACHE=0)."""
+    global _geocode_cache
+    if os.environ.get('GEOCODE_CACHE', '1') != '1':
+        return None
+    if _geocode_cache is None:
+        with _geocode_cache_lock:
+            if _geocode_cache is None:
+                _geocode_cache = GeocodeCache(
+                    os.environ.get('GEOCODE_CACHE_DB', os.environ.get('CACHE_DB', CACHE_DB)),
+                    ttl=float(os.environ.get('GEOCODE_TTL_DAYS', 90)) * 24 * 3600,
+                    negative_ttl=float(os.environ.get('GEOCODE_NEGATIVE_TTL_HOURS', 24)) * 3600,
+                    max_entries=int(os.environ.get('GEOCODE_CACHE_MAX', DEFAULT_MAX_ENTRIES)))
+    return _geocode_cache
@@ -0,0 +1,193 @@
+"""
+Синхронизация cache.json с репозиторием GitHub.
+
+Вызывается экспортёром кэша в фоне (не чаще интервала экспорта, все
+изменения за интервал уходят одним коммитом), а не на пути расчёта
+стоимости. Рабочее дерево и локальные ветки не трогаются: удалённая ветка
+забирается во временную ссылку, её cache.json объединяется с локальным по
+записям (при расхождении побеждает запись из надёжного источника — ORS, —
+затем более свежая, при равенстве — локальная), и коммит с
+объединённым файлом собирается поверх удалённой ветки и отправляется.
+Конфликтов слияния поэтому не бывает, а если кто-то успел отправить
+коммит раньше, попытка повторяется. Результат объединения пишется
+обратно в cache.json — экспортёр догружает пришедшие записи в хранилище
+и заменяет локальные, которые проиграли удалённым (статус 'replaced').
+"""
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from delivery_core import BASE_DIR, TRUSTED_SOURCES
+from cache_store import load_cache, save_cache
+from metrics import count, timed
+
+DEFAULT_REPO = 'https://github.com/floratvertransport-prog/delivery-calc.git'
+DEFAULT_BRANCH = 'main'
+# Временная ссылка на удалённую ветку (не origin/*, чтобы не мешать обычной работе с репозиторием)
+SYNC_REF = 'refs/cache-sync/remote'
+PUSH_ATTEMPTS = 3
+
+
+def _git(args, cwd, check=True, env=None):
+    return subprocess.run(['git'] + args, check=check, capture_output=True, text=True, cwd=cwd,
+                          env={**os.environ, **env} if env else None)
+
+
+def _mask(text, token):
+    return text.replace(token, '******') if token and text else text
+
+
+def _entry_rank(entry):
+    return entry.get('source') in TRUSTED_SOURCES, entry.get('updated_at') or 0
+
+
+def merge_entries(local, remote):
+    """
+    Объединить два снимка кэша: все ключи обоих. При расхождении — запись из
+    надёжного источника (TRUSTED_SOURCES), затем более свежая по updated_at;
+    при равенстве — локальная, как раньше.
+    """
+    merged = {**remote, **local}
+    for key, remote_entry in remote.items():
+        local_entry = local.get(key)
+        if local_entry is not None and _entry_rank(remote_entry) > _entry_rank(local_entry):
+            merged[key] = remote_entry
+    return merged
+
+
+def _remote_cache(cache_file, cwd):
+    """cache.json из удалённой ветки (пустой словарь, если файла там нет или он битый)."""
+    shown = _git(['show', f'{SYNC_REF}:{cache_file}'], cwd, check=False)
+    if shown.returncode != 0:
+        return {}
+    try:
+        return json.loads(shown.stdout)
+    except ValueError:
+        return {}
+
+
+def _commit_on_remote(cache_file, merged_path, cwd, author):
+    """Коммит поверх удалённой ветки, в котором заменён только cache.json. Вернуть sha."""
+    blob = _git(['hash-object', '-w', merged_path], cwd).stdout.strip()
+    fd, index_path = tempfile.mkstemp(prefix='cache-sync-', suffix='.index')
+    os.close(fd)
+    os.remove(index_path)
+    env = {'GIT_INDEX_FILE': index_path, 'GIT_AUTHOR_NAME': author, 'GIT_COMMITTER_NAME': author,
+           'GIT_AUTHOR_EMAIL': f'{author}@example.com', 'GIT_COMMITTER_EMAIL': f'{author}@example.com'}
+    try:
+        _git(['read-tree', SYNC_REF], cwd, env=env)
+        _git(['update-index', '--add', '--cacheinfo', f'100644,{blob},{cache_file}'], cwd, env=env)
+        tree = _git(['write-tree'], cwd, env=env).stdout.strip()
+        return _git(['commit-tree', tree, '-p', SYNC_REF, '-m', 'Update cache.json'], cwd, env=env).stdout.strip()
+    finally:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+
+def sync_cache_file(cache_file='cache.json', cwd=BASE_DIR):
+    """
+    Объединить cache.json с удалённой веткой и отправить изменения.
+
+    Вернуть словарь статусов (ключи git_*_status, как раньше), плюс
+    merged_remote — сколько записей пришло из удалённой ветки — и commit.
+    """
+    status = {}
+    cache_path = os.path.join(cwd, cache_file)
+    cache_file = os.path.relpath(cache_path, cwd)
+    git_repo = os.environ.get('GIT_REPO', DEFAULT_REPO)
+    git_token = os.environ.get('GIT_TOKEN')
+    branch = os.environ.get('GIT_BRANCH', DEFAULT_BRANCH)
+    author = os.environ.get('GIT_USER', 'floratvertransport-prog')
+    if git_token:
+        git_repo = git_repo.replace('https://', f'https://{git_token}@')
+    status['git_remote_status'] = f"Git remote: {_mask(git_repo, git_token)} ({branch})"
+    try:
+        if not os.path.exists(os.path.join(cwd, '.git')):
+            _git(['init'], cwd)
+        for attempt in range(1, PUSH_ATTEMPTS + 1):
+            try:
+                fetch_result = _git(['fetch', '--no-tags', git_repo, f'+refs/heads/{branch}:{SYNC_REF}'], cwd)
+                status['git_fetch_status'] = f"Git fetch: {_mask(fetch_result.stderr.strip(), git_token) or 'Success'}"
+            except subprocess.CalledProcessError as e:
+                status['git_sync_status'] = f"Ошибка git fetch: {_mask(e.stderr, git_token)}"
+                status['ok'] = False
+                return status
+            local = load_cache(cache_path)
+            remote = _remote_cache(cache_file, cwd)
+            merged = merge_entries(local, remote)
+            status['merged_remote'] = len(merged) - len(local)
+            # Локальные записи, которые заменены удалёнными (например, обновлёнными через ORS):
+            # {ключ: updated_at проигравшей записи}, чтобы не затереть запись, обновлённую после снимка
+            status['replaced'] = {key: entry.get('updated_at') for key, entry in local.items()
+                                  if merged[key] is not entry}
+            if merged != local:
+                save_cache(merged, cache_path)
+            if merged == remote:
+                status['git_sync_status'] = "Нет изменений в cache.json для коммита"
+                status['ok'] = True
+                return status
+            commit = _commit_on_remote(cache_file, cache_path, cwd, author)
+            push = _git(['push', git_repo, f'{commit}:refs/heads/{branch}'], cwd, check=False)
+            if push.returncode == 0:
+                status['commit'] = commit
+                status['git_sync_status'] = (f"Кэш успешно синхронизирован с GitHub: коммит {commit[:8]}, "
+                                             f"записей из удалённой ветки: {status['merged_remote']}")
+                status['ok'] = True
+                return status
+            # Кто-то отправил коммит раньше нас: забираем его и объединяем заново
+            status['git_sync_status'] = f"Ошибка git push (попытка {attempt}): {_mask(push.stderr, git_token)}"
+        status['ok'] = False
+    except subprocess.CalledProcessError as e:
+        status['git_sync_status'] = f"Ошибка синхронизации с GitHub: {e}\nSTDERR: {_mask(e.stderr, git_token)}"
+        status['ok'] = False
+    return status
+
+
+class GitCacheSync:
+    """
+    Синхронизация как on_export для CacheExporter, с состоянием для админ-режима.
+
+    Экспортёр и так объединяет все записи за интервал в один вызов; после
+    ошибки следующая попытка откладывается с экспоненциальной паузой, чтобы
+    недоступный GitHub не дёргался на каждом экспорте.
+    """
+
+    def __init__(self, cwd=BASE_DIR, max_backoff=3600):
+        self.cwd = cwd
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.state = {'runs': 0, 'failures': 0, 'consecutive_failures': 0, 'skipped': 0, 'last_attempt': None,
+                      'last_success': None, 'last_commit': None, 'next_attempt': None, 'running': False}
+
+    def __call__(self, path):
+        with self.lock:
+            now = time.time()
+            if self.state['next_attempt'] and now < self.state['next_attempt']:
+                self.state['skipped'] += 1
+                count('delivery_git_sync_total', result='skipped')
+                return {'git_sync_status': f"Синхронизация отложена после ошибки до "
+                                           f"{time.strftime('%H:%M:%S', time.localtime(self.state['next_attempt']))}",
+                        'ok': False}
+            self.state.update(running=True, last_attempt=now)
+        with timed('git_sync'):
+            status = sync_cache_file(path, self.cwd)
+        count('delivery_git_sync_total', result='ok' if status.get('ok') else 'error')
+        with self.lock:
+            self.state['running'] = False
+            self.state['runs'] += 1
+            if status.get('ok'):
+                self.state.update(consecutive_failures=0, next_attempt=None, last_success=time.time())
+                self.state['last_commit'] = status.get('commit') or self.state['last_commit']
+            else:
+                self.state['failures'] += 1
+                self.state['consecutive_failures'] += 1
+                delay = min(self.max_backoff, 60 * 2 ** (self.state['consecutive_failures'] - 1))
+                self.state['next_attempt'] = time.time() + delay
+        return status
+
+    def stats(self):
+        with self.lock:
+            return dict(self.state)
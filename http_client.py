@@ -0,0 +1,206 @@
+"""
+Общий асинхронный HTTP-слой для ORS и Яндекс Геокодера.
+
+Одна aiohttp.ClientSession с пулом соединений и keep-alive на каждый цикл
+событий, ограничение числа одновременных запросов и token bucket по каждому
+провайдеру, таймауты и повтор с экспоненциальной задержкой на 429/5xx и
+сетевых ошибках.
+
+Streamlit вызывает расчёт из синхронного кода, поэтому для него есть
+run_sync(): корутина выполняется в постоянном фоновом цикле событий, и сессия
+(вместе с TLS-соединениями) переживает повторные запуски скрипта.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+import aiohttp
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class ProviderConfig:
+    name: str
+    max_concurrency: int
+    rate_per_sec: float
+    burst: int
+    timeout: float
+    retries: int = 3
+    backoff: float = 0.5
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+# Квоты по умолчанию: ORS free — 40 запросов/мин на directions и matrix,
+# Яндекс Геокодер — ограничение на RPS; переопределяются переменными окружения.
+PROVIDERS = {
+    'ors': ProviderConfig('ors', max_concurrency=int(_env_float('ORS_MAX_CONCURRENCY', 4)),
+                          rate_per_sec=_env_float('ORS_RATE_PER_MIN', 40) / 60, burst=5,
+                          timeout=_env_float('ORS_TIMEOUT', 15)),
+    'ors_matrix': ProviderConfig('ors_matrix', max_concurrency=2,
+                                 rate_per_sec=_env_float('ORS_MATRIX_RATE_PER_MIN', 40) / 60, burst=2,
+                                 timeout=_env_float('ORS_MATRIX_TIMEOUT', 60)),
+    'yandex': ProviderConfig('yandex', max_concurrency=int(_env_float('YANDEX_MAX_CONCURRENCY', 8)),
+                             rate_per_sec=_env_float('YANDEX_RATE_PER_SEC', 10), burst=10,
+                             timeout=_env_float('YANDEX_TIMEOUT', 10)),
+    'default': ProviderConfig('default', max_concurrency=4, rate_per_sec=10, burst=10, timeout=10, retries=1),
+}
+
+
+class HttpError(Exception):
+    """Запрос не удался после всех повторов."""
+
+    def __init__(self, message, status=None, data=None):
+        super().__init__(message)
+        self.status = status
+        self.data = data
+
+
+class TokenBucket:
+    """Token bucket: не более rate запросов в секунду со всплеском до capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _ProviderLimits:
+    def __init__(self, config):
+        self.config = config
+        self.semaphore = asyncio.Semaphore(config.max_concurrency)
+        self.bucket = TokenBucket(config.rate_per_sec, config.burst)
+
+
+class HttpClient:
+    """HTTP-клиент одного цикла событий: общая сессия и лимиты провайдеров."""
+
+    def __init__(self, providers=None):
+        self.providers = providers or PROVIDERS
+        self.session = None
+        self.limits = {}
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0}
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=50, limit_per_host=20, keepalive_timeout=60, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    def _limits(self, provider):
+        if provider not in self.limits:
+            self.limits[provider] = _ProviderLimits(self.providers.get(provider, self.providers['default']))
+        return self.limits[provider]
+
+    async def request_json(self, provider, method, url, **kwargs):
+        """
+        Выполнить запрос с лимитами провайдера и повторами. Вернуть (status, json).
+
+        Ответы 429/5xx и сетевые ошибки повторяются; прочие статусы возвращаются
+        вызывающему коду как есть. После исчерпания повторов — HttpError.
+        """
+        limits = self._limits(provider)
+        config = limits.config
+        session = await self.get_session()
+        timeout = aiohttp.ClientTimeout(total=config.timeout)
+        last_error = None
+        for attempt in range(config.retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+                delay = config.backoff * (2 ** (attempt - 1)) * (1 + random.random())
+                retry_after = getattr(last_error, 'retry_after', None)
+                await asyncio.sleep(max(delay, retry_after or 0))
+            await limits.bucket.acquire()
+            async with limits.semaphore:
+                self.stats['requests'] += 1
+                try:
+                    async with session.request(method, url, timeout=timeout, **kwargs) as response:
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError:
+                            data = None
+                        if response.status not in RETRY_STATUSES:
+                            return response.status, data
+                        last_error = HttpError(f"{config.name}: HTTP {response.status}", response.status, data)
+                        try:
+                            last_error.retry_after = float(response.headers.get('Retry-After', 0))
+                        except ValueError:
+                            pass
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    last_error = HttpError(f"{config.name}: {type(e).__name__}: {e}")
+        self.stats['errors'] += 1
+        raise last_error
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client():
+    """HTTP-клиент текущего цикла событий (сессии aiohttp привязаны к циклу)."""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        client = _clients.get(loop)
+        if client is None:
+            # Клиенты завершённых циклов (asyncio.run в CLI) больше не нужны
+            for old_loop in [l for l in _clients if l.is_closed()]:
+                del _clients[old_loop]
+            client = _clients[loop] = HttpClient()
+    return client
+
+
+async def close_client():
+    """Закрыть сессию клиента текущего цикла (вызывать перед выходом из asyncio.run)."""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        client = _clients.pop(loop, None)
+    if client is not None:
+        await client.close()
+
+
+# ----------------------------
+# Фоновый цикл событий для синхронного кода
+# ----------------------------
+_background_loop = None
+_background_lock = threading.Lock()
+
+
+def get_background_loop():
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None or _background_loop.is_closed():
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='http-loop', daemon=True).start()
+    return _background_loop
+
+
+def run_sync(coro, timeout=None):
+    """Выполнить корутину в общем фоновом цикле и дождаться результата."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+    return future.result(timeout)
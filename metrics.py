@@ -0,0 +1,387 @@
+"""
+Метрики и трассировка этапов расчёта стоимости.
+
+Каждый этап (разбор координат, геокодирование, проверка полигона, поиск
+точки выхода, кэш, ORS, запись в кэш, фоновое обновление кэша, синхронизация
+с GitHub, пересборка справочных данных) замеряется через timed(): время
+попадает в гистограмму процесса, а если расчёт идёт внутри trace() — ещё и в список этапов текущего расчёта (для админ-режима).
+Трасса — contextvar, поэтому она доходит и до корутин в фоновом цикле
+(run_sync копирует контекст вызывающего потока).
+
+Метрики отдаются в текстовом формате Prometheus: GET /metrics у API-сервера
+или start_metrics_server(port) рядом со Streamlit. У каждого процесса свои
+метрики в памяти. Воркеры API делят один порт (SO_REUSEPORT), и сборщик
+попадает в случайный из них, поэтому при нескольких воркерах каждый раз в
+EXPORT_INTERVAL секунд пишет свои счётчики в общий каталог
+(start_multiprocess), а /metrics любого воркера отдаёт их сумму по всем
+процессам (render_metrics).
+
+Пример:
+    with trace() as stages:
+        with timed('geocode'):
+            ...
+    stages  # [('geocode', 0.12)]
+"""
+import bisect
+import contextvars
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды: от микросекундных этапов до запросов к ORS
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Как часто воркер пишет свои метрики в общий каталог, секунды
+EXPORT_INTERVAL = 5
+
+# Описания метрик для # HELP
+HELP = {
+    'delivery_stage_duration_seconds': "Время этапа расчёта стоимости",
+    'delivery_quote_duration_seconds': "Время расчёта стоимости целиком по источнику расстояния",
+    'delivery_quotes_total': "Рассчитанные стоимости по источнику расстояния",
+    'delivery_quote_errors_total': "Заказы, которые не удалось рассчитать",
+    'delivery_cache_lookups_total': "Обращения к кэшу расстояний",
+    'delivery_cache_refresh_total': "Фоновые пересчёты устаревших записей кэша по причине и результату",
+    'delivery_geocode_total': "Геокодирование адресов по результату",
+    'delivery_ors_requests_total': "Запросы маршрута к ORS по результату",
+    'delivery_git_sync_total': "Синхронизации cache.json с GitHub по результату",
+    'delivery_reference_reloads_total': "Замены справочных данных на лету по результату",
+}
+
+
+class Histogram:
+    """Кумулятивная гистограмма в духе Prometheus: счётчики корзин, сумма и число наблюдений."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """(счётчики корзин, сумма, число наблюдений) на один момент."""
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины (как histogram_quantile)."""
+        counts, _, total = self.snapshot()
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """Счётчики и гистограммы процесса; метки — кортеж пар (имя, значение)."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, labels=()):
+        """Гистограмма name с метками labels (создаётся при первом обращении)."""
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, name, value, labels=()):
+        self.histogram(name, labels).observe(value)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus (exposition format 0.0.4)."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        histograms = [(key, *histogram.snapshot()) for key, histogram in histograms]
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        for (name, labels), counts, total, count in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def state(self):
+        """Счётчики и гистограммы процесса в виде, пригодном для JSON (см. merge_state)."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in counters],
+            'histograms': [[name, labels, *histogram.snapshot()] for (name, labels), histogram in histograms],
+        }
+
+    def merge_state(self, state):
+        """Прибавить к реестру метрики другого процесса (результат state(), в том числе прочитанный из JSON)."""
+        for name, labels, value in state['counters']:
+            self.inc(name, tuple(tuple(pair) for pair in labels), value)
+        for name, labels, counts, total, count in state['histograms']:
+            histogram = self.histogram(name, tuple(tuple(pair) for pair in labels))
+            with histogram.lock:
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+    def summary(self, name):
+        """{значение первой метки: {count, mean, p50, p95, p99}} гистограммы name — для админ-панели (секунды)."""
+        with self.lock:
+            items = sorted((labels, h) for (n, labels), h in self.histograms.items() if n == name)
+        summary = {}
+        for labels, histogram in items:
+            _, total, count = histogram.snapshot()
+            summary[labels[0][1] if labels else ''] = {
+                'count': count, 'mean': total / count if count else None,
+                'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95), 'p99': histogram.quantile(0.99),
+            }
+        return summary
+
+    def counter_values(self, name):
+        """{кортеж меток → значение} счётчика name."""
+        with self.lock:
+            return {labels: value for (n, labels), value in sorted(self.counters.items()) if n == name}
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Реестр метрик процесса (создаётся при первом обращении)."""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = MetricsRegistry()
+    return _metrics
+
+
+# ----------------------------
+# Несколько процессов
+# ----------------------------
+_multiprocess_dir = None
+
+
+def _write_state(directory):
+    """Записать метрики процесса в каталог атомарно (файл на процесс)."""
+    path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(get_metrics().state(), f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def clear_multiprocess_dir(directory):
+    """Удалить метрики прошлого запуска (вызывается один раз до старта воркеров)."""
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        os.remove(path)
+
+
+def start_multiprocess(directory, interval=EXPORT_INTERVAL):
+    """
+    Писать метрики процесса в общий каталог раз в interval секунд; render_metrics()
+    после этого отдаёт сумму по всем процессам каталога. Файлы завершившихся
+    процессов остаются: их счётчики входят в сумму, и она не убывает.
+    """
+    global _multiprocess_dir
+    _multiprocess_dir = directory
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                _write_state(directory)
+            except OSError as e:
+                logger.warning(f"Не удалось записать метрики в {directory}: {e}")
+
+    threading.Thread(target=run, name='metrics-export', daemon=True).start()
+
+
+def render_metrics():
+    """Метрики в формате Prometheus: процесса или, после start_multiprocess, сумма по всем процессам."""
+    directory = _multiprocess_dir
+    if directory is None:
+        return get_metrics().render()
+    # Свои метрики — на момент запроса, остальных процессов — не старше interval
+    _write_state(directory)
+    total = MetricsRegistry()
+    for path in sorted(glob.glob(os.path.join(directory, 'metrics-*.json'))):
+        try:
+            with open(path) as f:
+                total.merge_state(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Метрики {path} не прочитаны: {e}")
+    return total.render()
+
+
+# ----------------------------
+# Трассировка этапов
+# ----------------------------
+_current_trace = contextvars.ContextVar('quote_trace', default=None)
+
+
+@contextmanager
+def trace(stages=None):
+    """
+    Собрать этапы расчёта внутри блока: список (этап, секунды) в порядке завершения.
+
+    stages — продолжить уже начатый список (расчёт из нескольких шагов).
+    """
+    stages = [] if stages is None else stages
+    token = _current_trace.set(stages)
+    try:
+        yield stages
+    finally:
+        _current_trace.reset(token)
+
+
+# Этап → гистограмма реестра процесса: замер не ищет её по составному ключу каждый раз
+_stage_histograms = {}
+
+
+class timed:
+    """Контекстный менеджер замера этапа: гистограмма delivery_stage_duration_seconds и текущая трасса."""
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        histogram = _stage_histograms.get(self.stage)
+        if histogram is None:
+            histogram = _stage_histograms[self.stage] = get_metrics().histogram(
+                'delivery_stage_duration_seconds', (('stage', self.stage),))
+        histogram.observe(elapsed)
+        stages = _current_trace.get()
+        if stages is not None:
+            stages.append((self.stage, elapsed))
+        return False
+
+
+def count(name, **labels):
+    """Увеличить счётчик name с метками labels."""
+    get_metrics().inc(name, tuple(sorted(labels.items())))
+
+
+def observe_quote(source, elapsed):
+    """Учесть завершённый расчёт: счётчик и гистограмма по источнику расстояния."""
+    metrics = get_metrics()
+    labels = (('source', source),)
+    metrics.inc('delivery_quotes_total', labels)
+    metrics.observe('delivery_quote_duration_seconds', elapsed, labels)
+    stages = _current_trace.get()
+    if stages is not None:
+        stages.append(('total', elapsed))
+
+
+# ----------------------------
+# HTTP-эндпоинт для Streamlit
+# ----------------------------
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """Отдавать /metrics на отдельном порту в фоновом потоке (один раз на процесс)."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                logger.warning(f"Не удалось открыть порт метрик {port}: {e}")
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+            logger.info(f"Метрики: http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,223 @@
+"""
+Предрасчёт расстояний «точка выхода → населённый пункт» через ORS /matrix.
+
+Берёт все точки выхода и все известные населённые пункты (остановки рейсов из
+routes.json и словари без рейсов), запрашивает матрицу расстояний по дорогам
+пачками и заполняет кэш расстояний заранее. Для каждого пункта выбирается
+ближайшая по дороге точка выхода, а не ближайшая по прямой. Одноимённые
+пункты в разных местах и остановки без населённого пункта не предрасчитываются.
+
+Пример:
+    ORS_API_KEY=... python precompute_distances.py --matrix-out matrix.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+from collections import defaultdict
+
+from delivery_core import (
+    ORS_BASE_URL,
+    distance_entry,
+    find_nearest_exit_point,
+    get_cache_store,
+    get_reference_data,
+    no_route_localities_point_7,
+    no_route_localities_point_8,
+    stale_reason,
+)
+from geo import haversine
+from http_client import HttpError, close_client, get_client
+from spatial_index import bare_name
+
+ORS_MATRIX_URL = f"{ORS_BASE_URL}/v2/matrix/driving-car"
+# Публичный ORS ограничивает матрицу 3500 парами; 8 точек выхода × 50 пунктов с запасом
+DEFAULT_CHUNK = 50
+# Точки одного названия ближе этого (км) — один и тот же пункт
+SAME_PLACE_KM = 1.0
+NON_LOCALITY_STOP = re.compile(r'\[|\d')
+
+
+def locality_points(reference=None):
+    """Словарь {название: множество (lon, lat)} всех населённых пунктов из справочников."""
+    reference = reference or get_reference_data()
+    points = defaultdict(set)
+    for day_routes in reference.route_groups.values():
+        for stops in day_routes.values():
+            for stop in stops:
+                # Остановки без населённого пункта («Дорога по направлению рейса [...]», номер трассы) — не пункты
+                if stop.get('coords') and not NON_LOCALITY_STOP.search(stop['name']):
+                    points[stop['name']].add(tuple(stop['coords']))
+    for name, (lat, lon) in {**no_route_localities_point_8, **no_route_localities_point_7}.items():
+        points[name].add((lon, lat))
+    return dict(points)
+
+
+def _spread(points):
+    return max(haversine(a[1], a[0], b[1], b[0]) for a in points for b in points)
+
+
+def known_localities(reference=None):
+    """
+    Словарь {название: (lon, lat)} населённых пунктов для предрасчёта.
+
+    Одноимённые пункты в разных местах (точки дальше SAME_PLACE_KM друг от
+    друга) пропускаются: расстояние до одного из них записалось бы в кэш
+    надёжной записью для всех.
+    """
+    return {name: min(points) for name, points in locality_points(reference).items()
+            if _spread(points) <= SAME_PLACE_KM}
+
+
+def shared_bare_names(names):
+    """Названия без типа, общие для нескольких пунктов («деревня Раменье» и «село Раменье»)."""
+    full_names = defaultdict(set)
+    for name in names:
+        full_names[bare_name(name)].add(name)
+    return {bare for bare, group in full_names.items() if len(group) > 1}
+
+
+async def fetch_matrix_chunk(exit_points, destinations, api_key):
+    """Расстояния (км) от каждой точки выхода до каждого пункта пачки: [exit][dest]."""
+    locations = [list(p) for p in exit_points] + [list(d) for d in destinations]
+    body = {
+        "locations": locations,
+        "sources": list(range(len(exit_points))),
+        "destinations": list(range(len(exit_points), len(locations))),
+        "metrics": ["distance"],
+        "units": "km",
+    }
+    headers = {"Authorization": api_key, "Content-Type": "application/json"}
+    try:
+        status, data = await get_client().request_json('ors_matrix', 'POST', ORS_MATRIX_URL, json=body, headers=headers)
+    except HttpError as e:
+        raise ValueError(f"Ошибка соединения с ORS API: {e}")
+    if status != 200:
+        error = (data or {}).get("error", {})
+        message = error.get("message", error) if isinstance(error, dict) else error
+        raise ValueError(f"Ошибка ORS matrix: HTTP {status}. Сообщение: {message}")
+    return data["distances"]
+
+
+async def compute_matrix(localities, exit_points, api_key, chunk=DEFAULT_CHUNK):
+    """Вернуть {название: [расстояние до точки выхода i или None]} для всех пунктов."""
+    names = list(localities)
+    chunks = [names[i:i + chunk] for i in range(0, len(names), chunk)]
+    results = await asyncio.gather(*[
+        fetch_matrix_chunk(exit_points, [localities[n] for n in part], api_key) for part in chunks
+    ])
+    matrix = {}
+    for part, distances in zip(chunks, results):
+        for j, name in enumerate(part):
+            matrix[name] = [row[j] for row in distances]
+    return matrix
+
+
+def road_nearest(distances, exit_points):
+    """Ближайшая по дороге точка выхода: (индекс, расстояние) или (None, None)."""
+    candidates = [(d, i) for i, d in enumerate(distances) if d is not None]
+    if not candidates:
+        return None, None
+    distance, index = min(candidates)
+    return index, distance
+
+
+def fill_cache(store, matrix, localities, exit_points, overwrite=False):
+    """
+    Записать в хранилище кэша расстояния туда-обратно. Вернуть список изменённых ключей.
+
+    Без overwrite заменяются только устаревшие записи (по прямой, прежнего
+    формата, от других точек выхода). Название без типа пишется ещё одним
+    ключом, только если оно не общее для нескольких пунктов.
+    """
+    reference = get_reference_data()
+    shared = shared_bare_names(locality_points(reference))
+    updated = []
+    for name, distances in matrix.items():
+        index, distance = road_nearest(distances, exit_points)
+        if index is None:
+            continue
+        entry = distance_entry(round(distance * 2, 3), exit_points[index], 'ors_matrix', localities[name])
+        bare = bare_name(name)
+        for key in dict.fromkeys([name] if bare in shared else [name, bare]):
+            current = store.get(key)
+            if overwrite or current is None or stale_reason(current, reference.exit_version):
+                store.set(key, entry)
+                updated.append(key)
+    return updated
+
+
+def matrix_report(matrix, localities, exit_points):
+    """Отчёт: для каждого пункта — ближайшая точка выхода по дороге и по прямой."""
+    report = {}
+    for name, distances in matrix.items():
+        index, distance = road_nearest(distances, exit_points)
+        lon, lat = localities[name]
+        haversine_exit, _ = find_nearest_exit_point(lat, lon, name)
+        report[name] = {
+            'coords': [lon, lat],
+            'distances': distances,
+            'road_nearest_exit': index + 1 if index is not None else None,
+            'road_distance': distance,
+            'haversine_nearest_exit': exit_points.index(haversine_exit) + 1 if haversine_exit in exit_points else None,
+        }
+    return report
+
+
+class _DryRunStore:
+    """Только чтение из хранилища: записи копятся в памяти."""
+
+    def __init__(self, store):
+        self.store = store
+        self.pending = {}
+
+    def get(self, key):
+        return self.pending.get(key) or self.store.get(key)
+
+    def __contains__(self, key):
+        return key in self.pending or key in self.store
+
+    def set(self, key, entry):
+        self.pending[key] = entry
+
+
+async def precompute(api_key, chunk=DEFAULT_CHUNK, overwrite=False, dry_run=False, matrix_out=None):
+    reference = get_reference_data()
+    exit_points = reference.exit_points
+    localities = known_localities(reference)
+    try:
+        matrix = await compute_matrix(localities, exit_points, api_key, chunk)
+    finally:
+        await close_client()
+    store = _DryRunStore(get_cache_store()) if dry_run else get_cache_store()
+    updated = fill_cache(store, matrix, localities, exit_points, overwrite)
+    report = matrix_report(matrix, localities, exit_points)
+    if matrix_out:
+        with open(matrix_out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return updated, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Предрасчёт расстояний до известных населённых пунктов через ORS matrix")
+    parser.add_argument('--chunk', type=int, default=DEFAULT_CHUNK, help="Пунктов назначения в одном запросе")
+    parser.add_argument('--overwrite', action='store_true', help="Перезаписывать существующие записи кэша")
+    parser.add_argument('--dry-run', action='store_true', help="Не записывать в хранилище кэша")
+    parser.add_argument('--matrix-out', help="Сохранить полную матрицу и ближайшие точки выхода в JSON")
+    args = parser.parse_args(argv)
+
+    api_key = os.environ.get("ORS_API_KEY")
+    if not api_key:
+        print("Ошибка: ORS_API_KEY не настроен", file=sys.stderr)
+        return 2
+    updated, report = asyncio.run(precompute(api_key, args.chunk, args.overwrite, args.dry_run, args.matrix_out))
+    mismatched = sum(1 for r in report.values() if r['road_nearest_exit'] != r['haversine_nearest_exit'])
+    print(f"Пунктов: {len(report)}, записей кэша обновлено: {len(updated)}, "
+          f"ближайшая по дороге точка выхода отличается от ближайшей по прямой: {mismatched}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Версии справочных данных и их замена на лету, без перезапуска процесса.
+
+Реестр хранит текущую версию справочных данных — объект со всеми
+производными индексами (граница Твери, точки выхода, календарь рейсов,
+сетка зон, словарь населённых пунктов). Наблюдатель в фоновом потоке раз в
+REFERENCE_RELOAD_INTERVAL секунд сверяет размер и mtime исходных файлов
+(routes.json, tver_boundaries.geojson, route_calendar.json) и при изменении
+собирает новую версию целиком, включая индексы, после чего подменяет одну
+ссылку. Расчёт стоимости только читает эту ссылку: разбора файлов и
+построения индексов на пути расчёта нет, а начатый расчёт дочитывает ту
+версию, с которой начал (см. pinned_reference в delivery_core).
+
+Версия с ошибками загрузки (файл дописывается, битый JSON) не заменяет
+рабочую: остаётся прежняя, ошибка видна в stats() и в логе.
+
+Пример:
+    registry = ReferenceRegistry(load_reference_data, [ROUTES_FILE, BOUNDARY_FILE])
+    registry.current                  # первая версия загружается при создании
+    ReferenceWatcher(registry, interval=10).start()
+"""
+import logging
+import threading
+import time
+
+from metrics import count, timed
+from reference_snapshot import source_fingerprint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 10
+# Пауза между замеченным изменением и чтением: файл могут ещё дописывать
+SETTLE_SECONDS = 0.5
+
+
+class ReferenceRegistry:
+    """
+    Текущая версия справочных данных.
+
+    loader() возвращает новую версию (объект с load_errors), prepare(version)
+    достраивает её индексы до замены. Первая версия загружается сразу и без
+    prepare — индексы строятся лениво, как раньше.
+    """
+
+    def __init__(self, loader, paths, prepare=None):
+        self.loader = loader
+        self.paths = list(paths)
+        self.prepare = prepare
+        self.lock = threading.Lock()
+        self.fingerprint = source_fingerprint(*self.paths)
+        self.current = loader()
+        self.generation = 1
+        self.loaded_at = time.time()
+        self.last_error = None
+        self.counters = {'reloads': 0, 'errors': 0}
+
+    def changed(self):
+        return source_fingerprint(*self.paths) != self.fingerprint
+
+    def reload(self, force=False):
+        """Собрать новую версию, если файлы изменились (force — в любом случае). Вернуть True при замене."""
+        with self.lock:
+            fingerprint = source_fingerprint(*self.paths)
+            if not force and fingerprint == self.fingerprint:
+                return False
+            # Следующая проверка сравнивает с этим состоянием, даже если версия не подошла:
+            # битый файл не перечитывается каждые несколько секунд, а ждёт нового сохранения
+            self.fingerprint = fingerprint
+            try:
+                with timed('reference_reload'):
+                    reference = self.loader()
+                    if reference.load_errors:
+                        raise ValueError("; ".join(reference.load_errors))
+                    if self.prepare:
+                        self.prepare(reference)
+            except Exception as e:
+                self.counters['errors'] += 1
+                self.last_error = f"Справочные данные не обновлены, остаётся версия {self.generation}: {e}"
+                count('delivery_reference_reloads_total', result='error')
+                logger.warning(self.last_error)
+                return False
+            # Замена одной ссылкой: расчёты видят либо прежнюю версию целиком, либо новую
+            self.current = reference
+            self.generation += 1
+            self.loaded_at = time.time()
+            self.last_error = None
+            self.counters['reloads'] += 1
+        count('delivery_reference_reloads_total', result='ok')
+        logger.info(f"Справочные данные обновлены: версия {self.generation} ({reference.version})")
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'generation': self.generation, 'version': self.current.version,
+                    'loaded_at': self.loaded_at, 'last_error': self.last_error}
+
+
+class ReferenceWatcher(threading.Thread):
+    """Раз в interval секунд проверяет исходные файлы реестра и пересобирает версию при изменении."""
+
+    def __init__(self, registry, interval=DEFAULT_INTERVAL, settle=SETTLE_SECONDS):
+        super().__init__(name='reference-watcher', daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.settle = settle
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check_once()
+
+    def check_once(self):
+        if not self.registry.changed():
+            return False
+        time.sleep(self.settle)
+        return self.registry.reload()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,322 @@
+"""
+Бинарный снимок справочных данных для быстрого старта процесса.
+
+routes.json и tver_boundaries.geojson компилируются в один файл: JSON-заголовок
+(версия формата, отпечаток исходных файлов, оглавление массивов) и
+выровненные типизированные массивы, которые читаются через mmap без разбора JSON.
+Строки (названия остановок и рейсов, дни, триграммы) лежат в общей таблице
+интернированных строк. Вместе с данными сохраняется готовый индекс
+«населённый пункт → дни и рейсы», поэтому при загрузке он не строится заново.
+
+Снимок пересобирается автоматически, если исходные JSON изменились:
+    python reference_snapshot.py            # собрать/обновить
+    python reference_snapshot.py --check    # только проверить актуальность
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+NAN = float('nan')
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_FILE = os.path.join(BASE_DIR, 'reference.snapshot')
+MAGIC = b'DCREFSN1'
+FORMAT_VERSION = 3
+ALIGN = 16
+
+
+# ----------------------------
+# Формат файла
+# ----------------------------
+def write_arrays(path, header, arrays):
+    """
+    Записать заголовок и массивы атомарно: MAGIC, длина заголовка, JSON,
+    данные с выравниванием. arrays — {имя: array.array}.
+    """
+    toc = {}
+    offset = 0
+    blobs = []
+    for name, values in arrays.items():
+        offset += -offset % ALIGN
+        toc[name] = [values.typecode, len(values), offset]
+        blobs.append((offset, values))
+        offset += len(values) * values.itemsize
+    header_bytes = json.dumps({**header, 'byteorder': sys.byteorder, 'arrays': toc},
+                              ensure_ascii=False).encode('utf-8')
+    data_start = len(MAGIC) + 8 + len(header_bytes)
+    data_start += -data_start % ALIGN
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.reference-', suffix='.snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for start, values in blobs:
+                f.write(b'\0' * (data_start + start - f.tell()))
+                values.tofile(f)
+        # mkstemp создаёт файл только для владельца, а снимок читают и другие пользователи (сервис, cron)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: не снимок справочных данных")
+        (length,) = struct.unpack('<Q', f.read(8))
+        return json.loads(f.read(length).decode('utf-8'))
+
+
+def read_arrays(path):
+    """Заголовок и {имя: memoryview} поверх mmap файла (без копирования, только чтение)."""
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path}: не снимок справочных данных")
+    (length,) = struct.unpack_from('<Q', buffer, len(MAGIC))
+    header_end = len(MAGIC) + 8 + length
+    header = json.loads(buffer[len(MAGIC) + 8:header_end].decode('utf-8'))
+    if header.get('byteorder') != sys.byteorder:
+        raise ValueError(f"{path}: снимок собран на платформе с другим порядком байт")
+    data_start = header_end + -header_end % ALIGN
+    view = memoryview(buffer)
+    arrays = {}
+    for name, (typecode, count, offset) in header['arrays'].items():
+        start = data_start + offset
+        arrays[name] = view[start:start + count * array(typecode).itemsize].cast(typecode)
+    return header, arrays
+
+
+class StringTable:
+    """Интернированные строки: каждая уникальная строка хранится один раз, ссылки — индексы."""
+
+    def __init__(self):
+        self.index = {}
+
+    def __call__(self, text):
+        return self.index.setdefault(text, len(self.index))
+
+    def arrays(self):
+        # Смещения — в символах: при загрузке весь блок декодируется одним вызовом
+        return array('B', ''.join(self.index).encode('utf-8')), _offsets(len(s) for s in self.index)
+
+
+def decode_strings(blob, offsets):
+    text = blob.tobytes().decode('utf-8')
+    bounds = offsets.tolist()
+    return [text[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+def _offsets(lengths):
+    offsets = array('i', [0])
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    return offsets
+
+
+def source_fingerprint(*paths):
+    """[[имя, размер, mtime_ns]] исходных файлов; отсутствующий файл — [имя, None, None]."""
+    fingerprint = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fingerprint.append([os.path.basename(path), st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            fingerprint.append([os.path.basename(path), None, None])
+    return fingerprint
+
+
+def compile_snapshot(routes_file, boundary_file, path=SNAPSHOT_FILE):
+    """Собрать снимок из исходных JSON. Вернуть заголовок."""
+    from delivery_core import reference_version
+    from geo import geojson_rings
+    from spatial_index import LocalityRouteIndex
+
+    fingerprint = source_fingerprint(routes_file, boundary_file)
+    with open(routes_file, 'r', encoding='utf-8') as f:
+        routes = json.load(f)
+    with open(boundary_file, 'r', encoding='utf-8') as f:
+        tver_geojson = json.load(f)
+    exit_points = routes.get('exit_points', [])
+    route_groups = routes.get('route_groups', {})
+    strings = StringTable()
+
+    # Дни и рейсы хранятся отдельно от остановок: пустые дни и рейсы тоже сохраняются
+    days = array('i', (strings(day) for day in route_groups))
+    route_day, route_name, stop_route, stop_name, stop_coords = array('i'), array('i'), array('i'), array('i'), array('d')
+    for day_pos, (day, day_routes) in enumerate(route_groups.items()):
+        for name, stops in day_routes.items():
+            route_day.append(day_pos)
+            route_name.append(strings(name))
+            for stop in stops:
+                stop_route.append(len(route_name) - 1)
+                stop_name.append(strings(stop['name']))
+                stop_coords.extend(stop['coords'] if stop.get('coords') else (NAN, NAN))
+
+    index = LocalityRouteIndex(route_groups)
+    index_names = array('i', (strings(name) for name in index.names))
+    index_entries = array('i')
+    for i, name in enumerate(index.names):
+        for day, day_routes in index.by_name[name].items():
+            for route in day_routes:
+                index_entries.extend((i, day, strings(route)))
+    grams = sorted(index.trigrams)
+    gram_ids = array('i', (strings(g) for g in grams))
+    gram_offsets = _offsets(len(index.trigrams[g]) for g in grams)
+    postings = array('i', (i for g in grams for i in sorted(index.trigrams[g])))
+
+    rings = geojson_rings(tver_geojson)
+    string_blob, string_offsets = strings.arrays()
+    arrays = {
+        'strings': string_blob,
+        'string_offsets': string_offsets,
+        'exit_points': array('d', (c for point in exit_points for c in point[:2])),
+        'days': days,
+        'route_day': route_day,
+        'route_name': route_name,
+        'stop_route': stop_route,
+        'stop_name': stop_name,
+        'stop_coords': stop_coords,
+        'index_names': index_names,
+        'index_entries': index_entries,
+        'grams': gram_ids,
+        'gram_offsets': gram_offsets,
+        'postings': postings,
+        'ring_offsets': _offsets(len(r) for r in rings),
+        'ring_coords': array('d', (c for ring in rings for point in ring for c in point[:2])),
+    }
+    header = {
+        'format': FORMAT_VERSION,
+        'sources': fingerprint,
+        'version': reference_version(exit_points, tver_geojson),
+        # Длина внешнего кольца первой части: ring_coords начинаются с него и для MultiPolygon
+        'first_ring': len(rings[0]) if rings else 0,
+    }
+    write_arrays(path, header, arrays)
+    return header
+
+
+def is_fresh(path, routes_file, boundary_file):
+    try:
+        header = read_header(path)
+    except (OSError, ValueError):
+        return False
+    return (header.get('format') == FORMAT_VERSION
+            and header.get('sources') == source_fingerprint(routes_file, boundary_file))
+
+
+# ----------------------------
+# Загрузка
+# ----------------------------
+def _pairs(values):
+    flat = values.tolist()
+    return [flat[i:i + 2] for i in range(0, len(flat), 2)]
+
+
+class ReferenceSnapshot:
+    """Загруженный снимок: массивы поверх mmap, строки декодируются один раз."""
+
+    def __init__(self, path=SNAPSHOT_FILE):
+        self.path = path
+        self.header, self.arrays = read_arrays(path)
+        self.version = self.header['version']
+        self.strings = decode_strings(self.arrays['strings'], self.arrays['string_offsets'])
+
+    def exit_points(self):
+        return _pairs(self.arrays['exit_points'])
+
+    def route_groups(self):
+        """routes.json['route_groups'] в исходном виде (порядок дней, рейсов и остановок сохранён)."""
+        strings = self.strings
+        days = [{} for _ in self.arrays['days']]
+        routes = []
+        for day_pos, name in zip(self.arrays['route_day'].tolist(), self.arrays['route_name'].tolist()):
+            routes.append(days[day_pos].setdefault(strings[name], []))
+        for route, name, (lon, lat) in zip(self.arrays['stop_route'].tolist(), self.arrays['stop_name'].tolist(),
+                                           _pairs(self.arrays['stop_coords'])):
+            stop = {'name': strings[name]}
+            if lon == lon:  # NaN — у остановки не было координат
+                stop['coords'] = [lon, lat]
+            routes[route].append(stop)
+        return {strings[day]: day_routes for day, day_routes in zip(self.arrays['days'].tolist(), days)}
+
+    def rings(self):
+        offsets = self.arrays['ring_offsets'].tolist()
+        points = _pairs(self.arrays['ring_coords'])
+        return [points[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def first_ring(self):
+        return _pairs(self.arrays['ring_coords'][:2 * self.header['first_ring']])
+
+    def route_index(self, **kwargs):
+        from spatial_index import LocalityRouteIndex
+
+        strings = self.strings
+        names = [strings[i] for i in self.arrays['index_names'].tolist()]
+        by_name = {name: {} for name in names}
+        entries = self.arrays['index_entries'].tolist()
+        for i in range(0, len(entries), 3):
+            name_idx, day, route = entries[i:i + 3]
+            by_name[names[name_idx]].setdefault(day, []).append(strings[route])
+        grams = [strings[i] for i in self.arrays['grams'].tolist()]
+        trigrams = _Postings(grams, self.arrays['gram_offsets'], self.arrays['postings'])
+        return LocalityRouteIndex.from_tables(by_name, names, trigrams, **kwargs)
+
+
+class _Postings:
+    """Триграмма → индексы названий; списки читаются из массивов по требованию."""
+
+    def __init__(self, grams, offsets, postings):
+        self.positions = {gram: i for i, gram in enumerate(grams)}
+        self.offsets = offsets
+        self.postings = postings
+
+    def get(self, gram, default=None):
+        i = self.positions.get(gram)
+        if i is None:
+            return default
+        return set(self.postings[self.offsets[i]:self.offsets[i + 1]].tolist())
+
+    def __len__(self):
+        return len(self.positions)
+
+
+def ensure_snapshot(routes_file, boundary_file, path=SNAPSHOT_FILE):
+    """Загрузить снимок, пересобрав его, если исходные JSON изменились."""
+    if not is_fresh(path, routes_file, boundary_file):
+        compile_snapshot(routes_file, boundary_file, path)
+    return ReferenceSnapshot(path)
+
+
+def main(argv=None):
+    from delivery_core import BOUNDARY_FILE, ROUTES_FILE
+
+    parser = argparse.ArgumentParser(description="Бинарный снимок routes.json и tver_boundaries.geojson")
+    parser.add_argument('--path', default=SNAPSHOT_FILE)
+    parser.add_argument('--check', action='store_true', help="Только проверить, актуален ли снимок")
+    parser.add_argument('--force', action='store_true', help="Пересобрать, даже если снимок актуален")
+    args = parser.parse_args(argv)
+
+    fresh = is_fresh(args.path, ROUTES_FILE, BOUNDARY_FILE)
+    if args.check:
+        print("Снимок актуален" if fresh else "Снимок устарел или отсутствует")
+        return 0 if fresh else 1
+    if fresh and not args.force:
+        print(f"Снимок {args.path} актуален")
+        return 0
+    header = compile_snapshot(ROUTES_FILE, BOUNDARY_FILE, args.path)
+    print(f"Снимок {args.path} собран: версия {header['version']}, {os.path.getsize(args.path)} байт")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,538 @@
+"""
+Локальный дорожный граф области — расстояния по дорогам без ORS, сети и квот.
+
+Граф строится один раз из выгрузки OpenStreetMap (.osm, .osm.gz, .osm.bz2;
+.osm.pbf — при установленном pyosmium). Берутся дороги, по которым проезжает
+легковая машина, цепочки промежуточных точек сворачиваются в рёбра не длиннее
+MAX_SEGMENT_KM, остаётся самая большая связная часть. Граф хранится в
+каталоге массивами CSR (.npy) и открывается через mmap. Вес ребра — время
+проезда по типу дороги (как «быстрейший маршрут» ORS), ответ — длина
+найденного пути в км.
+
+От каждой точки выхода заранее строится дерево кратчайших путей, поэтому
+«точка выхода → пункт» — это привязка пункта к ближайшему узлу и чтение
+массива. Остальные пары считаются A* с оценкой по прямой.
+
+Включение в расчёт: ROAD_GRAPH=<каталог графа>. Граф подстраховывает ORS
+вместо «по прямой × ROAD_FACTOR»; с ROUTING_BACKEND=graph расстояния
+считаются только по графу.
+
+Пример:
+    python road_graph.py build tver-oblast.osm.bz2 --path road_graph
+    python road_graph.py trees --path road_graph     # после изменения точек выхода
+    python road_graph.py route 56.8510,36.0209 57.0490,36.6216
+    python road_graph.py validate                    # сравнение с расстояниями ORS из кэша
+"""
+import argparse
+import bz2
+import gzip
+import heapq
+import json
+import math
+import os
+import sys
+import threading
+import xml.etree.ElementTree as ET
+from array import array
+
+import numpy as np
+
+from geo import haversine, haversine_matrix
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROAD_GRAPH_DIR = os.path.join(BASE_DIR, 'road_graph')
+FORMAT_VERSION = 1
+
+# Скорость по типу дороги, км/ч (если у дороги нет maxspeed)
+SPEEDS = {
+    'motorway': 110, 'trunk': 90, 'primary': 70, 'secondary': 60, 'tertiary': 50,
+    'motorway_link': 60, 'trunk_link': 50, 'primary_link': 40, 'secondary_link': 40, 'tertiary_link': 30,
+    'unclassified': 40, 'residential': 30, 'road': 30, 'living_street': 10, 'service': 15, 'track': 15,
+}
+# Оценка A* делит расстояние по прямой на эту скорость, поэтому быстрее ехать нельзя
+MAX_SPEED = 110
+NO_ACCESS = {'no'}
+# Длинные извилистые дороги режутся на рёбра не длиннее этого, чтобы точку было к чему привязать
+MAX_SEGMENT_KM = 1.0
+# Дальше этого от ближайшего узла точка считается вне графа
+MAX_SNAP_KM = 5.0
+# Ячейка сетки для поиска ближайшего узла, градусы
+GRID_CELL = 0.02
+
+
+# ----------------------------
+# Чтение OSM
+# ----------------------------
+def _parse_maxspeed(value):
+    if not value:
+        return None
+    try:
+        return float(value.split()[0])
+    except ValueError:
+        return None
+
+
+def way_attrs(tags):
+    """(скорость км/ч, направление: 1 — по ходу, -1 — против, 0 — в обе стороны) или None для дорог не для машин."""
+    highway = tags.get('highway')
+    speed = SPEEDS.get(highway)
+    if speed is None or tags.get('area') == 'yes':
+        return None
+    if any(tags.get(key) in NO_ACCESS for key in ('access', 'motor_vehicle', 'motorcar')):
+        return None
+    maxspeed = _parse_maxspeed(tags.get('maxspeed'))
+    if maxspeed:
+        speed = min(maxspeed, MAX_SPEED)
+    oneway = tags.get('oneway')
+    if oneway in ('yes', 'true', '1'):
+        direction = 1
+    elif oneway == '-1':
+        direction = -1
+    elif oneway == 'no':
+        direction = 0
+    else:
+        direction = 1 if tags.get('junction') in ('roundabout', 'circular') or highway == 'motorway' else 0
+    return speed, direction
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_osm_xml(path):
+    """Узлы (ids, lats, lons) и дороги [(refs, скорость, направление)] из OSM XML."""
+    ids, lats, lons = array('q'), array('d'), array('d')
+    ways = []
+    with _open(path) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end':
+                continue
+            if elem.tag == 'node':
+                ids.append(int(elem.get('id')))
+                lats.append(float(elem.get('lat')))
+                lons.append(float(elem.get('lon')))
+                root.clear()
+            elif elem.tag == 'way':
+                attrs = way_attrs({tag.get('k'): tag.get('v') for tag in elem.iter('tag')})
+                if attrs:
+                    ways.append((array('q', (int(nd.get('ref')) for nd in elem.iter('nd'))), *attrs))
+                root.clear()
+            elif elem.tag == 'relation':
+                root.clear()
+    return ids, lats, lons, ways
+
+
+def read_osm_pbf(path):
+    """То же для .osm.pbf через pyosmium (координаты узлов приходят вместе с дорогами)."""
+    try:
+        import osmium
+    except ImportError:
+        raise ValueError("Для .osm.pbf нужен pyosmium (pip install osmium) или выгрузка в .osm/.osm.bz2")
+    ids, lats, lons = array('q'), array('d'), array('d')
+    ways = []
+
+    class Handler(osmium.SimpleHandler):
+        def way(self, way):
+            attrs = way_attrs({tag.k: tag.v for tag in way.tags})
+            if not attrs:
+                return
+            refs = array('q')
+            for node in way.nodes:
+                if not node.location.valid():
+                    return
+                refs.append(node.ref)
+                ids.append(node.ref)
+                lats.append(node.lat)
+                lons.append(node.lon)
+            ways.append((refs, *attrs))
+
+    Handler().apply_file(path, locations=True)
+    return ids, lats, lons, ways
+
+
+def read_osm(path):
+    return read_osm_pbf(path) if path.endswith('.pbf') else read_osm_xml(path)
+
+
+# ----------------------------
+# Построение
+# ----------------------------
+def _segment_lengths(lats, lons):
+    """Длины отрезков ломаной, км (та же формула, что в haversine())."""
+    lat1, lat2 = np.radians(lats[:-1]), np.radians(lats[1:])
+    dlat = lat2 - lat1
+    dlon = np.radians(lons[1:] - lons[:-1])
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * 6371 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def collapse_ways(ids, lats, lons, ways, max_segment=MAX_SEGMENT_KM):
+    """
+    Рёбра графа из дорог: узлы — концы дорог, перекрёстки и точки через каждые max_segment км.
+
+    Вернуть (osm_lat, osm_lon, u, v, длина км, время с): u, v — индексы в
+    отсортированном списке OSM-узлов.
+    """
+    node_ids, first = np.unique(np.frombuffer(ids, dtype=np.int64), return_index=True)
+    node_lats = np.frombuffer(lats, dtype=np.float64)[first]
+    node_lons = np.frombuffer(lons, dtype=np.float64)[first]
+    refs = [np.searchsorted(node_ids, np.frombuffer(way_refs, dtype=np.int64)) for way_refs, _, _ in ways]
+    usage = np.bincount(np.concatenate(refs), minlength=len(node_ids)) if refs else np.zeros(0, dtype=np.int64)
+    junction = (usage > 1).tolist()
+    us, vs, lengths, times = array('q'), array('q'), array('d'), array('d')
+    for positions, (_, speed, direction) in zip(refs, ways):
+        if len(positions) < 2:
+            continue
+        if direction < 0:
+            positions = positions[::-1]
+        segments = _segment_lengths(node_lats[positions], node_lons[positions]).tolist()
+        points = positions.tolist()
+        start, length = points[0], 0.0
+        last = len(points) - 1
+        for k in range(1, len(points)):
+            length += segments[k - 1]
+            node = points[k]
+            if k == last or junction[node] or length >= max_segment:
+                if node != start:
+                    time = length / speed * 3600
+                    pairs = [(start, node), (node, start)] if not direction else [(start, node)]
+                    for a, b in pairs:
+                        us.append(a)
+                        vs.append(b)
+                        lengths.append(length)
+                        times.append(time)
+                start, length = node, 0.0
+    return (node_lats, node_lons, np.frombuffer(us, dtype=np.int64), np.frombuffer(vs, dtype=np.int64),
+            np.frombuffer(lengths, dtype=np.float64), np.frombuffer(times, dtype=np.float64))
+
+
+def largest_component(n, u, v):
+    """Маска узлов самой большой слабо связной компоненты (объединение множеств)."""
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(u.tolist(), v.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[ra] = rb
+    roots = np.array([find(x) for x in range(n)], dtype=np.int64)
+    return roots == np.bincount(roots).argmax()
+
+
+def to_csr(n, u, v, lengths, times):
+    """Рёбра, отсортированные по началу, без параллельных (остаётся быстрейшее): offsets, targets, length, time."""
+    order = np.lexsort((times, v, u))
+    u, v, lengths, times = u[order], v[order], lengths[order], times[order]
+    keep = np.ones(len(u), dtype=bool)
+    keep[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    u, v, lengths, times = u[keep], v[keep], lengths[keep], times[keep]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(u, minlength=n), out=offsets[1:])
+    return offsets, v.astype(np.int32), lengths.astype(np.float32), times.astype(np.float32)
+
+
+def build_road_graph(osm_path, path=ROAD_GRAPH_DIR, max_segment=MAX_SEGMENT_KM, exit_points=None):
+    """Построить граф из выгрузки OSM и сохранить в каталог path. Вернуть meta."""
+    ids, lats, lons, ways = read_osm(osm_path)
+    if not ways:
+        raise ValueError(f"В {osm_path} нет дорог для машин")
+    node_lats, node_lons, u, v, lengths, times = collapse_ways(ids, lats, lons, ways, max_segment)
+    used, inverse = np.unique(np.concatenate([u, v]), return_inverse=True)
+    u, v = inverse[:len(u)], inverse[len(u):]
+    keep_nodes = largest_component(len(used), u, v)
+    remap = np.cumsum(keep_nodes) - 1
+    keep_edges = keep_nodes[u] & keep_nodes[v]
+    u, v = remap[u[keep_edges]], remap[v[keep_edges]]
+    n = int(keep_nodes.sum())
+    offsets, targets, length, time = to_csr(n, u, v, lengths[keep_edges], times[keep_edges])
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'lat.npy'), node_lats[used][keep_nodes])
+    np.save(os.path.join(path, 'lon.npy'), node_lons[used][keep_nodes])
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'targets.npy'), targets)
+    np.save(os.path.join(path, 'length.npy'), length)
+    np.save(os.path.join(path, 'time.npy'), time)
+    meta = {
+        'format': FORMAT_VERSION,
+        'source': os.path.basename(osm_path),
+        'nodes': n,
+        'edges': int(len(targets)),
+        'ways': len(ways),
+        'max_segment_km': max_segment,
+        'speeds': SPEEDS,
+        'exit_points': [],
+    }
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    if exit_points:
+        meta = build_exit_trees(path, exit_points)
+    return meta
+
+
+def build_exit_trees(path, exit_points):
+    """Деревья кратчайших путей от точек выхода: exit_distance.npy [точка][узел], км. Вернуть meta."""
+    graph = RoadGraph(path)
+    rows = []
+    for lon, lat in exit_points:
+        node, _ = graph.nearest_node(lat, lon)
+        rows.append(graph.tree(node))
+    np.save(os.path.join(path, 'exit_distance.npy'), np.array(rows, dtype=np.float32))
+    graph.meta['exit_points'] = [list(p) for p in exit_points]
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(graph.meta, f, ensure_ascii=False, indent=2)
+    return graph.meta
+
+
+# ----------------------------
+# Запросы
+# ----------------------------
+def _array(values, typecode):
+    result = array(typecode)
+    result.frombytes(np.ascontiguousarray(values, dtype={'q': np.int64, 'i': np.int32, 'd': np.float64}[typecode])
+                     .tobytes())
+    return result
+
+
+class RoadGraph:
+    """
+    Загруженный дорожный граф.
+
+    Массивы CSR открываются через mmap; для обхода они один раз
+    переносятся в array (индексация из Python в разы быстрее, чем у numpy).
+    """
+
+    def __init__(self, path=ROAD_GRAPH_DIR):
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат дорожного графа: {self.meta.get('format')}")
+        self.path = path
+        self.lat = np.load(os.path.join(path, 'lat.npy'), mmap_mode='r')
+        self.lon = np.load(os.path.join(path, 'lon.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.targets = np.load(os.path.join(path, 'targets.npy'), mmap_mode='r')
+        self.length = np.load(os.path.join(path, 'length.npy'), mmap_mode='r')
+        self.time = np.load(os.path.join(path, 'time.npy'), mmap_mode='r')
+        trees_path = os.path.join(path, 'exit_distance.npy')
+        self.exit_distance = np.load(trees_path, mmap_mode='r') if os.path.exists(trees_path) else None
+        self.lock = threading.Lock()
+        self._grid = None
+        self._adjacency = None
+        # Узел → строка exit_distance (или дерево, посчитанное на лету)
+        self.trees = {}
+        if self.exit_distance is not None:
+            for row, (lon, lat) in enumerate(self.meta.get('exit_points', [])):
+                self.trees[self.nearest_node(lat, lon)[0]] = self.exit_distance[row]
+
+    def __len__(self):
+        return len(self.lat)
+
+    # Поиск ближайшего узла: узлы отсортированы по ячейке сетки
+    def _cell_keys(self, lats, lons):
+        return np.floor(np.asarray(lats) / GRID_CELL).astype(np.int64) * 100000 + \
+            np.floor(np.asarray(lons) / GRID_CELL).astype(np.int64)
+
+    def _build_grid(self):
+        keys = self._cell_keys(self.lat, self.lon)
+        order = np.argsort(keys, kind='stable')
+        return keys[order], order
+
+    def _window(self, row, col, radius):
+        keys, order = self._grid
+        parts = []
+        for r in range(row - radius, row + radius + 1):
+            lo, hi = np.searchsorted(keys, [r * 100000 + col - radius, r * 100000 + col + radius + 1])
+            if hi > lo:
+                parts.append(order[lo:hi])
+        return np.concatenate(parts) if parts else None
+
+    def nearest_node(self, lat, lon, max_distance=MAX_SNAP_KM):
+        """(узел, расстояние по прямой, км) ближайшего узла; ValueError, если он дальше max_distance."""
+        if self._grid is None:
+            with self.lock:
+                if self._grid is None:
+                    self._grid = self._build_grid()
+        row, col = math.floor(lat / GRID_CELL), math.floor(lon / GRID_CELL)
+        # Кольцо ячеек по долготе шире: на широте Твери градус долготы почти вдвое короче
+        max_radius = int(max_distance / (111.0 * GRID_CELL * max(math.cos(math.radians(lat)), 0.1))) + 1
+        for radius in range(max_radius + 1):
+            if self._window(row, col, radius) is not None:
+                # Ближайший узел может лежать и в следующем кольце
+                candidates = self._window(row, col, radius + 1)
+                distances = haversine_matrix([lat], [lon], self.lat[candidates], self.lon[candidates])[0]
+                best = int(distances.argmin())
+                if distances[best] <= max_distance:
+                    return int(candidates[best]), float(distances[best])
+                break
+        raise ValueError(f"Точка ({lat}, {lon}) дальше {max_distance} км от дорожного графа")
+
+    def _arrays(self):
+        if self._adjacency is None:
+            with self.lock:
+                if self._adjacency is None:
+                    self._adjacency = (_array(self.offsets, 'q'), _array(self.targets, 'i'), _array(self.length, 'd'),
+                                       _array(self.time, 'd'), _array(self.lat, 'd'), _array(self.lon, 'd'))
+        return self._adjacency
+
+    def tree(self, source):
+        """Дейкстра по времени от узла source ко всем: длины быстрейших путей, км (inf — недостижим)."""
+        offsets, targets, lengths, times, _, _ = self._arrays()
+        n = len(offsets) - 1
+        best = [math.inf] * n
+        distance = np.full(n, np.inf)
+        best[source] = 0.0
+        heap = [(0.0, 0.0, source)]
+        while heap:
+            g, length, u = heapq.heappop(heap)
+            if g > best[u]:
+                continue
+            distance[u] = length
+            for k in range(offsets[u], offsets[u + 1]):
+                v = targets[k]
+                candidate = g + times[k]
+                if candidate < best[v]:
+                    best[v] = candidate
+                    heapq.heappush(heap, (candidate, length + lengths[k], v))
+        return distance
+
+    def astar(self, source, target):
+        """Длина быстрейшего пути source → target, км; A* с оценкой «по прямой на MAX_SPEED»."""
+        offsets, targets, lengths, times, lats, lons = self._arrays()
+        target_lat, target_lon = lats[target], lons[target]
+        per_km = 3600 / MAX_SPEED
+
+        def estimate(node):
+            return haversine(lats[node], lons[node], target_lat, target_lon) * per_km
+
+        best = {source: 0.0}
+        heap = [(estimate(source), 0.0, 0.0, source)]
+        while heap:
+            _, g, length, u = heapq.heappop(heap)
+            if u == target:
+                return length
+            if g > best[u]:
+                continue
+            for k in range(offsets[u], offsets[u + 1]):
+                v = targets[k]
+                candidate = g + times[k]
+                if candidate < best.get(v, math.inf):
+                    best[v] = candidate
+                    heapq.heappush(heap, (candidate + estimate(v), candidate, length + lengths[k], v))
+        raise ValueError("Маршрут по дорожному графу не найден")
+
+    def distance(self, start_lon, start_lat, end_lon, end_lat):
+        """
+        Расстояние по дорогам, км (порядок аргументов как у get_road_distance_ors).
+
+        К пути добавляются отрезки по прямой от точек до ближайших узлов.
+        Из точки выхода с готовым деревом ответ — чтение массива, иначе A*.
+        """
+        source, start_snap = self.nearest_node(start_lat, start_lon)
+        target, end_snap = self.nearest_node(end_lat, end_lon)
+        tree = self.trees.get(source)
+        if tree is not None:
+            road = float(tree[target])
+            if math.isinf(road):
+                raise ValueError("Маршрут по дорожному графу не найден")
+        else:
+            road = self.astar(source, target)
+        return road + start_snap + end_snap
+
+
+def load_road_graph(path=ROAD_GRAPH_DIR):
+    return RoadGraph(path)
+
+
+# ----------------------------
+# Проверка по кэшу
+# ----------------------------
+def validate_road_graph(graph, store=None):
+    """Сравнить граф с расстояниями ORS из кэша расстояний (записи с координатами пункта)."""
+    from cache_refresh import entry_coordinates, known_coordinates
+    from delivery_core import get_cache_store
+
+    store = store or get_cache_store()
+    known = known_coordinates()
+    errors, failures, skipped = [], 0, 0
+    for key, entry in store.to_dict().items():
+        coords = entry_coordinates(key, entry, known)
+        if entry.get('source') not in (None, 'ors', 'ors_matrix') or not coords or not entry.get('exit_point'):
+            skipped += 1
+            continue
+        exit_lon, exit_lat = entry['exit_point']
+        try:
+            road = graph.distance(exit_lon, exit_lat, coords[0], coords[1]) * 2
+        except ValueError:
+            failures += 1
+            continue
+        errors.append((road - entry['distance']) / entry['distance'] if entry['distance'] else 0.0)
+    errors = np.array(errors)
+    return {
+        'compared': int(errors.size),
+        'failures': failures,
+        'skipped': skipped,
+        'error_mean_pct': float(errors.mean() * 100) if errors.size else None,
+        'abs_error_median_pct': float(np.median(np.abs(errors)) * 100) if errors.size else None,
+        'abs_error_p95_pct': float(np.percentile(np.abs(errors), 95) * 100) if errors.size else None,
+    }
+
+
+def _point(text):
+    lat, lon = (float(x) for x in text.split(','))
+    return lat, lon
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный дорожный граф для расстояний без ORS")
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help="Построить граф из выгрузки OSM")
+    build.add_argument('osm', help=".osm, .osm.gz, .osm.bz2 или .osm.pbf (нужен pyosmium)")
+    build.add_argument('--path', default=ROAD_GRAPH_DIR)
+    build.add_argument('--max-segment', type=float, default=MAX_SEGMENT_KM, help="Наибольшая длина ребра, км")
+    trees = sub.add_parser('trees', help="Пересчитать деревья от текущих точек выхода")
+    trees.add_argument('--path', default=ROAD_GRAPH_DIR)
+    route = sub.add_parser('route', help="Расстояние между двумя точками")
+    route.add_argument('start', type=_point, help="lat,lon")
+    route.add_argument('end', type=_point, help="lat,lon")
+    route.add_argument('--path', default=ROAD_GRAPH_DIR)
+    validate = sub.add_parser('validate', help="Сравнить с расстояниями ORS из кэша")
+    validate.add_argument('--path', default=ROAD_GRAPH_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command in ('build', 'trees'):
+        from delivery_core import get_reference_data
+
+        exit_points = get_reference_data().exit_points
+        if args.command == 'build':
+            meta = build_road_graph(args.osm, args.path, args.max_segment, exit_points)
+        else:
+            meta = build_exit_trees(args.path, exit_points)
+        print(f"Граф: узлов {meta['nodes']}, рёбер {meta['edges']}, деревьев от точек выхода "
+              f"{len(meta['exit_points'])} → {args.path}")
+        return 0
+    graph = load_road_graph(args.path)
+    if args.command == 'route':
+        (start_lat, start_lon), (end_lat, end_lon) = args.start, args.end
+        try:
+            print(f"{graph.distance(start_lon, start_lat, end_lon, end_lat):.3f} км")
+        except ValueError as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            return 1
+        return 0
+    print(json.dumps(validate_road_graph(graph), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""
+Календарь оптовых рейсов: в какие даты рейс идёт в населённый пункт.
+
+Расписание в routes.json — по дням недели. Календарь добавляет к нему
+праздники (рейсов нет) и периоды блокировки отдельных рейсов или всех
+сразу (ремонт машины, отпуск водителя). Населённые пункты с одинаковым
+набором «день недели → рейсы» делят одну таблицу на год: отсортированные
+даты рейсов и для каждого дня года — индекс ближайшей даты рейса, так что
+«рейс в этот день?» и «ближайшие N дат рейса от даты D» — O(1) (плюс N).
+
+Файл календаря (ROUTE_CALENDAR_FILE, по умолчанию route_calendar.json рядом
+с routes.json) необязателен:
+    {
+      "public_holidays": true,
+      "holidays": ["2026-12-31"],
+      "blackouts": [{"from": "2026-11-02", "to": "2026-11-06", "routes": ["КШ_КЗ_КГ"], "reason": "ремонт"}]
+    }
+Без "routes" блокировка действует на все рейсы. Государственные праздники
+(PUBLIC_HOLIDAYS — только фиксированные даты, без переносов выходных)
+учитываются лишь при "public_holidays": true или ROUTE_PUBLIC_HOLIDAYS=1:
+без настройки календарь совпадает с расписанием routes.json. Перенесённые
+выходные перечисляются в "holidays".
+
+Ближайшие даты рейса для пункта:
+    python route_calendar.py "деревня Даниловское" --from 2026-12-28 -n 5
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import date
+from typing import NamedTuple, Tuple
+
+# Нерабочие праздничные дни РФ (месяц, день) — рейсов в эти дни нет, если праздники включены
+PUBLIC_HOLIDAYS = frozenset([(1, d) for d in range(1, 9)] + [(2, 23), (3, 8), (5, 1), (5, 9), (6, 12), (11, 4)])
+
+WEEKDAY_NAMES = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+# Дальше стольких лет вперёд ближайший рейс не ищем (пункт без рейсов или всё заблокировано)
+MAX_YEARS_AHEAD = 2
+NO_ROUTE = 0xFFFF
+
+
+class RouteDay(NamedTuple):
+    """Дата рейса в населённый пункт и рейсы этого дня."""
+    date: date
+    weekday: str
+    routes: Tuple[str, ...]
+
+
+def _parse_date(value):
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+class Blackout(NamedTuple):
+    start: date
+    end: date
+    routes: frozenset  # пустое множество — все рейсы
+    reason: str = ''
+
+    def blocks(self, day, route):
+        return self.start <= day <= self.end and (not self.routes or route in self.routes)
+
+
+def load_calendar_config(path):
+    """
+    (праздники, блокировки, учитывать ли государственные праздники) из JSON-файла.
+
+    Файла нет — ни праздников, ни блокировок. Государственные праздники
+    включаются ключом "public_holidays" или переменной ROUTE_PUBLIC_HOLIDAYS=1.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+    holidays = {_parse_date(d) for d in config.get('holidays', [])}
+    blackouts = [Blackout(_parse_date(b['from']), _parse_date(b.get('to', b['from'])),
+                          frozenset(b.get('routes') or ()), b.get('reason', ''))
+                 for b in config.get('blackouts', [])]
+    public_holidays = config.get('public_holidays', os.environ.get('ROUTE_PUBLIC_HOLIDAYS') == '1')
+    return holidays, blackouts, public_holidays
+
+
+class _YearTable:
+    """Даты рейсов одного набора «день недели → рейсы» за год и индекс ближайшей даты для каждого дня."""
+
+    __slots__ = ('first', 'dates', 'routes', 'next_index')
+
+    def __init__(self, year, schedule, is_closed, blocked):
+        self.first = date(year, 1, 1).toordinal()
+        days = date(year + 1, 1, 1).toordinal() - self.first
+        self.dates = array('l')
+        self.routes = []
+        self.next_index = array('H', [NO_ROUTE]) * days
+        for offset in range(days):
+            day = date.fromordinal(self.first + offset)
+            day_routes = schedule.get(day.weekday())
+            if not day_routes or is_closed(day):
+                continue
+            open_routes = tuple(r for r in day_routes if not blocked(day, r))
+            if open_routes:
+                self.dates.append(self.first + offset)
+                self.routes.append(open_routes)
+        # Индекс ближайшей даты рейса не раньше каждого дня года (проход с конца)
+        position = len(self.dates)
+        for offset in range(days - 1, -1, -1):
+            if position and self.dates[position - 1] >= self.first + offset:
+                position -= 1
+            self.next_index[offset] = position if position < len(self.dates) else NO_ROUTE
+
+    def route_days(self, start_index, count):
+        return [RouteDay(date.fromordinal(self.dates[i]), WEEKDAY_NAMES[date.fromordinal(self.dates[i]).weekday()],
+                         self.routes[i]) for i in range(start_index, min(len(self.dates), start_index + count))]
+
+
+class RouteCalendar:
+    """
+    Даты рейсов по населённым пунктам с учётом праздников и блокировок.
+
+    route_index — объект с lookup(locality) → {день недели: [рейсы]}
+    (LocalityRouteIndex); таблицы строятся лениво на (набор рейсов, год).
+    """
+
+    def __init__(self, route_index, holidays=(), blackouts=(), public_holidays=False, memo_size=4096):
+        self.route_index = route_index
+        self.holidays = set(holidays)
+        self.public_holidays = public_holidays
+        self.blackouts = list(blackouts)
+        self.tables = {}
+        self.schedules = OrderedDict()
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+
+    def is_holiday(self, day):
+        return day in self.holidays or (self.public_holidays and (day.month, day.day) in PUBLIC_HOLIDAYS)
+
+    def _closed(self, day):
+        return self.is_holiday(day) or any(b.blocks(day, None) for b in self.blackouts if not b.routes)
+
+    def _blocked(self, day, route):
+        return any(b.blocks(day, route) for b in self.blackouts if b.routes)
+
+    def schedule(self, locality):
+        """Набор «день недели → рейсы» населённого пункта в неизменяемом виде (ключ таблиц)."""
+        if not locality:
+            return ()
+        with self.lock:
+            schedule = self.schedules.get(locality)
+            if schedule is not None:
+                self.schedules.move_to_end(locality)
+                return schedule
+        schedule = tuple(sorted((day, tuple(routes)) for day, routes in self.route_index.lookup(locality).items()))
+        with self.lock:
+            self.schedules[locality] = schedule
+            if len(self.schedules) > self.memo_size:
+                self.schedules.popitem(last=False)
+        return schedule
+
+    def _table(self, schedule, year):
+        key = (schedule, year)
+        table = self.tables.get(key)
+        if table is None:
+            table = _YearTable(year, dict(schedule), self._closed, self._blocked)
+            with self.lock:
+                table = self.tables.setdefault(key, table)
+        return table
+
+    def weekdays(self, locality):
+        """Дни недели (0 = понедельник) по расписанию, без учёта праздников."""
+        return {day for day, _ in self.schedule(locality)}
+
+    def routes_on(self, locality, day):
+        """Рейсы в населённый пункт в эту дату (пустой кортеж — рейса нет)."""
+        schedule = self.schedule(locality)
+        if not schedule:
+            return ()
+        table = self._table(schedule, day.year)
+        index = table.next_index[day.toordinal() - table.first]
+        if index == NO_ROUTE or table.dates[index] != day.toordinal():
+            return ()
+        return table.routes[index]
+
+    def runs(self, locality, day):
+        return bool(self.routes_on(locality, day))
+
+    def next_route_days(self, locality, start, count=1):
+        """Ближайшие count дат рейса не раньше start: список RouteDay."""
+        schedule = self.schedule(locality)
+        found = []
+        if not schedule or count <= 0:
+            return found
+        day = start
+        for _ in range(MAX_YEARS_AHEAD + 1):
+            table = self._table(schedule, day.year)
+            index = table.next_index[day.toordinal() - table.first]
+            if index != NO_ROUTE:
+                found.extend(table.route_days(index, count - len(found)))
+                if len(found) >= count:
+                    break
+            day = date(day.year + 1, 1, 1)
+        return found
+
+    def next_route_day(self, locality, start):
+        days = self.next_route_days(locality, start, 1)
+        return days[0] if days else None
+
+    def dates_between(self, locality, start, end):
+        """Все даты рейса в интервале [start, end]."""
+        days = []
+        for route_day in self.next_route_days(locality, start, (end - start).days + 1):
+            if route_day.date > end:
+                break
+            days.append(route_day)
+        return days
+
+
+def main(argv=None):
+    from delivery_core import get_route_calendar
+
+    parser = argparse.ArgumentParser(description="Ближайшие даты оптовых рейсов в населённый пункт")
+    parser.add_argument('locality')
+    parser.add_argument('--from', dest='start', type=date.fromisoformat, default=date.today())
+    parser.add_argument('-n', '--count', type=int, default=5)
+    args = parser.parse_args(argv)
+    calendar = get_route_calendar()
+    route_days = calendar.next_route_days(args.locality, args.start, args.count)
+    if not route_days:
+        print(f"Рейсов в «{args.locality}» нет")
+        return 1
+    for route_day in route_days:
+        print(f"{route_day.date:%d.%m.%Y} {route_day.weekday:<12} {', '.join(route_day.routes)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
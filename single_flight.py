@@ -0,0 +1,58 @@
+"""
+Объединение одновременных одинаковых запросов (single-flight).
+
+Если несколько сессий одновременно считают один и тот же новый населённый
+пункт (или геокодируют один адрес), запрос к ORS/Яндексу и запись в кэш
+выполняет первая, остальные ждут её результат. Все расчёты процесса идут в
+общем фоновом цикле событий (run_sync) или в цикле API-сервера, поэтому
+реестра на цикл достаточно; между процессами гонку записи снимает upsert
+в SQLite.
+"""
+import asyncio
+import threading
+
+
+class SingleFlight:
+    """Ключ → задача в полёте; повторные вызовы с тем же ключом ждут ту же задачу."""
+
+    def __init__(self):
+        self.calls = {}
+        self.stats = {'leaders': 0, 'followers': 0}
+
+    async def do(self, key, factory):
+        """Результат factory() для key; factory вызывается один раз на всех одновременных вызывающих."""
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.stats['leaders'] += 1
+        else:
+            self.stats['followers'] += 1
+        # Отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # Ошибку получат ожидающие; если их не осталось, не пишем «exception was never retrieved»
+            task.exception()
+
+    def __len__(self):
+        return len(self.calls)
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Реестр запросов в полёте текущего цикла событий (задачи привязаны к циклу)."""
+    loop = asyncio.get_running_loop()
+    with _flights_lock:
+        flight = _flights.get(loop)
+        if flight is None:
+            for old_loop in [l for l in _flights if l.is_closed()]:
+                del _flights[old_loop]
+            flight = _flights[loop] = SingleFlight()
+    return flight
@@ -0,0 +1,386 @@
+"""
+Индексы справочных данных, которые строятся один раз при загрузке.
+
+GridIndex — равномерная сетка по широте/долготе: ближайшая точка (по
+haversine) и точки в квадрате допуска без перебора всех точек.
+LocalityRouteIndex — название населённого пункта → дни недели и рейсы,
+в которых он есть.
+LocalityResolver — словарь известных населённых пунктов для извлечения
+пункта из адреса (точное совпадение по нормализованному названию, затем
+поиск с опечатками).
+"""
+import math
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+from geo import KM_PER_DEGREE, haversine
+
+# Типы населённых пунктов, которые пользователи часто не пишут в адресе
+LOCALITY_TYPES = ('посёлок городского типа ', 'посёлок дома отдыха ', 'деревня ', 'село ', 'посёлок ', 'хутор ',
+                  'слобода ', 'станция ', 'населённый пункт ')
+
+
+def bare_name(name):
+    """Название без типа населённого пункта: «деревня Даниловское» → «Даниловское»."""
+    lowered = name.lower().replace('ё', 'е')
+    for prefix in LOCALITY_TYPES:
+        if lowered.startswith(prefix.replace('ё', 'е')):
+            return name[len(prefix):]
+    return name
+
+
+class GridIndex:
+    """
+    Сетка с ячейками cell_size×cell_size градусов над точками (lat, lon).
+
+    nearest() обходит кольца ячеек вокруг точки запроса и останавливается,
+    когда следующее кольцо заведомо дальше найденного кандидата.
+    """
+
+    def __init__(self, points, cell_size=0.05):
+        self.points = [(float(lat), float(lon)) for lat, lon in points]
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        for i, (lat, lon) in enumerate(self.points):
+            self.cells[self._cell(lat, lon)].append(i)
+        if self.cells:
+            rows = [c[0] for c in self.cells]
+            cols = [c[1] for c in self.cells]
+            self.bounds = (min(rows), max(rows), min(cols), max(cols))
+            self.max_abs_lat = max(abs(lat) for lat, _ in self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def _ring(self, ci, cj, k):
+        if k == 0:
+            yield ci, cj
+            return
+        for dj in range(-k, k + 1):
+            yield ci - k, cj + dj
+            yield ci + k, cj + dj
+        for di in range(-k + 1, k):
+            yield ci + di, cj - k
+            yield ci + di, cj + k
+
+    def nearest(self, lat, lon):
+        """Индекс ближайшей точки и расстояние до неё в км; (None, inf) для пустого индекса."""
+        if not self.points:
+            return None, float('inf')
+        ci, cj = self._cell(lat, lon)
+        row_min, row_max, col_min, col_max = self.bounds
+        max_ring = max(abs(ci - row_min), abs(ci - row_max), abs(cj - col_min), abs(cj - col_max))
+        # Нижняя граница расстояния на одну ячейку (по долготе градус короче, берём худшую широту)
+        max_lat = min(89.0, max(abs(lat), self.max_abs_lat) + self.cell_size)
+        km_per_cell = self.cell_size * KM_PER_DEGREE * math.cos(math.radians(max_lat)) * 0.99
+        best = (float('inf'), None)
+        for k in range(max_ring + 1):
+            for cell in self._ring(ci, cj, k):
+                for i in self.cells.get(cell, ()):
+                    p_lat, p_lon = self.points[i]
+                    candidate = (haversine(lat, lon, p_lat, p_lon), i)
+                    if candidate < best:
+                        best = candidate
+            # Всё, что за кольцом k, не ближе k ячеек по одной из осей
+            if best[1] is not None and best[0] <= k * km_per_cell:
+                break
+        return best[1], best[0]
+
+    def within(self, lat, lon, tolerance):
+        """Индексы точек с |Δlat| < tolerance и |Δlon| < tolerance (в градусах), по возрастанию."""
+        reach = math.ceil(tolerance / self.cell_size)
+        ci, cj = self._cell(lat, lon)
+        found = []
+        for di in range(-reach, reach + 1):
+            for dj in range(-reach, reach + 1):
+                for i in self.cells.get((ci + di, cj + dj), ()):
+                    p_lat, p_lon = self.points[i]
+                    if abs(lat - p_lat) < tolerance and abs(lon - p_lon) < tolerance:
+                        found.append(i)
+        return sorted(found)
+
+
+class LocalityRouteIndex:
+    """
+    Название населённого пункта → {день недели: [рейсы]}.
+
+    Семантика прежней проверки сохранена: пункт подходит, если его название
+    (без учёта регистра) содержится в названии остановки. Кандидаты ищутся по
+    триграммному индексу уникальных названий остановок и проверяются
+    подстрокой; ответы запоминаются, так что повторный запрос — O(1).
+    """
+
+    def __init__(self, route_groups, memo_size=4096):
+        self.by_name = {}
+        for day, routes in route_groups.items():
+            for route_name, stops in routes.items():
+                for stop in stops:
+                    days = self.by_name.setdefault(stop["name"].lower(), {})
+                    routes_for_day = days.setdefault(int(day), [])
+                    if route_name not in routes_for_day:
+                        routes_for_day.append(route_name)
+        self.names = list(self.by_name)
+        self.trigrams = defaultdict(set)
+        for i, name in enumerate(self.names):
+            for gram in _trigrams(name):
+                self.trigrams[gram].add(i)
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_tables(cls, by_name, names, trigrams, memo_size=4096):
+        """Индекс из готовых таблиц (см. reference_snapshot.py); trigrams — объект с get(gram, default)."""
+        index = cls.__new__(cls)
+        index.by_name = by_name
+        index.names = names
+        index.trigrams = trigrams
+        index.memo = OrderedDict()
+        index.memo_size = memo_size
+        index.lock = threading.Lock()
+        return index
+
+    def _candidates(self, query):
+        grams = _trigrams(query)
+        if not grams:
+            return range(len(self.names))
+        postings = sorted((self.trigrams.get(gram, set()) for gram in grams), key=len)
+        return sorted(set.intersection(*postings))
+
+    def lookup(self, locality):
+        """{день недели (0 = понедельник): [названия рейсов]} для населённого пункта."""
+        if not locality:
+            return {}
+        query = locality.lower()
+        with self.lock:
+            if query in self.memo:
+                self.memo.move_to_end(query)
+                return self.memo[query]
+        result = {}
+        for i in self._candidates(query):
+            name = self.names[i]
+            if query in name:
+                for day, routes in self.by_name[name].items():
+                    day_routes = result.setdefault(day, [])
+                    day_routes.extend(r for r in routes if r not in day_routes)
+        with self.lock:
+            self.memo[query] = result
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return result
+
+    def weekdays(self, locality):
+        return set(self.lookup(locality))
+
+    def __len__(self):
+        return len(self.by_name)
+
+
+# Слова типа пункта, которые отбрасываются при нормализации («д.», «пгт», «посёлок городского типа»)
+LOCALITY_TYPE_WORDS = {'деревня', 'дер', 'д', 'село', 'с', 'поселок', 'пос', 'п', 'пгт', 'городского', 'типа',
+                       'дома', 'отдыха', 'хутор', 'х', 'слобода', 'сл', 'станция', 'ст', 'населенный', 'пункт',
+                       'нп', 'рп', 'городской', 'рабочий', 'город', 'г'}
+# Слово после названия области/района: «Тверская область», «Калининский р-н»
+REGION_WORDS = {'область', 'обл', 'район', 'р-н', 'край', 'округ', 'россия'}
+# Слово перед улицей и всё, что дальше в этой части адреса: «ул. Центральная, д. 5»
+STREET_WORDS = {'ул', 'улица', 'пр', 'пр-т', 'проспект', 'пер', 'переулок', 'б-р', 'бульвар', 'пл', 'площадь',
+                'наб', 'набережная', 'ш', 'шоссе', 'проезд', 'мкр', 'микрорайон', 'дом', 'корп', 'стр', 'кв',
+                'тупик', 'линия'}
+NON_LOCALITY_WORDS = REGION_WORDS | STREET_WORDS
+_NON_WORD = re.compile(r'[^\w\s-]+|(?<!\w)-|-(?!\w)')
+# Сколько слов подряд проверяется как возможное название
+MAX_NAME_WORDS = 4
+# Совпадение с опечаткой принимается, только если точка адреса не дальше этого от известной точки пункта (км)
+FUZZY_MAX_KM = 3.0
+
+
+def _words(text):
+    return _NON_WORD.sub(' ', text.lower().replace('ё', 'е')).split()
+
+
+def _strip_type(words):
+    start = 0
+    while start < len(words) - 1 and words[start] in LOCALITY_TYPE_WORDS:
+        start += 1
+    return words[start:]
+
+
+def _segments(words):
+    """Куски адреса, где может стоять название пункта: без области/района и без улицы с домом."""
+    segments, current = [], []
+    for word in words:
+        if word in STREET_WORDS:
+            break
+        if word in REGION_WORDS:
+            current = current[:-1]
+            if current:
+                segments.append(current)
+            current = []
+            continue
+        current.append(word)
+    if current:
+        segments.append(current)
+    return segments
+
+
+def normalize_locality(name):
+    """«деревня Алёшино» → «алешино», «д. Сухой Ручей» → «сухой ручей»."""
+    return ' '.join(_strip_type(_words(name)))
+
+
+def _edit_distance(a, b, limit):
+    """Расстояние Левенштейна, если оно не больше limit, иначе limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class LocalityResolver:
+    """
+    Нормализованное название → каноническое название населённого пункта.
+
+    resolve() ищет в адресе подряд идущие слова (до MAX_NAME_WORDS) с точным
+    совпадением в словаре и берёт самое длинное (при равенстве — последнее:
+    пункт в адресе обычно идёт после области и района). Если точных
+    совпадений нет, части адреса сравниваются с названиями по триграммам и
+    расстоянию Левенштейна. Совпадение с опечаткой принимается, только если
+    кандидат единственный (расстояние 1) и точка адреса лежит рядом с
+    известной точкой этого пункта (не дальше FUZZY_MAX_KM): соседние деревни
+    с похожими названиями (Горохово и Горбово) иначе получали бы чужие рейсы
+    и чужой кэш. Названия добавляются в порядке приоритета: первое
+    написание для нормализованного ключа становится каноническим, остальные
+    запоминаются как его варианты (aliases) — например, прежние ключи кэша.
+    """
+
+    def __init__(self, names=(), memo_size=4096):
+        self.canonical = {}
+        self.variants = {}
+        self.points = {}
+        self.keys = []
+        self.trigrams = defaultdict(set)
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+        for name in names:
+            self.add(name)
+
+    def add(self, name, point=None):
+        """
+        Добавить название и, если известна, точку пункта (lat, lon); можно
+        вызывать во время работы из других потоков (множества триграмм
+        заменяются копией, читатели их не видят изменёнными).
+        """
+        key = normalize_locality(name)
+        if not key or any(w in NON_LOCALITY_WORDS for w in key.split()):
+            return
+        with self.lock:
+            if point is not None and tuple(point) not in self.points.get(key, ()):
+                self.points[key] = self.points.get(key, ()) + (tuple(point),)
+            canonical = self.canonical.get(key)
+            if canonical is not None:
+                if name != canonical and name not in self.variants.get(key, ()):
+                    self.variants[key] = self.variants.get(key, ()) + (name,)
+                return
+            self.canonical[key] = name
+            for gram in _trigrams(key):
+                self.trigrams[gram] = self.trigrams[gram] | {len(self.keys)}
+            self.keys.append(key)
+            # Запомненные «не найдено» и нечёткие совпадения могли измениться
+            self.memo.clear()
+
+    def aliases(self, name):
+        """Другие написания того же пункта (без канонического), в порядке добавления."""
+        return self.variants.get(normalize_locality(name), ())
+
+    def _exact(self, parts):
+        best = None
+        position = 0
+        for words in parts:
+            for start in range(len(words)):
+                for end in range(start + 1, min(start + MAX_NAME_WORDS, len(words)) + 1):
+                    key = ' '.join(_strip_type(words[start:end]))
+                    if key in self.canonical:
+                        candidate = (len(key.split()), position + start, key)
+                        if best is None or candidate >= best:
+                            best = candidate
+            position += len(words)
+        return best[2] if best else None
+
+    def _fuzzy(self, parts):
+        """Единственный ключ на расстоянии 1 от какой-либо части адреса, иначе None."""
+        found = set()
+        for words in parts:
+            if any(w.isdigit() for w in words):
+                continue
+            query = ' '.join(_strip_type(words))
+            if len(query) < 4:
+                continue
+            grams = _trigrams(query)
+            counts = defaultdict(int)
+            for gram in grams:
+                for i in self.trigrams.get(gram, ()):
+                    counts[i] += 1
+            for i, shared in counts.items():
+                if shared * 3 >= len(grams) and _edit_distance(query, self.keys[i], 1) <= 1:
+                    found.add(self.keys[i])
+        return found.pop() if len(found) == 1 else None
+
+    def _near(self, key, point):
+        return point is not None and any(haversine(point[0], point[1], lat, lon) <= FUZZY_MAX_KM
+                                         for lat, lon in self.points.get(key, ()))
+
+    def resolve(self, address, point=None):
+        """
+        Каноническое название пункта из адреса или None. point — (lat, lon)
+        адреса; без неё совпадения с опечаткой не принимаются.
+        """
+        parts = [segment for part in address.split(',') for segment in _segments(_words(part))]
+        query = tuple(tuple(words) for words in parts)
+        with self.lock:
+            found = self.memo.get(query)
+            if found is not None:
+                self.memo.move_to_end(query)
+        if found is None:
+            exact = self._exact(parts)
+            found = (exact, None if exact else self._fuzzy(parts))
+            with self.lock:
+                self.memo[query] = found
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        exact, fuzzy = found
+        if exact:
+            return self.canonical[exact]
+        if fuzzy and self._near(fuzzy, point):
+            return self.canonical[fuzzy]
+        return None
+
+    def __contains__(self, name):
+        return normalize_locality(name) in self.canonical
+
+    def __len__(self):
+        return len(self.canonical)
+
+
+def locality_part(address):
+    """Первая часть адреса, похожая на населённый пункт (для пунктов не из словаря), или None."""
+    for part in address.split(','):
+        words = _words(part)
+        if words and not NON_LOCALITY_WORDS.intersection(words) and not any(w.isdigit() for w in words):
+            return part.strip()
+    return None
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
@@ -0,0 +1,397 @@
+"""
+Оценка общих поездок по розничным заказам на день.
+
+Каждый заказ калькулятор считает отдельной поездкой туда-обратно от
+ближайшей точки выхода. Если на один день набирается несколько заказов за
+одну точку выхода, их можно развезти одной машиной. Планировщик группирует
+заказы по (дата, точка выхода), строит матрицу расстояний по дорогам (ORS
+/matrix, при ошибке или без ключа — по прямой × ROAD_FACTOR), строит обход
+ближайшим соседом, улучшает его 2-opt и режет на поездки не длиннее
+max_stops остановок (оптимальное разбиение обхода динамикой). Общий
+километраж поездки делится между заказами пропорционально их отдельным
+поездкам туда-обратно, и для каждого заказа считается стоимость в общей
+поездке и экономия.
+
+Заказы по тарифу рейса едут с оптовым рейсом этого дня (routes.json), заказы
+по городу — без доплаты за километраж; в общие поездки они не попадают.
+
+Пример:
+    API_KEY=... ORS_API_KEY=... python trip_planner.py orders.csv -o plan.csv --max-stops 20
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+from collections import defaultdict
+from datetime import date
+from typing import List, NamedTuple
+
+from batch_quote import INPUT_FIELDS, RESULT_FIELDS, BatchPricer, detect_format, parse_date, read_orders
+from delivery_core import (
+    ROAD_FACTOR,
+    ROUTE_RATE_PER_KM,
+    cargo_prices,
+    find_nearest_exit_point,
+    get_reference_data,
+    get_route_calendar,
+    pinned_reference,
+    price_for_distance,
+)
+from geo import haversine_matrix
+from http_client import close_client
+from precompute_distances import DEFAULT_CHUNK, fetch_matrix_chunk
+
+PLAN_FIELDS = ['trip', 'stop_number', 'trip_distance', 'allocated_distance', 'shared_cost', 'trip_saving']
+DEFAULT_MAX_STOPS = 25
+# Сколько ближайших соседей проверяет 2-opt для каждой остановки
+NEIGHBOURS = 12
+
+
+class Trip(NamedTuple):
+    """Одна поездка: остановки (индексы заказов) в порядке объезда и километраж от точки выхода и обратно."""
+    trip_id: str
+    delivery_date: str
+    exit_index: int
+    orders: List[int]
+    distance: float
+    isolated_distance: float
+
+
+# ----------------------------
+# Матрица расстояний
+# ----------------------------
+def straight_matrix(points):
+    """Матрица «по прямой × ROAD_FACTOR» (км) для точек [lon, lat]."""
+    lons = [p[0] for p in points]
+    lats = [p[1] for p in points]
+    return (haversine_matrix(lats, lons, lats, lons) * ROAD_FACTOR).tolist()
+
+
+async def road_matrix(points, api_key, chunk=DEFAULT_CHUNK):
+    """
+    Матрица расстояний по дорогам (км) для точек [lon, lat] блоками chunk × chunk.
+
+    Пары, для которых ORS не нашёл маршрут, и блоки с ошибкой заполняются
+    расстоянием по прямой × ROAD_FACTOR. Вернуть (матрица, число блоков с ошибкой).
+    """
+    matrix = straight_matrix(points)
+    if not api_key or len(points) < 2:
+        return matrix, 0
+    blocks = [(i, j) for i in range(0, len(points), chunk) for j in range(0, len(points), chunk)]
+    results = await asyncio.gather(*[
+        fetch_matrix_chunk(points[i:i + chunk], points[j:j + chunk], api_key) for i, j in blocks
+    ], return_exceptions=True)
+    failed = 0
+    for (i, j), distances in zip(blocks, results):
+        if isinstance(distances, Exception):
+            failed += 1
+            continue
+        for di, row in enumerate(distances):
+            for dj, value in enumerate(row):
+                if value is not None:
+                    matrix[i + di][j + dj] = value
+    return matrix, failed
+
+
+# ----------------------------
+# Обход
+# ----------------------------
+def tour_length(tour, dist):
+    """Длина замкнутого обхода."""
+    return sum(dist[tour[k - 1]][tour[k]] for k in range(len(tour)))
+
+
+def nearest_neighbour_tour(dist, start=0):
+    """Обход всех вершин жадно к ближайшей непосещённой, начиная со start."""
+    unvisited = set(range(len(dist)))
+    unvisited.discard(start)
+    tour = [start]
+    while unvisited:
+        row = dist[tour[-1]]
+        nearest = min(unvisited, key=row.__getitem__)
+        unvisited.remove(nearest)
+        tour.append(nearest)
+    return tour
+
+
+def _reverse(tour, pos, start, end):
+    """Развернуть участок обхода с позиции start по end включительно (по кругу)."""
+    n = len(tour)
+    for _ in range(((end - start) % n + 1) // 2):
+        a, b = tour[start], tour[end]
+        tour[start], tour[end] = b, a
+        pos[b], pos[a] = start, end
+        start = (start + 1) % n
+        end = (end - 1) % n
+
+
+def two_opt(tour, dist, neighbours=NEIGHBOURS, max_rounds=100):
+    """
+    Улучшить замкнутый обход обменами 2-opt, пока они сокращают длину.
+
+    Для каждой вершины проверяются только neighbours ближайших (список
+    кандидатов), поэтому проход — O(n × neighbours), а не O(n²). dist должна
+    быть симметричной. Вернуть обход, начинающийся с той же вершины.
+    """
+    n = len(tour)
+    if n < 4:
+        return list(tour)
+    start = tour[0]
+    tour = list(tour)
+    pos = [0] * n
+    for p, node in enumerate(tour):
+        pos[node] = p
+    candidates = [sorted((c for c in range(n) if c != a), key=dist[a].__getitem__)[:neighbours] for a in range(n)]
+    for _ in range(max_rounds):
+        improved = False
+        for a in range(n):
+            for forward in (True, False):
+                i = pos[a]
+                b = tour[(i + 1) % n] if forward else tour[i - 1]
+                d_ab = dist[a][b]
+                for c in candidates[a]:
+                    d_ac = dist[a][c]
+                    if d_ac >= d_ab:
+                        break
+                    j = pos[c]
+                    d = tour[(j + 1) % n] if forward else tour[j - 1]
+                    if c == b or d == a:
+                        continue
+                    if d_ac + dist[b][d] < d_ab + dist[c][d] - 1e-9:
+                        # Рёбра (a, b) и (c, d) заменяются на (a, c) и (b, d)
+                        if forward:
+                            _reverse(tour, pos, (i + 1) % n, j)
+                        else:
+                            _reverse(tour, pos, i, (j - 1) % n)
+                        improved = True
+                        break
+        if not improved:
+            break
+    k = pos[start]
+    return tour[k:] + tour[:k]
+
+
+def split_tour(order, dist, max_stops, max_distance=None):
+    """
+    Разбить порядок объезда (без депо, депо — вершина 0) на поездки из депо и обратно.
+
+    Динамика по префиксам: минимальный суммарный километраж при поездках не
+    больше max_stops остановок и не длиннее max_distance (поездка из одной
+    остановки допускается всегда). Вернуть список списков вершин.
+    """
+    n = len(order)
+    best = [0.0] + [float('inf')] * n
+    cut = [0] * (n + 1)
+    for k in range(n):
+        if best[k] == float('inf'):
+            continue
+        path = 0.0
+        for j in range(k, min(n, k + max_stops)):
+            if j > k:
+                path += dist[order[j - 1]][order[j]]
+            length = dist[0][order[k]] + path + dist[order[j]][0]
+            if max_distance and length > max_distance and j > k:
+                break
+            if best[k] + length < best[j + 1]:
+                best[j + 1] = best[k] + length
+                cut[j + 1] = k
+    trips = []
+    j = n
+    while j > 0:
+        trips.append(order[cut[j]:j])
+        j = cut[j]
+    return trips[::-1]
+
+
+def plan_group(dist, max_stops=DEFAULT_MAX_STOPS, max_distance=None):
+    """Поездки для группы: dist — матрица, где вершина 0 — точка выхода. Вернуть список списков вершин."""
+    n = len(dist)
+    if n <= 2:
+        return [list(range(1, n))] if n == 2 else []
+    symmetric = [[(dist[i][j] + dist[j][i]) / 2 for j in range(n)] for i in range(n)]
+    tour = two_opt(nearest_neighbour_tour(symmetric), symmetric)
+    return split_tour(tour[1:], symmetric, max_stops, max_distance)
+
+
+# ----------------------------
+# План дня
+# ----------------------------
+def _exit_index(exit_points, exit_point, coords):
+    """
+    Индекс точки выхода заказа в справочнике. Точки нет (расстояние взято из
+    кэша, записанного по прежним точкам выхода) — ближайшая к заказу; None,
+    если точек выхода нет совсем.
+    """
+    if exit_point is not None:
+        try:
+            return exit_points.index(list(exit_point))
+        except ValueError:
+            pass
+    nearest_exit, _ = find_nearest_exit_point(coords[1], coords[0])
+    return exit_points.index(nearest_exit) if nearest_exit is not None else None
+
+
+class TripPlanner:
+    """Расчёт заказов через BatchPricer и объединение их в общие поездки по (дата, точка выхода)."""
+
+    def __init__(self, pricer, routing_api_key=None, max_stops=DEFAULT_MAX_STOPS, max_distance=None):
+        self.pricer = pricer
+        self.routing_api_key = routing_api_key
+        self.max_stops = max_stops
+        self.max_distance = max_distance
+        self.stats = {'orders': 0, 'planned': 0, 'route': 0, 'city': 0, 'errors': 0, 'trips': 0,
+                      'isolated_distance': 0.0, 'shared_distance': 0.0, 'matrix_failures': 0}
+
+    async def _price(self, row, semaphore):
+        async with semaphore:
+            result = await self.pricer.price_row(row)
+            coords = None
+            if not result['error']:
+                # Геокодирование уже в кэше прогона: locate не делает новых запросов
+                dest_lat, dest_lon, _, _ = await self.pricer.locate(row)
+                coords = [dest_lon, dest_lat]
+            return result, coords
+
+    async def plan(self, rows):
+        """Вернуть (рассчитанные строки с полями PLAN_FIELDS, список Trip)."""
+        # Расчёт заказов и группировка по точкам выхода — по одной версии справочных данных,
+        # даже если она заменится в фоне посреди плана
+        with pinned_reference():
+            return await self._plan(rows)
+
+    async def _plan(self, rows):
+        # Заказ без даты считается на сегодня: дата подставляется до расчёта, чтобы цена,
+        # календарь рейсов и группа поездки видели один и тот же день
+        today = date.today().isoformat()
+        rows = [row if row.get('delivery_date') else {**row, 'delivery_date': today} for row in rows]
+        semaphore = asyncio.Semaphore(self.pricer.concurrency)
+        priced = await asyncio.gather(*[self._price(row, semaphore) for row in rows])
+        results = [result for result, _ in priced]
+        exit_points = get_reference_data().exit_points
+        calendar = get_route_calendar()
+        groups = defaultdict(list)
+        for index, (result, coords) in enumerate(priced):
+            for field in PLAN_FIELDS:
+                result.setdefault(field, None)
+            self.stats['orders'] += 1
+            if result['error']:
+                self.stats['errors'] += 1
+            elif result['source'] == 'город' or not result['total_distance']:
+                self.stats['city'] += 1
+            elif result['rate_per_km'] == ROUTE_RATE_PER_KM:
+                # Едет с оптовым рейсом этого дня
+                self.stats['route'] += 1
+                delivery_date = parse_date(result.get('delivery_date'))
+                routes = calendar.routes_on(result['locality'], delivery_date) if delivery_date else ()
+                result['trip'] = 'рейс ' + ', '.join(routes) if routes else 'рейс'
+            else:
+                delivery_date = parse_date(result.get('delivery_date'))
+                exit_index = _exit_index(exit_points, result['exit_point'], coords)
+                if exit_index is None:
+                    continue
+                groups[(delivery_date.isoformat() if delivery_date else '', exit_index)].append((index, coords))
+
+        trips = []
+        for (delivery_date, exit_index), members in sorted(groups.items()):
+            points = [exit_points[exit_index]] + [coords for _, coords in members]
+            dist, failed = await road_matrix(points, self.routing_api_key)
+            self.stats['matrix_failures'] += failed
+            for number, nodes in enumerate(plan_group(dist, self.max_stops, self.max_distance), 1):
+                trip = self._allocate(results, members, nodes, dist, f'{delivery_date}/выход {exit_index + 1}/{number}',
+                                      delivery_date, exit_index)
+                trips.append(trip)
+        self.stats['trips'] = len(trips)
+        return results, trips
+
+    def _allocate(self, results, members, nodes, dist, trip_id, delivery_date, exit_index):
+        """
+        Поделить километраж поездки между заказами пропорционально отдельным поездкам туда-обратно.
+
+        Доля поездки от суммы отдельных поездок по матрице применяется к
+        расстоянию из расчёта заказа, поэтому у поездки из одной остановки
+        стоимость совпадает с обычной, а экономия — ноль.
+        """
+        path = [0] + nodes + [0]
+        distance = sum(dist[path[k]][path[k + 1]] for k in range(len(path) - 1))
+        isolated = {node: dist[0][node] + dist[node][0] for node in nodes}
+        ratio = distance / (sum(isolated.values()) or 1.0)
+        orders = []
+        for stop_number, node in enumerate(nodes, 1):
+            index = members[node - 1][0]
+            orders.append(index)
+            result = results[index]
+            allocated = result['total_distance'] * ratio
+            cargo_size = (result.get('cargo_size') or 'маленький').strip()
+            shared_cost = price_for_distance(cargo_prices[cargo_size], allocated, result['rate_per_km'])
+            result.update({
+                'trip': trip_id,
+                'stop_number': stop_number,
+                'trip_distance': round(distance, 3),
+                'allocated_distance': round(allocated, 3),
+                'shared_cost': shared_cost,
+                'trip_saving': result['cost'] - shared_cost,
+            })
+        self.stats['planned'] += len(nodes)
+        self.stats['isolated_distance'] += sum(isolated.values())
+        self.stats['shared_distance'] += distance
+        return Trip(trip_id, delivery_date, exit_index, orders, distance, sum(isolated.values()))
+
+
+# ----------------------------
+# CLI
+# ----------------------------
+def write_plan(results, stream):
+    fieldnames = INPUT_FIELDS + RESULT_FIELDS + PLAN_FIELDS
+    fieldnames += [k for k in (results[0] if results else {}) if k not in fieldnames]
+    writer = csv.DictWriter(stream, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    for row in results:
+        writer.writerow({k: json.dumps(v) if isinstance(v, (list, tuple)) else v for k, v in row.items()})
+
+
+async def _run_cli(rows, args):
+    pricer = BatchPricer(os.environ.get("API_KEY"), os.environ.get("ORS_API_KEY"))
+    planner = TripPlanner(pricer, None if args.straight else os.environ.get("ORS_API_KEY"),
+                          args.max_stops, args.max_distance)
+    try:
+        results, trips = await planner.plan(rows)
+    finally:
+        await close_client()
+    return results, trips, planner.stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Общие поездки по розничным заказам на день")
+    parser.add_argument('input', help="CSV, JSONL или JSON с заказами (как для batch_quote.py)")
+    parser.add_argument('-o', '--output', default='-', help="CSV с планом ('-' — stdout)")
+    parser.add_argument('--max-stops', type=int, default=DEFAULT_MAX_STOPS, help="Остановок в одной поездке")
+    parser.add_argument('--max-distance', type=float, help="Предельный километраж поездки, км")
+    parser.add_argument('--straight', action='store_true', help="Не запрашивать матрицу ORS, считать по прямой")
+    args = parser.parse_args(argv)
+
+    with open(args.input, 'r', encoding='utf-8-sig', newline='') as f:
+        rows = list(read_orders(f, detect_format(args.input)))
+    results, trips, stats = asyncio.run(_run_cli(rows, args))
+    out_stream = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+    try:
+        write_plan(results, out_stream)
+    finally:
+        if out_stream is not sys.stdout:
+            out_stream.close()
+
+    for trip in trips:
+        print(f"{trip.trip_id}: остановок {len(trip.orders)}, {trip.distance:.1f} км "
+              f"вместо {trip.isolated_distance:.1f} км отдельными поездками", file=sys.stderr)
+    saved = stats['isolated_distance'] - stats['shared_distance']
+    print(f"Заказов: {stats['orders']}, в общих поездках: {stats['planned']} ({stats['trips']} поездок), "
+          f"с рейсом: {stats['route']}, по городу: {stats['city']}, ошибок: {stats['errors']}; "
+          f"экономия пробега: {saved:.1f} км", file=sys.stderr)
+    if stats['matrix_failures']:
+        print(f"Блоков матрицы ORS с ошибкой (посчитаны по прямой): {stats['matrix_failures']}", file=sys.stderr)
+    return 0 if stats['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""
+Предрасчитанная сетка ценовых зон вокруг Твери.
+
+Регион делится на ячейки cell_size×cell_size градусов; для центра каждой
+ячейки сохраняются: внутри ли она границы Твери (или пересекает границу),
+ближайшая точка выхода и расстояние по дороге в одну сторону (ORS matrix или
+haversine × ROAD_FACTOR). Массивы лежат в каталоге в формате .npy и
+открываются через mmap, так что загрузка не читает файл целиком, а
+поиск — O(1) по индексу ячейки.
+
+Построение и отчёт о точности:
+    python zone_grid.py build --cell 0.005
+    python zone_grid.py validate --samples 2000
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ZONE_GRID_DIR = os.path.join(BASE_DIR, 'zone_grid')
+FORMAT_VERSION = 1
+
+# Значения массива inside
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+# Регион по умолчанию: около 100 км вокруг Твери
+DEFAULT_BOUNDS = (56.0, 57.8, 34.3, 37.5)  # lat_min, lat_max, lon_min, lon_max
+DEFAULT_CELL = 0.005
+
+
+class ZoneGrid:
+    """Загруженная (через mmap) сетка зон."""
+
+    def __init__(self, path=ZONE_GRID_DIR):
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат сетки: {self.meta.get('format')}")
+        self.path = path
+        self.lat_min, self.lat_max, self.lon_min, self.lon_max = self.meta['bounds']
+        self.cell = self.meta['cell']
+        self.rows, self.cols = self.meta['shape']
+        self.inside = np.load(os.path.join(path, 'inside.npy'), mmap_mode='r')
+        self.exit_idx = np.load(os.path.join(path, 'exit.npy'), mmap_mode='r')
+        self.distance = np.load(os.path.join(path, 'distance.npy'), mmap_mode='r')
+
+    @property
+    def reference_version(self):
+        return self.meta.get('reference_version')
+
+    @property
+    def source(self):
+        return self.meta.get('source')
+
+    def cell_of(self, lat, lon):
+        row = math.floor((lat - self.lat_min) / self.cell)
+        col = math.floor((lon - self.lon_min) / self.cell)
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            return row, col
+        return None
+
+    def lookup(self, lat, lon):
+        """(inside, индекс точки выхода, расстояние в одну сторону, км) или None вне региона."""
+        cell = self.cell_of(lat, lon)
+        if cell is None:
+            return None
+        return int(self.inside[cell]), int(self.exit_idx[cell]), float(self.distance[cell])
+
+
+def load_zone_grid(path=ZONE_GRID_DIR):
+    return ZoneGrid(path)
+
+
+# ----------------------------
+# Построение
+# ----------------------------
+def _cell_centers(bounds, cell):
+    lat_min, lat_max, lon_min, lon_max = bounds
+    rows = math.ceil((lat_max - lat_min) / cell)
+    cols = math.ceil((lon_max - lon_min) / cell)
+    lats = lat_min + (np.arange(rows) + 0.5) * cell
+    lons = lon_min + (np.arange(cols) + 0.5) * cell
+    return rows, cols, lats, lons
+
+
+def crossed_cells(segments, bounds, cell):
+    """
+    Маска rows×cols ячеек, которые задевает хотя бы один отрезок (x1, y1, x2, y2) в (lon, lat).
+
+    Отрезок режется линиями сетки; ячейка каждого куска — по его середине,
+    ячейки концов отрезка (вершин) отмечаются тоже.
+    """
+    lat_min, _, lon_min, _ = bounds
+    rows, cols, _, _ = _cell_centers(bounds, cell)
+    marked = np.zeros((rows, cols), dtype=bool)
+    for x1, y1, x2, y2 in segments:
+        ts = [0.0, 1.0]
+        for a, b, origin in ((x1, x2, lon_min), (y1, y2, lat_min)):
+            if a != b:
+                lo, hi = sorted(((a - origin) / cell, (b - origin) / cell))
+                lines = np.arange(math.ceil(lo), math.floor(hi) + 1) * cell + origin
+                ts.extend(((lines - a) / (b - a)).tolist())
+        ts = np.unique(np.clip(ts, 0.0, 1.0))
+        ts = np.concatenate([ts, (ts[:-1] + ts[1:]) / 2])
+        row = np.floor((y1 + (y2 - y1) * ts - lat_min) / cell).astype(int)
+        col = np.floor((x1 + (x2 - x1) * ts - lon_min) / cell).astype(int)
+        ok = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+        marked[row[ok], col[ok]] = True
+    return marked
+
+
+def classify_cells(boundary, bounds, cell):
+    """
+    Массив rows×cols: OUTSIDE/INSIDE по центру ячейки, BOUNDARY — если углы и
+    центр расходятся или ячейку задевает ребро границы (узкий выступ может
+    пройти между углами и центром).
+    """
+    rows, cols, lats, lons = _cell_centers(bounds, cell)
+    center_lats, center_lons = np.meshgrid(lats, lons, indexing='ij')
+    centers = boundary.contains_many(center_lons.ravel(), center_lats.ravel()).reshape(rows, cols)
+    corner_lats = bounds[0] + np.arange(rows + 1) * cell
+    corner_lons = bounds[2] + np.arange(cols + 1) * cell
+    grid_lats, grid_lons = np.meshgrid(corner_lats, corner_lons, indexing='ij')
+    corners = boundary.contains_many(grid_lons.ravel(), grid_lats.ravel()).reshape(rows + 1, cols + 1)
+    same = ((corners[:-1, :-1] == centers) & (corners[1:, :-1] == centers)
+            & (corners[:-1, 1:] == centers) & (corners[1:, 1:] == centers))
+    inside = np.where(centers, INSIDE, OUTSIDE).astype(np.uint8)
+    inside[~same | crossed_cells(boundary.segments, bounds, cell)] = BOUNDARY
+    return inside
+
+
+async def _ors_distances(lats, lons, exit_idx, exit_points, api_key, chunk):
+    from http_client import close_client
+    from precompute_distances import fetch_matrix_chunk
+
+    distances = np.full(lats.shape, np.nan, dtype=np.float64)
+    try:
+        for start in range(0, lats.size, chunk):
+            part = slice(start, start + chunk)
+            destinations = list(zip(lons[part].tolist(), lats[part].tolist()))
+            matrix = np.array(await fetch_matrix_chunk(exit_points, destinations, api_key), dtype=float)
+            distances[part] = matrix[exit_idx[part], np.arange(matrix.shape[1])]
+            print(f"ORS: {min(start + chunk, lats.size)}/{lats.size}", file=sys.stderr)
+    finally:
+        await close_client()
+    return distances
+
+
+def build_zone_grid(path=ZONE_GRID_DIR, bounds=DEFAULT_BOUNDS, cell=DEFAULT_CELL, source='haversine',
+                    api_key=None, chunk=50):
+    """Построить сетку и сохранить её в каталог path. Вернуть meta."""
+    from delivery_core import PINNED_TOLERANCE, ROAD_FACTOR, find_nearest_exit_points_many, get_reference_data
+
+    reference = get_reference_data()
+    rows, cols, lats, lons = _cell_centers(bounds, cell)
+    inside = classify_cells(reference.tver_boundary, bounds, cell)
+    center_lats, center_lons = np.meshgrid(lats, lons, indexing='ij')
+    exit_idx, dist_to_exit = find_nearest_exit_points_many(center_lats.ravel(), center_lons.ravel())
+    # Ячейки, задевающие зону привязки пунктов к точкам 8 и 7, считаются точным путём
+    reach = PINNED_TOLERANCE + cell / 2
+    for lat, lon in reference.pinned_index.points:
+        inside[(np.abs(center_lats - lat) < reach) & (np.abs(center_lons - lon) < reach)] = BOUNDARY
+    road = dist_to_exit * ROAD_FACTOR
+    if source == 'ors':
+        if not api_key:
+            raise ValueError("Для source=ors нужен ORS_API_KEY")
+        outside = np.flatnonzero((inside.ravel() != INSIDE) & (exit_idx >= 0))
+        ors = asyncio.run(_ors_distances(center_lats.ravel()[outside], center_lons.ravel()[outside],
+                                         exit_idx[outside], reference.exit_points, api_key, chunk))
+        # Там, где ORS не нашёл маршрут, остаётся haversine × ROAD_FACTOR
+        found = ~np.isnan(ors)
+        road[outside[found]] = ors[found]
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'inside.npy'), inside)
+    np.save(os.path.join(path, 'exit.npy'), exit_idx.reshape(rows, cols).astype(np.int16))
+    np.save(os.path.join(path, 'distance.npy'), road.reshape(rows, cols).astype(np.float32))
+    meta = {
+        'format': FORMAT_VERSION,
+        'bounds': list(bounds),
+        'cell': cell,
+        'shape': [rows, cols],
+        'source': source,
+        'road_factor': ROAD_FACTOR,
+        'reference_version': reference.version,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+# ----------------------------
+# Проверка точности
+# ----------------------------
+class _NullStore:
+    """Хранилище без записей: точный путь не должен брать ответы из кэша."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, entry):
+        pass
+
+
+def validate_zone_grid(grid, samples=2000, cargo_size='средний', seed=42):
+    """Сравнить цены по сетке с точным расчётом (без ORS) в случайных точках региона."""
+    from delivery_core import calculate_delivery_cost, coordinates_locality
+
+    rng = random.Random(seed)
+    store = _NullStore()
+    report = {'samples': 0, 'boundary_fallbacks': 0, 'inside_mismatches': 0, 'cost_equal': 0,
+              'cost_diffs': [], 'distance_diffs': []}
+
+    async def run():
+        for _ in range(samples):
+            lat = rng.uniform(grid.lat_min, grid.lat_max)
+            lon = rng.uniform(grid.lon_min, grid.lon_max)
+            address = coordinates_locality(lat, lon)
+            exact = await calculate_delivery_cost(cargo_size, lat, lon, address, None, store=store, zone_grid=False)
+            fast = await calculate_delivery_cost(cargo_size, lat, lon, address, None, store=store, zone_grid=grid)
+            report['samples'] += 1
+            if fast.source != 'сетка':
+                report['boundary_fallbacks'] += 1
+            if (exact.source == 'город') != (fast.source == 'город'):
+                report['inside_mismatches'] += 1
+            report['cost_equal'] += exact.cost == fast.cost
+            report['cost_diffs'].append(abs(exact.cost - fast.cost))
+            report['distance_diffs'].append(abs(exact.total_distance - fast.total_distance))
+
+    asyncio.run(run())
+    cost_diffs = np.array(report.pop('cost_diffs'))
+    distance_diffs = np.array(report.pop('distance_diffs'))
+    report.update({
+        'cost_equal_share': report['cost_equal'] / max(report['samples'], 1),
+        'cost_diff_mean': float(cost_diffs.mean()) if cost_diffs.size else 0.0,
+        'cost_diff_p95': float(np.percentile(cost_diffs, 95)) if cost_diffs.size else 0.0,
+        'cost_diff_max': float(cost_diffs.max()) if cost_diffs.size else 0.0,
+        'distance_diff_mean_km': float(distance_diffs.mean()) if distance_diffs.size else 0.0,
+        'distance_diff_max_km': float(distance_diffs.max()) if distance_diffs.size else 0.0,
+    })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сетка ценовых зон для мгновенного расчёта по координатам")
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help="Построить сетку")
+    build.add_argument('--path', default=ZONE_GRID_DIR)
+    build.add_argument('--cell', type=float, default=DEFAULT_CELL, help="Размер ячейки, градусы")
+    build.add_argument('--bounds', type=float, nargs=4, default=DEFAULT_BOUNDS,
+                       metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'))
+    build.add_argument('--source', choices=['haversine', 'ors'], default='haversine')
+    build.add_argument('--chunk', type=int, default=50, help="Ячеек в одном запросе ORS matrix")
+    validate = sub.add_parser('validate', help="Сравнить сетку с точным расчётом")
+    validate.add_argument('--path', default=ZONE_GRID_DIR)
+    validate.add_argument('--samples', type=int, default=2000)
+    validate.add_argument('--report', help="Сохранить отчёт в JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        meta = build_zone_grid(args.path, tuple(args.bounds), args.cell, args.source, os.environ.get('ORS_API_KEY'),
+                               args.chunk)
+        print(f"Сетка {meta['shape'][0]}×{meta['shape'][1]} ({meta['source']}) сохранена в {args.path}")
+        return 0
+    report = validate_zone_grid(load_zone_grid(args.path), args.samples)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())